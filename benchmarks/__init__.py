@@ -0,0 +1,8 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# =====================================
+# @Time    : 2021/04/12
+# @Author  : Yang Guan (Tsinghua Univ.)
+# @FileName: __init__.py
+# =====================================
@@ -0,0 +1,392 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# =====================================
+# @Time    : 2021/04/12
+# @Author  : Yang Guan (Tsinghua Univ.)
+# @FileName: run_benchmarks.py
+# =====================================
+
+"""micro-benchmarks of the hot paths, run from the repo root e.g.
+    python -m benchmarks.run_benchmarks --save-baseline my_machine
+    python -m benchmarks.run_benchmarks --compare my_machine
+every benchmark runs in a fresh process, since there is only one sumo per process"""
+
+import argparse
+import concurrent.futures
+import datetime
+import json
+import multiprocessing as mp
+import os
+import platform
+import random
+import sys
+import time
+from collections import OrderedDict
+
+import numpy as np
+
+dirname = os.path.dirname(__file__)
+BASELINE_DIR = os.path.join(dirname, 'baselines')
+BENCHMARKS = OrderedDict()
+
+
+class SkipBenchmark(Exception):
+    pass
+
+
+def benchmark(name):
+    def decorator(fn):
+        BENCHMARKS[name] = fn
+        return fn
+    return decorator
+
+
+def _measure(fn, repeat, warmup=3):
+    for _ in range(warmup):  # tracing of tf.functions etc.
+        fn()
+    durations = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        durations.append(time.perf_counter() - start)
+    return np.array(durations)
+
+
+def _latency(durations, prefix=''):
+    return OrderedDict([(prefix + 'median_ms', float(np.median(durations)) * 1000.),
+                        (prefix + 'p90_ms', float(np.percentile(durations, 90)) * 1000.)])
+
+
+def _seed(seed):
+    random.seed(seed)
+    np.random.seed(seed)
+
+
+def _make_env(args, **kwargs):
+    from endtoend import CrossroadEnd2end
+    _seed(args.seed)
+    env = CrossroadEnd2end(args.task, args.num_future_data, backend=args.env_backend, **kwargs)
+    env.seed(args.seed)
+    return env
+
+
+def _random_action(rng):  # mostly forward, so that the episodes are not too short
+    return rng.uniform([-0.2, -0.5], [0.2, 1.]).astype(np.float32)
+
+
+def _sample_obses(task, num_future_data, n, seed=0):
+    # observations of the surrogate traffic, realistic enough for the model benchmarks and no sumo is needed
+    from endtoend import CrossroadEnd2end
+    _seed(seed)
+    env = CrossroadEnd2end(task, num_future_data, backend='numpy', traffic_backend='surrogate')
+    rng = np.random.RandomState(seed)
+    obses = [env.reset()]
+    while len(obses) < n:
+        obs, _, done, _ = env.step(_random_action(rng))
+        obses.append(env.reset() if done else obs)
+    env.close()
+    return np.array(obses, dtype=np.float32)
+
+
+def _tile(obses, batch_size):
+    return obses[np.arange(batch_size) % len(obses)]
+
+
+def _batch_benchmark(args, obses, fn):
+    import tensorflow as tf
+    out = OrderedDict()
+    rng = np.random.RandomState(args.seed)
+    for batch_size in args.batch_sizes:
+        batch_obses = tf.constant(_tile(obses, batch_size))
+        actions = tf.constant(rng.uniform(-1, 1, (batch_size, 2)).astype(np.float32))
+        durations = _measure(lambda: fn(batch_obses, actions), args.repeat)
+        out['b{}_samples_per_sec'.format(batch_size)] = batch_size / float(np.median(durations))
+        out.update(_latency(durations, 'b{}_'.format(batch_size)))
+    return out
+
+
+@benchmark('env_step')
+def bench_env_step(args):
+    env = _make_env(args, traffic_backend=args.traffic_backend)
+    env.reset()
+    rng = np.random.RandomState(args.seed)
+    durations = []
+    for _ in range(args.env_steps):
+        action = _random_action(rng)
+        start = time.perf_counter()
+        _, _, done, _ = env.step(action)
+        durations.append(time.perf_counter() - start)
+        if done:
+            env.reset()
+    durations = np.array(durations[10:])
+    return OrderedDict([('steps_per_sec', 1. / float(np.mean(durations)))] + list(_latency(durations).items()))
+
+
+@benchmark('env_reset')
+def bench_env_reset(args):
+    env = _make_env(args, traffic_backend=args.traffic_backend)
+    env.reset()
+    rng = np.random.RandomState(args.seed)
+    durations = []
+    for _ in range(args.env_resets):
+        for _ in range(10):  # let the traffic move on
+            env.step(_random_action(rng))
+        start = time.perf_counter()
+        env.reset()
+        durations.append(time.perf_counter() - start)
+    durations = np.array(durations)
+    return OrderedDict([('resets_per_sec', 1. / float(np.mean(durations)))] + list(_latency(durations).items()))
+
+
+@benchmark('model_rollout_out')
+def bench_model_rollout_out(args):
+    import tensorflow as tf
+    from dynamics_and_models import EnvironmentModel
+    obses = _sample_obses(args.task, args.num_future_data, 256, args.seed)
+    model = EnvironmentModel(args.task, args.num_future_data)
+    num_paths = len(model.ref_path.path_list)
+
+    @tf.function
+    def rollout(obses, actions):
+        ref_indexes = tf.range(tf.shape(obses)[0]) % num_paths
+        model.reset(obses, ref_indexes)
+        return model.rollout_out(actions)[:2]
+    return _batch_benchmark(args, obses, rollout)
+
+
+@benchmark('model_rollout')
+def bench_model_rollout(args):
+    import tensorflow as tf
+    from dynamics_and_models import EnvironmentModel
+    obses = _sample_obses(args.task, args.num_future_data, 256, args.seed)
+    model = EnvironmentModel(args.task, args.num_future_data)
+    num_paths = len(model.ref_path.path_list)
+    weights = tf.constant(np.random.RandomState(args.seed).normal(0, 0.05, (obses.shape[1], 2)).astype(np.float32))
+
+    @tf.function
+    def policy(obses):  # a stand-in for a trained policy, mostly forward
+        return 0.3 * tf.tanh(tf.matmul(obses, weights)) + tf.constant([0., 0.6])
+
+    def rollout(obses, actions):
+        ref_indexes = tf.range(tf.shape(obses)[0]) % num_paths
+        return model.rollout(obses, policy, args.rollout_horizon, ref_indexes)[:2]
+    return _batch_benchmark(args, obses, rollout)
+
+
+@benchmark('model_compute_rewards')
+def bench_model_compute_rewards(args):
+    import tensorflow as tf
+    from dynamics_and_models import EnvironmentModel
+    obses = _sample_obses(args.task, args.num_future_data, 256, args.seed)
+    model = EnvironmentModel(args.task, args.num_future_data)
+
+    @tf.function
+    def compute_rewards(obses, actions):
+        return model.compute_rewards(obses, model._action_transformation_for_end2end(actions))[0]
+    return _batch_benchmark(args, obses, compute_rewards)
+
+
+@benchmark('ref_path_tracking_error_vector')
+def bench_tracking_error_vector(args):
+    # eager, as it is called by the env
+    from dynamics_and_models import ReferencePath
+    obses = _sample_obses(args.task, args.num_future_data, 256, args.seed)
+    path = ReferencePath(args.task)
+    out = OrderedDict()
+    for batch_size in args.batch_sizes:
+        batch_obses = _tile(obses, batch_size)
+        ego_vs, ego_xs, ego_ys, ego_phis = batch_obses[:, 0], batch_obses[:, 3], batch_obses[:, 4], batch_obses[:, 5]
+        durations = _measure(lambda: path.tracking_error_vector(ego_xs, ego_ys, ego_phis, ego_vs,
+                                                                args.num_future_data), args.repeat)
+        out.update(_latency(durations, 'b{}_'.format(batch_size)))
+    return out
+
+
+def _load_policy(args):
+    if args.policy_dir is None:
+        raise SkipBenchmark('no --policy-dir given')
+    from utils.load_policy import LoadPolicy
+    return LoadPolicy(args.policy_dir, args.policy_iter)
+
+
+@benchmark('policy_run_batch')
+def bench_policy_run_batch(args):
+    policy = _load_policy(args)
+    obses = _sample_obses(policy.args.env_kwargs_training_task, policy.args.env_kwargs_num_future_data, 256,
+                          args.seed)
+    return _batch_benchmark(args, obses, lambda obses, actions: policy.run_batch(obses))
+
+
+@benchmark('policy_obj_value_batch')
+def bench_policy_obj_value_batch(args):
+    policy = _load_policy(args)
+    obses = _sample_obses(policy.args.env_kwargs_training_task, policy.args.env_kwargs_num_future_data, 256,
+                          args.seed)
+    return _batch_benchmark(args, obses, lambda obses, actions: policy.obj_value_batch(obses))
+
+
+@benchmark('hier_decision_step')
+def bench_hier_decision_step(args):
+    if args.hier_exp_dir is None:
+        raise SkipBenchmark('no --hier-exp-dir given')
+    os.chdir(os.path.join(dirname, '..', 'hierarchical_decision'))  # the model path is relative to it
+    from hierarchical_decision.hier_decision import HierarchicalDecision
+    _seed(args.seed)
+    hier_decision = HierarchicalDecision(args.task, args.hier_exp_dir, args.hier_ite)
+    hier_decision.reset()
+    durations = []
+    for _ in range(args.hier_steps):
+        start = time.perf_counter()
+        done = hier_decision.step()
+        durations.append(time.perf_counter() - start)
+        if done:
+            hier_decision.reset()
+    return _latency(np.array(durations[3:]))
+
+
+@benchmark('mpc_solver')
+def bench_mpc_solver(args):
+    try:
+        from mpc.mpc_ipopt import ModelPredictiveControl
+    except ImportError as e:
+        raise SkipBenchmark(str(e))
+    obses = _sample_obses(args.task, 0, 64, args.seed)[::8]
+    durations = []
+    for obs in obses:
+        mpc = ModelPredictiveControl(args.mpc_horizon, args.task, 0, ref_index=0)
+        state_all = np.array((list(obs[:9]) + [0, 0]) * args.mpc_horizon + list(obs[:9])).reshape((-1, 1))
+        start = time.perf_counter()
+        mpc.mpc_solver(list(obs), state_all)
+        durations.append(time.perf_counter() - start)
+    return _latency(np.array(durations))
+
+
+def _run_benchmark(name, args):
+    try:
+        return 'ok', BENCHMARKS[name](args)
+    except SkipBenchmark as e:
+        return 'skipped', str(e)
+
+
+def run_isolated(name, args):
+    with concurrent.futures.ProcessPoolExecutor(max_workers=1, mp_context=mp.get_context('spawn')) as executor:
+        return executor.submit(_run_benchmark, name, args).result()
+
+
+def _package_version(name):
+    try:
+        from importlib.metadata import version
+        return version(name)
+    except Exception:
+        return None
+
+
+def machine_info():
+    return OrderedDict(time=datetime.datetime.now().isoformat(timespec='seconds'),
+                       platform=platform.platform(),
+                       processor=platform.processor(),
+                       cpu_count=os.cpu_count(),
+                       python=platform.python_version(),
+                       numpy=np.__version__,
+                       tensorflow=_package_version('tensorflow'),
+                       sumo=_package_version('eclipse-sumo'))
+
+
+def baseline_path(name):  # a baseline name, or the path of a json file
+    return name if name.endswith('.json') else os.path.join(BASELINE_DIR, name + '.json')
+
+
+def compare(results, baseline, tolerance):
+    """prints the change of every metric, metrics named *_per_sec are better higher, the others (latencies) lower.
+    returns the (benchmark, metric) pairs that got worse by more than tolerance"""
+    regressions = []
+    print('{:<32}{:<26}{:>12}{:>12}{:>9}'.format('benchmark', 'metric', 'baseline', 'current', 'change'))
+    for name, metrics in results.items():
+        base_metrics = baseline.get(name)
+        if not isinstance(metrics, dict) or not isinstance(base_metrics, dict):
+            continue
+        for metric, value in metrics.items():
+            if metric not in base_metrics:
+                continue
+            base_value = base_metrics[metric]
+            change = value / base_value - 1.
+            worse = -change if metric.endswith('_per_sec') else change
+            flag = ''
+            if worse > tolerance:
+                regressions.append((name, metric))
+                flag = '  <-- regression'
+            print('{:<32}{:<26}{:>12.3f}{:>12.3f}{:>+8.1f}%{}'.format(name, metric, base_value, value,
+                                                                      change * 100., flag))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='micro-benchmarks of the env, model, policy and planner')
+    parser.add_argument('--only', type=str, default=None, help='comma separated names, out of: ' +
+                                                                 ', '.join(BENCHMARKS))
+    parser.add_argument('--task', type=str, default='left')
+    parser.add_argument('--num-future-data', type=int, default=0)
+    parser.add_argument('--env-backend', type=str, default='tf')
+    parser.add_argument('--traffic-backend', type=str, default='sumo')
+    parser.add_argument('--batch-sizes', type=str, default='1,16,256,4096')
+    parser.add_argument('--repeat', type=int, default=30)
+    parser.add_argument('--env-steps', type=int, default=500)
+    parser.add_argument('--env-resets', type=int, default=30)
+    parser.add_argument('--policy-dir', type=str, default=None, help='exp dir of a trained policy')
+    parser.add_argument('--policy-iter', type=int, default=None)
+    parser.add_argument('--hier-exp-dir', type=str, default=None, help='under utils/models/<task>/')
+    parser.add_argument('--hier-ite', type=int, default=None)
+    parser.add_argument('--hier-steps', type=int, default=50)
+    parser.add_argument('--mpc-horizon', type=int, default=25)
+    parser.add_argument('--rollout-horizon', type=int, default=20)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', type=str, default=None, help='json file to write the results to')
+    parser.add_argument('--save-baseline', type=str, default=None, help='name of the baseline to write')
+    parser.add_argument('--compare', type=str, default=None, help='name or json file of the baseline')
+    parser.add_argument('--tolerance', type=float, default=0.1, help='relative change counted as regression')
+    args = parser.parse_args(argv)
+    args.batch_sizes = [int(b) for b in args.batch_sizes.split(',')]
+    names = list(BENCHMARKS) if args.only is None else args.only.split(',')
+    for name in names:
+        assert name in BENCHMARKS, name
+
+    results = OrderedDict()
+    for name in names:
+        start = time.time()
+        status, result = run_isolated(name, args)
+        if status == 'ok':
+            results[name] = result
+            print('{} ({:.0f}s): {}'.format(name, time.time() - start,
+                                            ', '.join('{}={:.3f}'.format(k, v) for k, v in result.items())))
+        else:
+            print('{} skipped: {}'.format(name, result))
+    report = OrderedDict(machine=machine_info(),
+                         config=OrderedDict((k, v) for k, v in vars(args).items()
+                                            if k not in ['only', 'output', 'save_baseline', 'compare', 'tolerance']),
+                         results=results)
+
+    paths = [args.output] if args.output is not None else []
+    if args.save_baseline is not None:
+        os.makedirs(BASELINE_DIR, exist_ok=True)
+        paths.append(baseline_path(args.save_baseline))
+    for path in paths:
+        with open(path, 'w') as f:
+            json.dump(report, f, indent=2)
+        print('written to', path)
+
+    if args.compare is not None:
+        with open(baseline_path(args.compare)) as f:
+            baseline = json.load(f)
+        changed = [k for k, v in report['config'].items() if baseline['config'].get(k) != v]
+        if changed:
+            print('warning: config differs from the baseline in', changed)
+        regressions = compare(results, baseline['results'], args.tolerance)
+        if regressions:
+            print('{} regression(s) beyond {:.0f}%'.format(len(regressions), args.tolerance * 100.))
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
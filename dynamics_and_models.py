@@ -7,7 +7,8 @@
 # @FileName: dynamics_and_models.py
 # =====================================
 
-from math import pi, cos, sin
+import os
+from math import pi, cos, sin, sqrt, atan
 
 import bezier
 import matplotlib.pyplot as plt
@@ -17,7 +18,7 @@ from tensorflow import logical_and
 
 # gym.envs.user_defined.toyota_env.
 from endtoend_env_utils import rotate_coordination, L, W, CROSSROAD_SIZE, LANE_WIDTH, LANE_NUMBER, \
-    VEHICLE_MODE_LIST, EXPECTED_V
+    VEHICLE_MODE_LIST, EXPECTED_V, VEH_NUM, PATH_CACHE_DIR, veh_turn_radii, predict_vehs
 
 tf.config.threading.set_inter_op_parallelism_threads(1)
 tf.config.threading.set_intra_op_parallelism_threads(1)
@@ -82,10 +83,78 @@ class VehicleDynamics(object):
 
         return tf.stack(next_state, 1), tf.stack([alpha_f, alpha_r, miu_f, miu_r], 1)
 
+    def f_xu_jacobians(self, states, actions, tau):
+        """closed-form jacobians of the next states of f_xu w.r.t. the states [B, 6, 6] and the actions [B, 6, 2],
+        e.g. for linearizing the model along a trajectory without a gradient tape"""
+        v_x, v_y, r, phi = states[:, 0], states[:, 1], states[:, 2], states[:, 5]
+        phi = phi * np.pi / 180.
+        steer = actions[:, 0]
+        C_f, C_r, a, b, mass, I_z = [tf.convert_to_tensor(self.vehicle_params[key], dtype=tf.float32)
+                                     for key in ['C_f', 'C_r', 'a', 'b', 'mass', 'I_z']]
+        zeros, ones = tf.zeros_like(v_x), tf.ones_like(v_x)
+        cos_phi, sin_phi = tf.cos(phi), tf.sin(phi)
+
+        # next v_y and r are fractions num/den, d(num/den) = (d num * den - num * d den) / den^2
+        num_v_y = mass * v_y * v_x + tau * (a * C_f - b * C_r) * r - tau * C_f * steer * v_x - \
+                  tau * mass * tf.square(v_x) * r
+        den_v_y = mass * v_x - tau * (C_f + C_r)
+        num_r = -I_z * r * v_x - tau * (a * C_f - b * C_r) * v_y + tau * a * C_f * steer * v_x
+        den_r = tau * (tf.square(a) * C_f + tf.square(b) * C_r) - I_z * v_x
+
+        df_dx = [[ones, tau * r, tau * v_y, zeros, zeros, zeros],
+                 [((mass * v_y - tau * C_f * steer - 2. * tau * mass * v_x * r) * den_v_y - num_v_y * mass) /
+                  tf.square(den_v_y),
+                  mass * v_x / den_v_y,
+                  (tau * (a * C_f - b * C_r) - tau * mass * tf.square(v_x)) / den_v_y,
+                  zeros, zeros, zeros],
+                 [((-I_z * r + tau * a * C_f * steer) * den_r + num_r * I_z) / tf.square(den_r),
+                  -tau * (a * C_f - b * C_r) / den_r,
+                  -I_z * v_x / den_r,
+                  zeros, zeros, zeros],
+                 [tau * cos_phi, -tau * sin_phi, zeros, ones, zeros,
+                  tau * (-v_x * sin_phi - v_y * cos_phi) * np.pi / 180.],
+                 [tau * sin_phi, tau * cos_phi, zeros, zeros, ones,
+                  tau * (v_x * cos_phi - v_y * sin_phi) * np.pi / 180.],
+                 [zeros, zeros, tau * 180 / np.pi * ones, zeros, zeros, ones]]
+        df_du = [[zeros, tau * ones],
+                 [-tau * C_f * v_x / den_v_y, zeros],
+                 [tau * a * C_f * v_x / den_r, zeros],
+                 [zeros, zeros],
+                 [zeros, zeros],
+                 [zeros, zeros]]
+        return tf.stack([tf.stack(row, 1) for row in df_dx], 1), tf.stack([tf.stack(row, 1) for row in df_du], 1)
+
     def prediction(self, x_1, u_1, frequency):
         x_next, next_params = self.f_xu(x_1, u_1, 1 / frequency)
         return x_next, next_params
 
+    def np_f_xu(self, state, action, tau):  # single sample, state and action are 1-d arrays, computed in float64
+        v_x, v_y, r, x, y, phi = [float(s) for s in state]
+        phi = phi * pi / 180.
+        steer, a_x = float(action[0]), float(action[1])
+        C_f, C_r, a, b, mass, I_z, miu, F_zf, F_zr = [self.vehicle_params[key] for key in
+                                                      ['C_f', 'C_r', 'a', 'b', 'mass', 'I_z', 'miu', 'F_zf', 'F_zr']]
+        F_xf = mass * a_x / 2 if a_x < 0 else 0.
+        F_xr = mass * a_x / 2 if a_x < 0 else mass * a_x
+        miu_f = sqrt(max((miu * F_zf) ** 2 - F_xf ** 2, 0.)) / F_zf
+        miu_r = sqrt(max((miu * F_zr) ** 2 - F_xr ** 2, 0.)) / F_zr
+        alpha_f = atan((v_y + a * r) / (v_x+1e-8)) - steer
+        alpha_r = atan((v_y - b * r) / (v_x+1e-8))
+
+        next_state = [v_x + tau * (a_x + v_y * r),
+                      (mass * v_y * v_x + tau * (a * C_f - b * C_r) * r - tau * C_f * steer * v_x
+                       - tau * mass * v_x ** 2 * r) / (mass * v_x - tau * (C_f + C_r)),
+                      (-I_z * r * v_x - tau * (a * C_f - b * C_r) * v_y + tau * a * C_f * steer * v_x) / (
+                              tau * (a ** 2 * C_f + b ** 2 * C_r) - I_z * v_x),
+                      x + tau * (v_x * cos(phi) - v_y * sin(phi)),
+                      y + tau * (v_x * sin(phi) + v_y * cos(phi)),
+                      (phi + tau * r) * 180 / pi]
+        return np.array(next_state), np.array([alpha_f, alpha_r, miu_f, miu_r])
+
+    def np_prediction(self, x_1, u_1, frequency):
+        x_next, next_params = self.np_f_xu(x_1, u_1, 1 / frequency)
+        return x_next, next_params
+
 
 class EnvironmentModel(object):  # all tensors
     def __init__(self, training_task, num_future_data=0, mode='training'):
@@ -98,21 +167,26 @@ class EnvironmentModel(object):  # all tensors
         self.actions = None
         self.ref_path = ReferencePath(self.task)
         self.ref_indexes = None
+        self.closest_indexs = None  # closest path points of the last step, hints for the next search
         self.num_future_data = num_future_data
         self.exp_v = EXPECTED_V
         self.reward_info = None
         self.ego_info_dim = 6
         self.per_veh_info_dim = 4
         self.per_tracking_info_dim = 3
+        self.veh_turn_radii = veh_turn_radii(VEHICLE_MODE_LIST[self.task])
+        self._rollout_fns = {}  # (policy_fn, horizon, path, jit_compile) -> compiled rollout, see rollout
 
     def reset(self, obses, ref_indexes=None):  # input are all tensors
         self.obses = obses
         self.ref_indexes = ref_indexes
+        self.closest_indexs = None
         self.actions = None
         self.reward_info = None
 
     def add_traj(self, obses, path_index):
         self.obses = obses
+        self.closest_indexs = None
         self.ref_path.set_path(path_index)
 
     def rollout_out(self, actions):  # obses and actions are tensors, think of actions are in range [-1, 1]
@@ -120,11 +194,61 @@ class EnvironmentModel(object):  # all tensors
             self.actions = self._action_transformation_for_end2end(actions)
             rewards, punish_term_for_training, real_punish_term, veh2veh4real, veh2road4real, _ \
                 = self.compute_rewards(self.obses, self.actions)
-            self.obses = self.compute_next_obses(self.obses, self.actions)
+            self.obses, self.closest_indexs = self._compute_next_obses(self.obses, self.actions, self.closest_indexs)
             # self.reward_info.update({'final_rew': rewards.numpy()[0]})
 
         return self.obses, rewards, punish_term_for_training, real_punish_term, veh2veh4real, veh2road4real
 
+    def rollout(self, obses, policy_fn, horizon, ref_indexes=None, jit_compile=True):
+        """rolls the model out for horizon steps from obses with the actions of policy_fn (obses -> actions in
+        [-1, 1], traceable by tf.function), as horizon calls of rollout_out would do. returns the next obses
+        [horizon, B, obs_dim] and the rewards, punish_term_for_training, real_punish_term, veh2veh4real and
+        veh2road4real [horizon, B] of every step. the steps run in a tf.while_loop compiled by XLA, so that the
+        graph does not grow with the horizon. one function is traced per policy_fn, horizon and, out of training,
+        the path set by add_traj, which is a constant of the graph. the state of the model is left untouched"""
+        path_key = None if self.mode == 'training' else self.ref_path.ref_index
+        key = (policy_fn, horizon, path_key, jit_compile)
+        if key not in self._rollout_fns:
+            self._rollout_fns[key] = self._build_rollout(policy_fn, horizon, obses.shape[-1], jit_compile)
+        obses = tf.convert_to_tensor(obses, dtype=tf.float32)
+        if self.mode == 'training':
+            ref_indexes = self.ref_indexes if ref_indexes is None else ref_indexes
+            return self._rollout_fns[key](obses, tf.cast(ref_indexes, tf.int32))
+        return self._rollout_fns[key](obses)
+
+    def _build_rollout(self, policy_fn, horizon, obs_dim, jit_compile):
+        assert horizon >= 1
+
+        def step(obses, hint_indexs, ref_indexes):
+            actions = self._action_transformation_for_end2end(policy_fn(obses))
+            rewards, punish_term_for_training, real_punish_term, veh2veh4real, veh2road4real, _ \
+                = self.compute_rewards(obses, actions)
+            next_obses, closest_indexs = self._compute_next_obses(obses, actions, hint_indexs, ref_indexes)
+            return next_obses, closest_indexs, \
+                (next_obses, rewards, punish_term_for_training, real_punish_term, veh2veh4real, veh2road4real)
+
+        def rollout(obses, ref_indexes=None):
+            with tf.name_scope('model_rollout'):
+                # the first step searches the whole path as rollout_out does without hints, so it is peeled off
+                # the loop, whose steps are warm-started by the matches of the previous one
+                obses, closest_indexs, outs = step(obses, None, ref_indexes)
+                tas = [tf.TensorArray(out.dtype, size=horizon, element_shape=out.shape).write(0, out)
+                       for out in outs]
+
+                def body(i, obses, closest_indexs, tas):
+                    obses, closest_indexs, outs = step(obses, closest_indexs, ref_indexes)
+                    return i + 1, obses, closest_indexs, [ta.write(i, out) for ta, out in zip(tas, outs)]
+
+                _, _, _, tas = tf.while_loop(lambda i, *_: i < horizon, body,
+                                             (tf.constant(1), obses, closest_indexs, tas),
+                                             maximum_iterations=horizon - 1)
+                return tuple(ta.stack() for ta in tas)
+
+        input_signature = [tf.TensorSpec([None, obs_dim], tf.float32)]
+        if self.mode == 'training':
+            input_signature.append(tf.TensorSpec([None], tf.int32))
+        return tf.function(rollout, input_signature=input_signature, jit_compile=jit_compile)
+
     def _action_transformation_for_end2end(self, actions):  # [-1, 1]
         actions = tf.clip_by_value(actions, -1.05, 1.05)
         steer_norm, a_xs_norm = actions[:, 0], actions[:, 1]
@@ -132,6 +256,9 @@ class EnvironmentModel(object):  # all tensors
         return tf.stack([steer_scale, a_xs_scale], 1)
 
     def ss(self, obses, actions, lam=0.1):
+        """discrete-time barrier constraint next_g >= (1-lam)*g on the distances g between the circles of the ego
+        and of the vehicles within 10m, as in compute_rewards. returns the summed squared violations [B] and
+        those of every vehicle slot [B, N], which tell the binding vehicles"""
         actions = self._action_transformation_for_end2end(actions)
         next_obses = self.compute_next_obses(obses, actions)
         ego_infos, veh_infos = obses[:, :self.ego_info_dim], \
@@ -140,48 +267,43 @@ class EnvironmentModel(object):  # all tensors
         next_ego_infos, next_veh_infos = next_obses[:, :self.ego_info_dim], \
                                          next_obses[:, self.ego_info_dim + self.per_tracking_info_dim * (
                                                    self.num_future_data + 1):]
-        ego_lws = (L - W) / 2.
-        ego_front_points = tf.cast(ego_infos[:, 3] + ego_lws * tf.cos(ego_infos[:, 5] * np.pi / 180.),
-                                   dtype=tf.float32), \
-                           tf.cast(ego_infos[:, 4] + ego_lws * tf.sin(ego_infos[:, 5] * np.pi / 180.), dtype=tf.float32)
-        ego_rear_points = tf.cast(ego_infos[:, 3] - ego_lws * tf.cos(ego_infos[:, 5] * np.pi / 180.), dtype=tf.float32), \
-                          tf.cast(ego_infos[:, 4] - ego_lws * tf.sin(ego_infos[:, 5] * np.pi / 180.), dtype=tf.float32)
-
-        next_ego_front_points = tf.cast(next_ego_infos[:, 3] + ego_lws * tf.cos(next_ego_infos[:, 5] * np.pi / 180.),
-                                   dtype=tf.float32), \
-                           tf.cast(next_ego_infos[:, 4] + ego_lws * tf.sin(next_ego_infos[:, 5] * np.pi / 180.), dtype=tf.float32)
-        next_ego_rear_points = tf.cast(next_ego_infos[:, 3] - ego_lws * tf.cos(next_ego_infos[:, 5] * np.pi / 180.), dtype=tf.float32), \
-                          tf.cast(next_ego_infos[:, 4] - ego_lws * tf.sin(next_ego_infos[:, 5] * np.pi / 180.), dtype=tf.float32)
-
-        veh2veh4real = tf.zeros_like(veh_infos[:, 0])
-        for veh_index in range(int(tf.shape(veh_infos)[1] / self.per_veh_info_dim)):
-            vehs = veh_infos[:, veh_index * self.per_veh_info_dim:(veh_index + 1) * self.per_veh_info_dim]
-            ego2veh_dist = tf.sqrt(tf.square(ego_infos[:, 3] - vehs[:, 0]) + tf.square(ego_infos[:, 4] - vehs[:, 1]))
-
-            next_vehs = next_veh_infos[:, veh_index * self.per_veh_info_dim:(veh_index + 1) * self.per_veh_info_dim]
-
-            veh_lws = (L - W) / 2.
-            veh_front_points = tf.cast(vehs[:, 0] + veh_lws * tf.cos(vehs[:, 3] * np.pi / 180.), dtype=tf.float32), \
-                               tf.cast(vehs[:, 1] + veh_lws * tf.sin(vehs[:, 3] * np.pi / 180.), dtype=tf.float32)
-            veh_rear_points = tf.cast(vehs[:, 0] - veh_lws * tf.cos(vehs[:, 3] * np.pi / 180.), dtype=tf.float32), \
-                              tf.cast(vehs[:, 1] - veh_lws * tf.sin(vehs[:, 3] * np.pi / 180.), dtype=tf.float32)
-
-            next_veh_front_points = tf.cast(next_vehs[:, 0] + veh_lws * tf.cos(next_vehs[:, 3] * np.pi / 180.), dtype=tf.float32), \
-                               tf.cast(next_vehs[:, 1] + veh_lws * tf.sin(next_vehs[:, 3] * np.pi / 180.), dtype=tf.float32)
-            next_veh_rear_points = tf.cast(next_vehs[:, 0] - veh_lws * tf.cos(next_vehs[:, 3] * np.pi / 180.), dtype=tf.float32), \
-                              tf.cast(next_vehs[:, 1] - veh_lws * tf.sin(next_vehs[:, 3] * np.pi / 180.), dtype=tf.float32)
-
-            for ego_point in [(ego_front_points, next_ego_front_points), (ego_rear_points, next_ego_rear_points)]:
-                for veh_point in [(veh_front_points, next_veh_front_points), (veh_rear_points, next_veh_rear_points)]:
-                    veh2veh_dist = tf.sqrt(
-                        tf.square(ego_point[0][0] - veh_point[0][0]) + tf.square(ego_point[0][1] - veh_point[0][1]))
-                    next_veh2veh_dist = tf.sqrt(
-                        tf.square(ego_point[1][0] - veh_point[1][0]) + tf.square(ego_point[1][1] - veh_point[1][1]))
-                    next_g = next_veh2veh_dist - 2.5
-                    g = veh2veh_dist - 2.5
-                    veh2veh4real += tf.where(logical_and(next_g - (1-lam)*g < 0, ego2veh_dist < 10), tf.square(next_g - (1-lam)*g),
-                                             tf.zeros_like(veh_infos[:, 0]))
-        return veh2veh4real
+        g = self._veh2veh_dists(self._circle_centres(ego_infos[:, 3], ego_infos[:, 4], ego_infos[:, 5]),
+                                self._veh_circle_centres(veh_infos)) - 2.5  # [2, 2, B, N]
+        next_g = self._veh2veh_dists(self._circle_centres(next_ego_infos[:, 3], next_ego_infos[:, 4],
+                                                          next_ego_infos[:, 5]),
+                                     self._veh_circle_centres(next_veh_infos)) - 2.5
+        vehs = tf.reshape(veh_infos, (-1, veh_infos.shape[1] // self.per_veh_info_dim, self.per_veh_info_dim))
+        ego2veh_dists = tf.sqrt(tf.square(ego_infos[:, 3:4] - vehs[:, :, 0]) +
+                                tf.square(ego_infos[:, 4:5] - vehs[:, :, 1]))  # [B, N]
+        barriers = next_g - (1 - lam) * g
+        violations = tf.where(logical_and(barriers < 0, ego2veh_dists < 10), tf.square(barriers),
+                              tf.zeros_like(barriers))
+        veh2veh4real_per_veh = tf.reduce_sum(violations, axis=[0, 1])
+        return tf.reduce_sum(veh2veh4real_per_veh, 1), veh2veh4real_per_veh
+
+    @staticmethod
+    def _circle_centres(xs, ys, phis):
+        """centres of the front and rear circles covering vehicles of size L, W, as xs and ys [2 (front, rear), ...]"""
+        lws = (L - W) / 2.
+        phis_rad = phis * np.pi / 180.
+        signs = tf.reshape(tf.constant([1., -1.]), [2] + [1] * len(phis.shape))
+        return xs + signs * lws * tf.cos(phis_rad), ys + signs * lws * tf.sin(phis_rad)
+
+    def _veh_circle_centres(self, veh_infos):  # [B, N * per_veh_info_dim] -> xs, ys [2, B, N]
+        vehs = tf.reshape(veh_infos, (-1, veh_infos.shape[1] // self.per_veh_info_dim, self.per_veh_info_dim))
+        return self._circle_centres(vehs[:, :, 0], vehs[:, :, 1], vehs[:, :, 3])
+
+    @staticmethod
+    def _veh2veh_dists(ego_points, veh_points):
+        """distances between the circles of the egos (xs, ys [2, B]) and of their vehicles (xs, ys [2, B, N]), as
+        [2 (ego front, rear), 2 (veh front, rear), B, N]. the vehicles are kept on the innermost axis and the egos
+        are spread over them beforehand, so that only whole [B, N] blocks are broadcast, which is much faster than
+        broadcasting over small inner axes"""
+        (ego_xs, ego_ys), (veh_xs, veh_ys) = ego_points, veh_points
+        ego_xs = tf.broadcast_to(ego_xs[:, :, tf.newaxis], tf.shape(veh_xs))
+        ego_ys = tf.broadcast_to(ego_ys[:, :, tf.newaxis], tf.shape(veh_ys))
+        return tf.sqrt(tf.square(ego_xs[:, tf.newaxis] - veh_xs[tf.newaxis]) +
+                       tf.square(ego_ys[:, tf.newaxis] - veh_ys[tf.newaxis]))
 
     def compute_rewards(self, obses, actions):
         # obses = self.convert_vehs_to_abso(obses)
@@ -206,27 +328,13 @@ class EnvironmentModel(object):  # all tensors
             devi_phi = -tf.cast(tf.square(tracking_infos[:, 1] * np.pi / 180.), dtype=tf.float32)
             devi_v = -tf.square(tracking_infos[:, 2])
 
-            # rewards related to veh2veh collision
-            ego_lws = (L - W) / 2.
-            ego_front_points = tf.cast(ego_infos[:, 3] + ego_lws * tf.cos(ego_infos[:, 5] * np.pi / 180.), dtype=tf.float32), \
-                               tf.cast(ego_infos[:, 4] + ego_lws * tf.sin(ego_infos[:, 5] * np.pi / 180.), dtype=tf.float32)
-            ego_rear_points = tf.cast(ego_infos[:, 3] - ego_lws * tf.cos(ego_infos[:, 5] * np.pi / 180.), dtype=tf.float32), \
-                              tf.cast(ego_infos[:, 4] - ego_lws * tf.sin(ego_infos[:, 5] * np.pi / 180.), dtype=tf.float32)
-            veh2veh4real = tf.zeros_like(veh_infos[:, 0])
-            veh2veh4training = tf.zeros_like(veh_infos[:, 0])
-
-            for veh_index in range(int(tf.shape(veh_infos)[1] / self.per_veh_info_dim)):
-                vehs = veh_infos[:, veh_index * self.per_veh_info_dim:(veh_index + 1) * self.per_veh_info_dim]
-                veh_lws = (L - W) / 2.
-                veh_front_points = tf.cast(vehs[:, 0] + veh_lws * tf.cos(vehs[:, 3] * np.pi / 180.), dtype=tf.float32), \
-                                   tf.cast(vehs[:, 1] + veh_lws * tf.sin(vehs[:, 3] * np.pi / 180.), dtype=tf.float32)
-                veh_rear_points = tf.cast(vehs[:, 0] - veh_lws * tf.cos(vehs[:, 3] * np.pi / 180.), dtype=tf.float32), \
-                                  tf.cast(vehs[:, 1] - veh_lws * tf.sin(vehs[:, 3] * np.pi / 180.), dtype=tf.float32)
-                for ego_point in [ego_front_points, ego_rear_points]:
-                    for veh_point in [veh_front_points, veh_rear_points]:
-                        veh2veh_dist = tf.sqrt(tf.square(ego_point[0] - veh_point[0]) + tf.square(ego_point[1] - veh_point[1]))
-                        veh2veh4training += tf.where(veh2veh_dist-3.5 < 0, tf.square(veh2veh_dist-3.5), tf.zeros_like(veh_infos[:, 0]))
-                        veh2veh4real += tf.where(veh2veh_dist-2.5 < 0, tf.square(veh2veh_dist-2.5), tf.zeros_like(veh_infos[:, 0]))
+            # rewards related to veh2veh collision, between the front and rear circles of the ego and of every vehicle
+            ego_points = self._circle_centres(ego_infos[:, 3], ego_infos[:, 4], ego_infos[:, 5])  # xs, ys [2, B]
+            ego_front_points, ego_rear_points = (ego_points[0][0], ego_points[1][0]), \
+                                                (ego_points[0][1], ego_points[1][1])
+            veh2veh_dists = self._veh2veh_dists(ego_points, self._veh_circle_centres(veh_infos))  # [2, 2, B, N]
+            veh2veh4training = tf.reduce_sum(tf.square(tf.minimum(veh2veh_dists - 3.5, 0.)), axis=[0, 1, 3])
+            veh2veh4real = tf.reduce_sum(tf.square(tf.minimum(veh2veh_dists - 2.5, 0.)), axis=[0, 1, 3])
 
             veh2road4real = tf.zeros_like(veh_infos[:, 0])
             veh2road4training = tf.zeros_like(veh_infos[:, 0])
@@ -319,7 +427,93 @@ class EnvironmentModel(object):  # all tensors
 
             return rewards, punish_term_for_training, real_punish_term, veh2veh4real, veh2road4real, reward_dict
 
+    def np_compute_rewards(self, obs, action):  # single sample, obs and action are 1-d arrays, computed in float64
+        tracking_start = self.ego_info_dim
+        veh_start = self.ego_info_dim + self.per_tracking_info_dim * (self.num_future_data + 1)
+        ego_infos, tracking_infos = obs[:tracking_start].astype(np.float64), obs[tracking_start:veh_start].astype(np.float64)
+        veh_infos = obs[veh_start:].astype(np.float64).reshape(-1, self.per_veh_info_dim)
+        steer, a_x = float(action[0]), float(action[1])
+        # rewards related to action
+        punish_steer = -steer ** 2
+        punish_a_x = -a_x ** 2
+
+        # rewards related to ego stability
+        punish_yaw_rate = -ego_infos[2] ** 2
+
+        # rewards related to tracking error
+        devi_y = -tracking_infos[0] ** 2
+        devi_phi = -(tracking_infos[1] * pi / 180.) ** 2
+        devi_v = -tracking_infos[2] ** 2
+
+        # rewards related to veh2veh collision, [2 ego points, veh_num, 2 veh points]
+        ego_lws = (L - W) / 2.
+        ego_x, ego_y, ego_phi_rad = ego_infos[3], ego_infos[4], ego_infos[5] * pi / 180.
+        ego_points = np.array([[ego_x + ego_lws * cos(ego_phi_rad), ego_y + ego_lws * sin(ego_phi_rad)],
+                               [ego_x - ego_lws * cos(ego_phi_rad), ego_y - ego_lws * sin(ego_phi_rad)]])
+        veh_lws = (L - W) / 2.
+        veh_phis_rad = veh_infos[:, 3] * pi / 180.
+        veh_deltas = np.stack([veh_lws * np.cos(veh_phis_rad), veh_lws * np.sin(veh_phis_rad)], 1)
+        veh_points = np.stack([veh_infos[:, :2] + veh_deltas, veh_infos[:, :2] - veh_deltas], 1)
+        veh2veh_dists = np.sqrt(np.sum(np.square(ego_points[:, np.newaxis, np.newaxis, :] -
+                                                 veh_points[np.newaxis, :, :, :]), axis=-1))
+        veh2veh4training = float(np.sum(np.square(np.minimum(veh2veh_dists - 3.5, 0.))))
+        veh2veh4real = float(np.sum(np.square(np.minimum(veh2veh_dists - 2.5, 0.))))
+
+        veh2road4training, veh2road4real = 0., 0.
+        for ego_point in ego_points:
+            veh2road4training += self._np_veh2road(ego_point[0], ego_point[1], for_training=True)
+            veh2road4real += self._np_veh2road(ego_point[0], ego_point[1], for_training=False)
+
+        rewards = 0.05 * devi_v + 0.8 * devi_y + 30 * devi_phi + 0.02 * punish_yaw_rate + \
+                  5 * punish_steer + 0.05 * punish_a_x
+        punish_term_for_training = veh2veh4training + veh2road4training
+        real_punish_term = veh2veh4real + veh2road4real
+
+        reward_dict = dict(punish_steer=punish_steer,
+                           punish_a_x=punish_a_x,
+                           punish_yaw_rate=punish_yaw_rate,
+                           devi_v=devi_v,
+                           devi_y=devi_y,
+                           devi_phi=devi_phi,
+                           scaled_punish_steer=5 * punish_steer,
+                           scaled_punish_a_x=0.05 * punish_a_x,
+                           scaled_punish_yaw_rate=0.02 * punish_yaw_rate,
+                           scaled_devi_v=0.05 * devi_v,
+                           scaled_devi_y=0.8 * devi_y,
+                           scaled_devi_phi=30 * devi_phi,
+                           veh2veh4training=veh2veh4training,
+                           veh2road4training=veh2road4training,
+                           veh2veh4real=veh2veh4real,
+                           veh2road4real=veh2road4real,
+                           )
+
+        return rewards, punish_term_for_training, real_punish_term, veh2veh4real, veh2road4real, reward_dict
+
+    def _np_veh2road(self, x, y, for_training):
+        # (condition, margin) pairs, the penalty is margin**2 when the condition holds and margin < 0
+        if self.task == 'left':
+            terms = [(y < -CROSSROAD_SIZE/2, x - 1),
+                     (y < -CROSSROAD_SIZE/2, LANE_WIDTH - x - 1),
+                     (x < 0 if for_training else x < -CROSSROAD_SIZE/2, LANE_WIDTH*LANE_NUMBER - y - 1),
+                     (x < -CROSSROAD_SIZE/2, y - 0 - 1)]
+        elif self.task == 'straight':
+            terms = [(y < -CROSSROAD_SIZE/2, x - LANE_WIDTH - 1),
+                     (y < -CROSSROAD_SIZE/2, 2*LANE_WIDTH - x - 1),
+                     (y > CROSSROAD_SIZE/2, LANE_WIDTH*LANE_NUMBER - x - 1),
+                     (y > CROSSROAD_SIZE/2, x - 0 - 1)]
+        else:
+            assert self.task == 'right'
+            terms = [(y < -CROSSROAD_SIZE/2, x - 2*LANE_WIDTH - 1),
+                     (y < -CROSSROAD_SIZE/2, LANE_NUMBER*LANE_WIDTH - x - 1),
+                     (x > CROSSROAD_SIZE/2, 0 - y - 1),
+                     (x > CROSSROAD_SIZE/2, y - (-LANE_WIDTH*LANE_NUMBER) - 1)]
+        return sum(margin ** 2 for cond, margin in terms if cond and margin < 0)
+
     def compute_next_obses(self, obses, actions):
+        next_obses, _ = self._compute_next_obses(obses, actions)
+        return next_obses
+
+    def _compute_next_obses(self, obses, actions, hint_indexs=None, ref_indexes=None):
         # obses = self.convert_vehs_to_abso(obses)
         ego_infos, tracking_infos, veh_infos = obses[:, :self.ego_info_dim],\
                                                obses[:, self.ego_info_dim:
@@ -330,32 +524,24 @@ class EnvironmentModel(object):  # all tensors
 
         veh_infos = tf.stop_gradient(veh_infos)
         next_ego_infos = self.ego_predict(ego_infos, actions)
-        # different for training and selecting
-        if self.mode != 'training':
-            next_tracking_infos = self.ref_path.tracking_error_vector(next_ego_infos[:, 3],
-                                                                      next_ego_infos[:, 4],
-                                                                      next_ego_infos[:, 5],
-                                                                      next_ego_infos[:, 0],
-                                                                      self.num_future_data)
+        # different for training and selecting: every sample follows its own path of ref_indexes when training
+        if self.mode == 'training':
+            ref_indexes = self.ref_indexes if ref_indexes is None else ref_indexes
         else:
-            # next_tracking_infos = self.tracking_error_predict(ego_infos, tracking_infos, actions)
-            next_tracking_infos = tf.zeros(shape=(len(next_ego_infos),
-                                                  (self.num_future_data+1)*self.per_tracking_info_dim))
-            ref_indexes = tf.expand_dims(self.ref_indexes, axis=1)
-            for ref_idx, path in enumerate(self.ref_path.path_list):
-                self.ref_path.path = path
-                tracking_info_4_this_ref_idx = self.ref_path.tracking_error_vector(next_ego_infos[:, 3],
-                                                                                   next_ego_infos[:, 4],
-                                                                                   next_ego_infos[:, 5],
-                                                                                   next_ego_infos[:, 0],
-                                                                                   self.num_future_data)
-                next_tracking_infos = tf.where(ref_indexes == ref_idx, tracking_info_4_this_ref_idx,
-                                               next_tracking_infos)
+            ref_indexes = None
+        next_tracking_infos, closest_indexs = self.ref_path.tracking_error_vector(next_ego_infos[:, 3],
+                                                                                  next_ego_infos[:, 4],
+                                                                                  next_ego_infos[:, 5],
+                                                                                  next_ego_infos[:, 0],
+                                                                                  self.num_future_data,
+                                                                                  hint_indexs=hint_indexs,
+                                                                                  return_indexs=True,
+                                                                                  ref_indexes=ref_indexes)
 
         next_veh_infos = self.veh_predict(veh_infos)
         next_obses = tf.concat([next_ego_infos, next_tracking_infos, next_veh_infos], 1)
         # next_obses = self.convert_vehs_to_rela(next_obses)
-        return next_obses
+        return next_obses, closest_indexs
 
     # def convert_vehs_to_rela(self, obs_abso):
     #     ego_infos, tracking_infos, veh_infos = obs_abso[:, :self.ego_info_dim], \
@@ -392,39 +578,9 @@ class EnvironmentModel(object):  # all tensors
         return ego_next_infos
 
     def veh_predict(self, veh_infos):
-        veh_mode_list = VEHICLE_MODE_LIST[self.task]
-        predictions_to_be_concat = []
-
-        for vehs_index in range(len(veh_mode_list)):
-            predictions_to_be_concat.append(self.predict_for_a_mode(
-                veh_infos[:, vehs_index * self.per_veh_info_dim:(vehs_index + 1) * self.per_veh_info_dim],
-                veh_mode_list[vehs_index]))
-        pred = tf.stop_gradient(tf.concat(predictions_to_be_concat, 1))
-        return pred
-
-    def predict_for_a_mode(self, vehs, mode):
-        veh_xs, veh_ys, veh_vs, veh_phis = vehs[:, 0], vehs[:, 1], vehs[:, 2], vehs[:, 3]
-        veh_phis_rad = veh_phis * np.pi / 180.
-
-        middle_cond = logical_and(logical_and(veh_xs > -CROSSROAD_SIZE/2, veh_xs < CROSSROAD_SIZE/2),
-                                  logical_and(veh_ys > -CROSSROAD_SIZE/2, veh_ys < CROSSROAD_SIZE/2))
-        zeros = tf.zeros_like(veh_xs)
-
-        veh_xs_delta = veh_vs / self.base_frequency * tf.cos(veh_phis_rad)
-        veh_ys_delta = veh_vs / self.base_frequency * tf.sin(veh_phis_rad)
-
-        if mode in ['dl', 'rd', 'ur', 'lu']:
-            veh_phis_rad_delta = tf.where(middle_cond, (veh_vs / (CROSSROAD_SIZE/2+0.5*LANE_WIDTH)) / self.base_frequency, zeros)
-        elif mode in ['dr', 'ru', 'ul', 'ld']:
-            veh_phis_rad_delta = tf.where(middle_cond, -(veh_vs / (CROSSROAD_SIZE/2-2.5*LANE_WIDTH)) / self.base_frequency, zeros)  # TODO：ONLY FOR 3LANE
-        else:
-            veh_phis_rad_delta = zeros
-        next_veh_xs, next_veh_ys, next_veh_vs, next_veh_phis_rad = \
-            veh_xs + veh_xs_delta, veh_ys + veh_ys_delta, veh_vs, veh_phis_rad + veh_phis_rad_delta
-        next_veh_phis_rad = tf.where(next_veh_phis_rad > np.pi, next_veh_phis_rad - 2 * np.pi, next_veh_phis_rad)
-        next_veh_phis_rad = tf.where(next_veh_phis_rad <= -np.pi, next_veh_phis_rad + 2 * np.pi, next_veh_phis_rad)
-        next_veh_phis = next_veh_phis_rad * 180 / np.pi
-        return tf.stack([next_veh_xs, next_veh_ys, next_veh_vs, next_veh_phis], 1)
+        vehs = tf.reshape(veh_infos, (-1, veh_infos.shape[1] // self.per_veh_info_dim, self.per_veh_info_dim))
+        next_vehs = predict_vehs(vehs, self.veh_turn_radii, self.base_frequency, tf)
+        return tf.stop_gradient(tf.reshape(next_vehs, (-1, veh_infos.shape[1])))
 
     def render(self, mode='human'):
         if mode == 'human':
@@ -580,159 +736,280 @@ def deal_with_phi_diff(phi_diff):
     return phi_diff
 
 
+def np_deal_with_phi_diff(phi_diff):
+    phi_diff = phi_diff - 360. if phi_diff > 180. else phi_diff
+    phi_diff = phi_diff + 360. if phi_diff < -180. else phi_diff
+    return phi_diff
+
+
+def _construct_ref_paths(task):
+    path_list, path_len_list, control_points = [], [], []
+    sl = 40  # straight length
+    meter_pointnum_ratio = 30
+    control_ext = CROSSROAD_SIZE/3.
+    if task == 'left':
+        end_offsets = [LANE_WIDTH*(i+0.5) for i in range(LANE_NUMBER)]
+        start_offsets = [LANE_WIDTH*0.5]
+        for start_offset in start_offsets:
+            for end_offset in end_offsets:
+                control_point1 = start_offset, -CROSSROAD_SIZE/2
+                control_point2 = start_offset, -CROSSROAD_SIZE/2 + control_ext
+                control_point3 = -CROSSROAD_SIZE/2 + control_ext, end_offset
+                control_point4 = -CROSSROAD_SIZE/2, end_offset
+                control_points.append([control_point1,control_point2,control_point3,control_point4])
+
+                node = np.asfortranarray([[control_point1[0], control_point2[0], control_point3[0], control_point4[0]],
+                                          [control_point1[1], control_point2[1], control_point3[1], control_point4[1]]],
+                                         dtype=np.float32)
+                curve = bezier.Curve(node, degree=3)
+                s_vals = np.linspace(0, 1.0, int(pi/2*(CROSSROAD_SIZE/2+LANE_WIDTH/2)) * meter_pointnum_ratio)
+                trj_data = curve.evaluate_multi(s_vals)
+                trj_data = trj_data.astype(np.float32)
+                start_straight_line_x = LANE_WIDTH/2 * np.ones(shape=(sl * meter_pointnum_ratio,), dtype=np.float32)[:-1]
+                start_straight_line_y = np.linspace(-CROSSROAD_SIZE/2 - sl, -CROSSROAD_SIZE/2, sl * meter_pointnum_ratio, dtype=np.float32)[:-1]
+                end_straight_line_x = np.linspace(-CROSSROAD_SIZE/2, -CROSSROAD_SIZE/2 - sl, sl * meter_pointnum_ratio, dtype=np.float32)[1:]
+                end_straight_line_y = end_offset * np.ones(shape=(sl * meter_pointnum_ratio,), dtype=np.float32)[1:]
+                planed_trj = np.append(np.append(start_straight_line_x, trj_data[0]), end_straight_line_x), \
+                             np.append(np.append(start_straight_line_y, trj_data[1]), end_straight_line_y)
+
+                xs_1, ys_1 = planed_trj[0][:-1], planed_trj[1][:-1]
+                xs_2, ys_2 = planed_trj[0][1:], planed_trj[1][1:]
+                phis_1 = np.arctan2(ys_2 - ys_1,
+                                    xs_2 - xs_1) * 180 / pi
+                planed_trj = xs_1, ys_1, phis_1
+                path_list.append(planed_trj)
+                path_len_list.append((sl * meter_pointnum_ratio, len(trj_data[0]), len(xs_1)))
+
+    elif task == 'straight':
+        end_offsets = [LANE_WIDTH*(i+0.5) for i in range(LANE_NUMBER)]
+        start_offsets = [LANE_WIDTH*1.5]
+        for start_offset in start_offsets:
+            for end_offset in end_offsets:
+                control_point1 = start_offset, -CROSSROAD_SIZE/2
+                control_point2 = start_offset, -CROSSROAD_SIZE/2 + control_ext
+                control_point3 = end_offset, CROSSROAD_SIZE/2 - control_ext
+                control_point4 = end_offset, CROSSROAD_SIZE/2
+                control_points.append([control_point1,control_point2,control_point3,control_point4])
+
+                node = np.asfortranarray([[control_point1[0], control_point2[0], control_point3[0], control_point4[0]],
+                                          [control_point1[1], control_point2[1], control_point3[1], control_point4[1]]]
+                                         , dtype=np.float32)
+                curve = bezier.Curve(node, degree=3)
+                s_vals = np.linspace(0, 1.0, CROSSROAD_SIZE * meter_pointnum_ratio)
+                trj_data = curve.evaluate_multi(s_vals)
+                trj_data = trj_data.astype(np.float32)
+                start_straight_line_x = start_offset * np.ones(shape=(sl * meter_pointnum_ratio,), dtype=np.float32)[:-1]
+                start_straight_line_y = np.linspace(-CROSSROAD_SIZE/2 - sl, -CROSSROAD_SIZE/2, sl * meter_pointnum_ratio, dtype=np.float32)[:-1]
+                end_straight_line_x = end_offset * np.ones(shape=(sl * meter_pointnum_ratio,), dtype=np.float32)[1:]
+                end_straight_line_y = np.linspace(CROSSROAD_SIZE/2, CROSSROAD_SIZE/2 + sl, sl * meter_pointnum_ratio, dtype=np.float32)[1:]
+                planed_trj = np.append(np.append(start_straight_line_x, trj_data[0]), end_straight_line_x), \
+                             np.append(np.append(start_straight_line_y, trj_data[1]), end_straight_line_y)
+                xs_1, ys_1 = planed_trj[0][:-1], planed_trj[1][:-1]
+                xs_2, ys_2 = planed_trj[0][1:], planed_trj[1][1:]
+                phis_1 = np.arctan2(ys_2 - ys_1,
+                                    xs_2 - xs_1) * 180 / pi
+                planed_trj = xs_1, ys_1, phis_1
+                path_list.append(planed_trj)
+                path_len_list.append((sl * meter_pointnum_ratio, len(trj_data[0]), len(xs_1)))
+
+    else:
+        assert task == 'right'
+        control_ext = CROSSROAD_SIZE/5.
+        end_offsets = [-LANE_WIDTH * 2.5, -LANE_WIDTH * 1.5, -LANE_WIDTH * 0.5]
+        start_offsets = [LANE_WIDTH*(LANE_NUMBER-0.5)]
+
+        for start_offset in start_offsets:
+            for end_offset in end_offsets:
+                control_point1 = start_offset, -CROSSROAD_SIZE/2
+                control_point2 = start_offset, -CROSSROAD_SIZE/2 + control_ext
+                control_point3 = CROSSROAD_SIZE/2 - control_ext, end_offset
+                control_point4 = CROSSROAD_SIZE/2, end_offset
+                control_points.append([control_point1,control_point2,control_point3,control_point4])
+
+                node = np.asfortranarray([[control_point1[0], control_point2[0], control_point3[0], control_point4[0]],
+                                          [control_point1[1], control_point2[1], control_point3[1], control_point4[1]]],
+                                         dtype=np.float32)
+                curve = bezier.Curve(node, degree=3)
+                s_vals = np.linspace(0, 1.0, int(pi/2*(CROSSROAD_SIZE/2-LANE_WIDTH*(LANE_NUMBER-0.5))) * meter_pointnum_ratio)
+                trj_data = curve.evaluate_multi(s_vals)
+                trj_data = trj_data.astype(np.float32)
+                start_straight_line_x = start_offset * np.ones(shape=(sl * meter_pointnum_ratio,), dtype=np.float32)[:-1]
+                start_straight_line_y = np.linspace(-CROSSROAD_SIZE/2 - sl, -CROSSROAD_SIZE/2, sl * meter_pointnum_ratio, dtype=np.float32)[:-1]
+                end_straight_line_x = np.linspace(CROSSROAD_SIZE/2, CROSSROAD_SIZE/2 + sl, sl * meter_pointnum_ratio, dtype=np.float32)[1:]
+                end_straight_line_y = end_offset * np.ones(shape=(sl * meter_pointnum_ratio,), dtype=np.float32)[1:]
+                planed_trj = np.append(np.append(start_straight_line_x, trj_data[0]), end_straight_line_x), \
+                             np.append(np.append(start_straight_line_y, trj_data[1]), end_straight_line_y)
+                xs_1, ys_1 = planed_trj[0][:-1], planed_trj[1][:-1]
+                xs_2, ys_2 = planed_trj[0][1:], planed_trj[1][1:]
+                phis_1 = np.arctan2(ys_2 - ys_1,
+                                    xs_2 - xs_1) * 180 / pi
+                planed_trj = xs_1, ys_1, phis_1
+                path_list.append(planed_trj)
+                path_len_list.append((sl * meter_pointnum_ratio, len(trj_data[0]), len(xs_1)))
+    return path_list, path_len_list, control_points
+
+
+_PATH_LIBRARY = {}
+_WINDOW_FRAMES = {}
+_PADDED_PATHS = {}
+
+
+def load_path_library(task):
+    """paths of a task, built once and cached in PATH_CACHE_DIR as a [path_num, 3, path_len] float32 .npy,
+    which is memory-mapped read-only so that all the processes share the same pages"""
+    if task not in _PATH_LIBRARY:
+        file_prefix = os.path.join(PATH_CACHE_DIR, '{}_{}_{}_{}'.format(task, CROSSROAD_SIZE, LANE_WIDTH, LANE_NUMBER))
+        if not os.path.exists(file_prefix + '.npy'):
+            path_list, path_len_list, control_points = _construct_ref_paths(task)
+            try:
+                os.makedirs(PATH_CACHE_DIR, exist_ok=True)
+                tmp_suffix = '.{}.tmp'.format(os.getpid())
+                with open(file_prefix + '_meta.npz' + tmp_suffix, 'wb') as f:
+                    np.savez(f, path_len_list=np.array(path_len_list), control_points=np.array(control_points))
+                with open(file_prefix + '.npy' + tmp_suffix, 'wb') as f:
+                    np.save(f, np.array(path_list, dtype=np.float32))
+                os.replace(file_prefix + '_meta.npz' + tmp_suffix, file_prefix + '_meta.npz')
+                os.replace(file_prefix + '.npy' + tmp_suffix, file_prefix + '.npy')
+            except OSError:  # e.g. a read-only install, the paths are then kept in this process only
+                _PATH_LIBRARY[task] = dict(path_list=path_list, path_len_list=path_len_list,
+                                           control_points=control_points)
+                return _PATH_LIBRARY[task]
+        paths = np.load(file_prefix + '.npy', mmap_mode='r').view(np.ndarray)
+        meta = np.load(file_prefix + '_meta.npz')
+        _PATH_LIBRARY[task] = dict(path_list=[tuple(path) for path in paths],
+                                   path_len_list=[tuple(int(l) for l in path_len) for path_len in meta['path_len_list']],
+                                   control_points=[[tuple(point) for point in points]
+                                                   for points in meta['control_points'].tolist()])
+    return _PATH_LIBRARY[task]
+
+
 class ReferencePath(object):
     def __init__(self, task, ref_index=None):
         self.exp_v = EXPECTED_V
         self.task = task
-        self.path_list = []
-        self.path_len_list = []
-        self.control_points = []
-        self._construct_ref_path(self.task)
+        path_library = load_path_library(self.task)  # shared by all the instances, do not modify in place
+        self.path_list = path_library['path_list']
+        self.path_len_list = path_library['path_len_list']
+        self.control_points = path_library['control_points']
         self.ref_index = np.random.choice(len(self.path_list)) if ref_index is None else ref_index
         self.path = self.path_list[self.ref_index]
+        self.search_window = (-20, 70)  # in path points (30 per meter) around the hint, for warm-started search
+        self.max_search_residual = 5.
 
     def set_path(self, path_index=None):
         self.ref_index = path_index
         self.path = self.path_list[self.ref_index]
 
-    def _construct_ref_path(self, task):
-        sl = 40  # straight length
-        meter_pointnum_ratio = 30
-        control_ext = CROSSROAD_SIZE/3.
-        if task == 'left':
-            end_offsets = [LANE_WIDTH*(i+0.5) for i in range(LANE_NUMBER)]
-            start_offsets = [LANE_WIDTH*0.5]
-            for start_offset in start_offsets:
-                for end_offset in end_offsets:
-                    control_point1 = start_offset, -CROSSROAD_SIZE/2
-                    control_point2 = start_offset, -CROSSROAD_SIZE/2 + control_ext
-                    control_point3 = -CROSSROAD_SIZE/2 + control_ext, end_offset
-                    control_point4 = -CROSSROAD_SIZE/2, end_offset
-                    self.control_points.append([control_point1,control_point2,control_point3,control_point4])
-
-                    node = np.asfortranarray([[control_point1[0], control_point2[0], control_point3[0], control_point4[0]],
-                                              [control_point1[1], control_point2[1], control_point3[1], control_point4[1]]],
-                                             dtype=np.float32)
-                    curve = bezier.Curve(node, degree=3)
-                    s_vals = np.linspace(0, 1.0, int(pi/2*(CROSSROAD_SIZE/2+LANE_WIDTH/2)) * meter_pointnum_ratio)
-                    trj_data = curve.evaluate_multi(s_vals)
-                    trj_data = trj_data.astype(np.float32)
-                    start_straight_line_x = LANE_WIDTH/2 * np.ones(shape=(sl * meter_pointnum_ratio,), dtype=np.float32)[:-1]
-                    start_straight_line_y = np.linspace(-CROSSROAD_SIZE/2 - sl, -CROSSROAD_SIZE/2, sl * meter_pointnum_ratio, dtype=np.float32)[:-1]
-                    end_straight_line_x = np.linspace(-CROSSROAD_SIZE/2, -CROSSROAD_SIZE/2 - sl, sl * meter_pointnum_ratio, dtype=np.float32)[1:]
-                    end_straight_line_y = end_offset * np.ones(shape=(sl * meter_pointnum_ratio,), dtype=np.float32)[1:]
-                    planed_trj = np.append(np.append(start_straight_line_x, trj_data[0]), end_straight_line_x), \
-                                 np.append(np.append(start_straight_line_y, trj_data[1]), end_straight_line_y)
-
-                    xs_1, ys_1 = planed_trj[0][:-1], planed_trj[1][:-1]
-                    xs_2, ys_2 = planed_trj[0][1:], planed_trj[1][1:]
-                    phis_1 = np.arctan2(ys_2 - ys_1,
-                                        xs_2 - xs_1) * 180 / pi
-                    planed_trj = xs_1, ys_1, phis_1
-                    self.path_list.append(planed_trj)
-                    self.path_len_list.append((sl * meter_pointnum_ratio, len(trj_data[0]), len(xs_1)))
-
-        elif task == 'straight':
-            end_offsets = [LANE_WIDTH*(i+0.5) for i in range(LANE_NUMBER)]
-            start_offsets = [LANE_WIDTH*1.5]
-            for start_offset in start_offsets:
-                for end_offset in end_offsets:
-                    control_point1 = start_offset, -CROSSROAD_SIZE/2
-                    control_point2 = start_offset, -CROSSROAD_SIZE/2 + control_ext
-                    control_point3 = end_offset, CROSSROAD_SIZE/2 - control_ext
-                    control_point4 = end_offset, CROSSROAD_SIZE/2
-                    self.control_points.append([control_point1,control_point2,control_point3,control_point4])
-
-                    node = np.asfortranarray([[control_point1[0], control_point2[0], control_point3[0], control_point4[0]],
-                                              [control_point1[1], control_point2[1], control_point3[1], control_point4[1]]]
-                                             , dtype=np.float32)
-                    curve = bezier.Curve(node, degree=3)
-                    s_vals = np.linspace(0, 1.0, CROSSROAD_SIZE * meter_pointnum_ratio)
-                    trj_data = curve.evaluate_multi(s_vals)
-                    trj_data = trj_data.astype(np.float32)
-                    start_straight_line_x = start_offset * np.ones(shape=(sl * meter_pointnum_ratio,), dtype=np.float32)[:-1]
-                    start_straight_line_y = np.linspace(-CROSSROAD_SIZE/2 - sl, -CROSSROAD_SIZE/2, sl * meter_pointnum_ratio, dtype=np.float32)[:-1]
-                    end_straight_line_x = end_offset * np.ones(shape=(sl * meter_pointnum_ratio,), dtype=np.float32)[1:]
-                    end_straight_line_y = np.linspace(CROSSROAD_SIZE/2, CROSSROAD_SIZE/2 + sl, sl * meter_pointnum_ratio, dtype=np.float32)[1:]
-                    planed_trj = np.append(np.append(start_straight_line_x, trj_data[0]), end_straight_line_x), \
-                                 np.append(np.append(start_straight_line_y, trj_data[1]), end_straight_line_y)
-                    xs_1, ys_1 = planed_trj[0][:-1], planed_trj[1][:-1]
-                    xs_2, ys_2 = planed_trj[0][1:], planed_trj[1][1:]
-                    phis_1 = np.arctan2(ys_2 - ys_1,
-                                        xs_2 - xs_1) * 180 / pi
-                    planed_trj = xs_1, ys_1, phis_1
-                    self.path_list.append(planed_trj)
-                    self.path_len_list.append((sl * meter_pointnum_ratio, len(trj_data[0]), len(xs_1)))
-
+    def find_closest_point(self, xs, ys, ratio=10, hint_indexs=None, ref_indexes=None):
+        # with hint_indexs (e.g. the matches of the last step), only a window of the full-resolution path
+        # around the hints is searched, samples whose window misses the match fall back to the global search.
+        # with ref_indexes [B], every sample is matched on its own path of path_list instead of self.path
+        if hint_indexs is None:
+            indexs = self._global_closest_indexs(xs, ys, ratio, ref_indexes)
         else:
-            assert task == 'right'
-            control_ext = CROSSROAD_SIZE/5.
-            end_offsets = [-LANE_WIDTH * 2.5, -LANE_WIDTH * 1.5, -LANE_WIDTH * 0.5]
-            start_offsets = [LANE_WIDTH*(LANE_NUMBER-0.5)]
-
-            for start_offset in start_offsets:
-                for end_offset in end_offsets:
-                    control_point1 = start_offset, -CROSSROAD_SIZE/2
-                    control_point2 = start_offset, -CROSSROAD_SIZE/2 + control_ext
-                    control_point3 = CROSSROAD_SIZE/2 - control_ext, end_offset
-                    control_point4 = CROSSROAD_SIZE/2, end_offset
-                    self.control_points.append([control_point1,control_point2,control_point3,control_point4])
-
-                    node = np.asfortranarray([[control_point1[0], control_point2[0], control_point3[0], control_point4[0]],
-                                              [control_point1[1], control_point2[1], control_point3[1], control_point4[1]]],
-                                             dtype=np.float32)
-                    curve = bezier.Curve(node, degree=3)
-                    s_vals = np.linspace(0, 1.0, int(pi/2*(CROSSROAD_SIZE/2-LANE_WIDTH*(LANE_NUMBER-0.5))) * meter_pointnum_ratio)
-                    trj_data = curve.evaluate_multi(s_vals)
-                    trj_data = trj_data.astype(np.float32)
-                    start_straight_line_x = start_offset * np.ones(shape=(sl * meter_pointnum_ratio,), dtype=np.float32)[:-1]
-                    start_straight_line_y = np.linspace(-CROSSROAD_SIZE/2 - sl, -CROSSROAD_SIZE/2, sl * meter_pointnum_ratio, dtype=np.float32)[:-1]
-                    end_straight_line_x = np.linspace(CROSSROAD_SIZE/2, CROSSROAD_SIZE/2 + sl, sl * meter_pointnum_ratio, dtype=np.float32)[1:]
-                    end_straight_line_y = end_offset * np.ones(shape=(sl * meter_pointnum_ratio,), dtype=np.float32)[1:]
-                    planed_trj = np.append(np.append(start_straight_line_x, trj_data[0]), end_straight_line_x), \
-                                 np.append(np.append(start_straight_line_y, trj_data[1]), end_straight_line_y)
-                    xs_1, ys_1 = planed_trj[0][:-1], planed_trj[1][:-1]
-                    xs_2, ys_2 = planed_trj[0][1:], planed_trj[1][1:]
-                    phis_1 = np.arctan2(ys_2 - ys_1,
-                                        xs_2 - xs_1) * 180 / pi
-                    planed_trj = xs_1, ys_1, phis_1
-                    self.path_list.append(planed_trj)
-                    self.path_len_list.append((sl * meter_pointnum_ratio, len(trj_data[0]), len(xs_1)))
-
-    def find_closest_point(self, xs, ys, ratio=10):
+            indexs = self._local_closest_indexs(xs, ys, hint_indexs, ratio, ref_indexes)
+        return indexs, self.indexs2points(indexs, ref_indexes)
+
+    def _path_lens(self, ref_indexes=None, dtype=tf.int64):
+        if ref_indexes is None:
+            return len(self.path[0])
+        return tf.gather(tf.cast(self._padded_paths()[1], dtype), ref_indexes)
+
+    def _global_closest_indexs(self, xs, ys, ratio, ref_indexes=None):
+        if ref_indexes is not None:
+            reduced_paths = tf.gather(self._padded_paths()[0][:, ::ratio, :2], ref_indexes)  # [B, reduced_len, 2]
+            dist_array = tf.square(tf.reshape(xs, (-1, 1)) - reduced_paths[:, :, 0]) + \
+                         tf.square(tf.reshape(ys, (-1, 1)) - reduced_paths[:, :, 1])
+            return tf.argmin(dist_array, 1) * ratio
         path_len = len(self.path[0])
         reduced_idx = np.arange(0, path_len, ratio)
         reduced_len = len(reduced_idx)
         reduced_path_x, reduced_path_y = self.path[0][reduced_idx], self.path[1][reduced_idx]
         xs_tile = tf.tile(tf.reshape(xs, (-1, 1)), tf.constant([1, reduced_len]))
         ys_tile = tf.tile(tf.reshape(ys, (-1, 1)), tf.constant([1, reduced_len]))
-        pathx_tile = tf.tile(tf.reshape(reduced_path_x, (1, -1)), tf.constant([len(xs), 1]))
-        pathy_tile = tf.tile(tf.reshape(reduced_path_y, (1, -1)), tf.constant([len(xs), 1]))
+        pathx_tile = tf.tile(tf.reshape(reduced_path_x, (1, -1)), tf.stack([tf.shape(xs)[0], 1]))
+        pathy_tile = tf.tile(tf.reshape(reduced_path_y, (1, -1)), tf.stack([tf.shape(xs)[0], 1]))
 
         dist_array = tf.square(xs_tile - pathx_tile) + tf.square(ys_tile - pathy_tile)
 
         indexs = tf.argmin(dist_array, 1) * ratio
-        return indexs, self.indexs2points(indexs)
-
-    def future_n_data(self, current_indexs, n):
+        return indexs
+
+    def _local_closest_indexs(self, xs, ys, hint_indexs, ratio, ref_indexes=None):
+        path_lens = self._path_lens(ref_indexes)
+        window_len = self.search_window[1] - self.search_window[0]
+        starts = tf.clip_by_value(tf.cast(hint_indexs, tf.int64) + self.search_window[0], 0, path_lens - window_len)
+        if ref_indexes is None:
+            windows = tf.gather(self._window_frames(), starts)  # [B, 2, window_len]
+        else:
+            windows = tf.gather_nd(self._window_frames(all_paths=True),
+                                   tf.stack([tf.cast(ref_indexes, tf.int64), starts], 1))
+        dist_array = tf.square(tf.reshape(xs, (-1, 1)) - windows[:, 0]) + \
+                     tf.square(tf.reshape(ys, (-1, 1)) - windows[:, 1])
+        argmins = tf.argmin(dist_array, 1)
+        indexs = starts + argmins
+        # a match on the window border is probably not the closest point, unless it is the path end
+        on_border = tf.logical_or(tf.logical_and(argmins == 0, indexs > 0),
+                                  tf.logical_and(argmins == window_len - 1, indexs < path_lens - 1))
+        is_lost = tf.logical_or(on_border, tf.reduce_min(dist_array, 1) > self.max_search_residual ** 2)
+        return tf.cond(tf.reduce_any(is_lost),
+                       lambda: tf.where(is_lost, self._global_closest_indexs(xs, ys, ratio, ref_indexes), indexs),
+                       lambda: indexs)
+
+    def _window_frames(self, all_paths=False):
+        # xy of all the windows of the path as a [path_len-window_len+1, 2, window_len] tensor, so that a window
+        # is gathered as one row instead of point by point. with all_paths, those of the padded paths of the
+        # task stacked as [path_num, ...]
+        window_len = self.search_window[1] - self.search_window[0]
+        key = (self.task, 'all' if all_paths else self.ref_index, window_len)
+        if key not in _WINDOW_FRAMES:
+            if all_paths:
+                xys = np.transpose(self._padded_paths(as_numpy=True)[0][:, :, :2], (0, 2, 1))  # [path_num, 2, L]
+            else:
+                xys = np.stack([self.path[0], self.path[1]], axis=0)
+            frames = np.lib.stride_tricks.sliding_window_view(xys, window_len, axis=-1)
+            frames = np.moveaxis(frames, -3, -2)
+            with tf.init_scope():  # an eager constant, captured rather than re-embedded by tf.functions
+                _WINDOW_FRAMES[key] = tf.constant(frames)
+        return _WINDOW_FRAMES[key]
+
+    def _padded_paths(self, as_numpy=False):
+        """all the paths of the task as one [path_num, max_path_len, 3] tensor, padded with far away points that
+        no search matches, and their lengths [path_num]"""
+        if self.task not in _PADDED_PATHS:
+            path_lens = np.array([len(path[0]) for path in self.path_list], dtype=np.int64)
+            paths = np.full((len(self.path_list), path_lens.max(), 3), 1e6, dtype=np.float32)
+            for path, padded_path, path_len in zip(self.path_list, paths, path_lens):
+                padded_path[:path_len] = np.stack(path, axis=1)
+            with tf.init_scope():
+                _PADDED_PATHS[self.task] = (paths, path_lens), (tf.constant(paths), tf.constant(path_lens))
+        return _PADDED_PATHS[self.task][0 if as_numpy else 1]
+
+    def future_n_data(self, current_indexs, n, ref_indexes=None):
         future_data_list = []
         current_indexs = tf.cast(current_indexs, tf.int32)
+        last_indexs = self._path_lens(ref_indexes, tf.int32) - 2
         for _ in range(n):
             current_indexs += 80
-            current_indexs = tf.where(current_indexs >= len(self.path[0]) - 2, len(self.path[0]) - 2, current_indexs)
-            future_data_list.append(self.indexs2points(current_indexs))
+            current_indexs = tf.where(current_indexs >= last_indexs, last_indexs, current_indexs)
+            future_data_list.append(self.indexs2points(current_indexs, ref_indexes))
         return future_data_list
 
-    def indexs2points(self, indexs):
+    def indexs2points(self, indexs, ref_indexes=None):
+        path_lens = self._path_lens(ref_indexes, indexs.dtype) if ref_indexes is not None else len(self.path[0])
         indexs = tf.where(indexs >= 0, indexs, 0)
-        indexs = tf.where(indexs < len(self.path[0]), indexs, len(self.path[0])-1)
+        indexs = tf.where(indexs < path_lens, indexs, path_lens-1)
+        if ref_indexes is not None:
+            points = tf.gather_nd(self._padded_paths()[0], tf.stack([tf.cast(ref_indexes, indexs.dtype), indexs], 1))
+            return points[:, 0], points[:, 1], points[:, 2]
         points = tf.gather(self.path[0], indexs), \
                  tf.gather(self.path[1], indexs), \
                  tf.gather(self.path[2], indexs)
 
         return points[0], points[1], points[2]
 
-    def tracking_error_vector(self, ego_xs, ego_ys, ego_phis, ego_vs, n):
+    def tracking_error_vector(self, ego_xs, ego_ys, ego_phis, ego_vs, n, hint_indexs=None, return_indexs=False,
+                              ref_indexes=None):
         def two2one(ref_xs, ref_ys):
             if self.task == 'left':
                 delta_ = tf.sqrt(tf.square(ego_xs - (-CROSSROAD_SIZE/2)) + tf.square(ego_ys - (-CROSSROAD_SIZE/2))) - \
@@ -751,9 +1028,10 @@ class ReferencePath(object):
                 delta_ = tf.where(ego_xs > CROSSROAD_SIZE/2, -(ego_ys - ref_ys), delta_)
                 return -delta_
 
-        indexs, current_points = self.find_closest_point(ego_xs, ego_ys)
+        indexs, current_points = self.find_closest_point(ego_xs, ego_ys, hint_indexs=hint_indexs,
+                                                         ref_indexes=ref_indexes)
         # print('Index:', indexs.numpy(), 'points:', current_points[:])
-        n_future_data = self.future_n_data(indexs, n)
+        n_future_data = self.future_n_data(indexs, n, ref_indexes)
 
         tracking_error = tf.stack([two2one(current_points[0], current_points[1]),
                                            deal_with_phi_diff(ego_phis - current_points[2]),
@@ -767,8 +1045,79 @@ class ReferencePath(object):
                                        for ref_point in n_future_data], 1)
             final = tf.concat([final, future_points], 1)
 
+        if return_indexs:
+            return final, indexs
         return final
 
+    def np_find_closest_point(self, x, y, ratio=10, hint_index=None):  # single sample
+        if hint_index is not None:
+            path_len = len(self.path[0])
+            window_len = self.search_window[1] - self.search_window[0]
+            start = min(max(int(hint_index) + self.search_window[0], 0), path_len - window_len)
+            dists = np.square(x - self.path[0][start:start+window_len].astype(np.float64)) + \
+                    np.square(y - self.path[1][start:start+window_len].astype(np.float64))
+            argmin = int(np.argmin(dists))
+            index = start + argmin
+            # same fallback rule as _local_closest_indexs
+            on_border = (argmin == 0 and index > 0) or (argmin == window_len - 1 and index < path_len - 1)
+            if not on_border and dists[argmin] <= self.max_search_residual ** 2:
+                return index, self.np_indexs2points(index)
+        dists = np.square(x - self.path[0][::ratio].astype(np.float64)) + \
+                np.square(y - self.path[1][::ratio].astype(np.float64))
+        index = int(np.argmin(dists)) * ratio
+        return index, self.np_indexs2points(index)
+
+    def np_future_n_data(self, current_index, n):
+        future_data_list = []
+        for _ in range(n):
+            current_index = min(current_index + 80, len(self.path[0]) - 2)
+            future_data_list.append(self.np_indexs2points(current_index))
+        return future_data_list
+
+    def np_indexs2points(self, index):
+        index = min(max(int(index), 0), len(self.path[0]) - 1)
+        return float(self.path[0][index]), float(self.path[1][index]), float(self.path[2][index])
+
+    def np_tracking_error_vector(self, ego_x, ego_y, ego_phi, ego_v, n, hint_index=None, return_index=False):
+        # single sample, returns a float64 1-d array
+        ego_x, ego_y, ego_phi, ego_v = float(ego_x), float(ego_y), float(ego_phi), float(ego_v)
+
+        def two2one(ref_x, ref_y):
+            if self.task == 'left':
+                if ego_x < -CROSSROAD_SIZE/2:
+                    delta_ = ego_y - ref_y
+                elif ego_y < -CROSSROAD_SIZE/2:
+                    delta_ = ego_x - ref_x
+                else:
+                    delta_ = sqrt((ego_x - (-CROSSROAD_SIZE/2)) ** 2 + (ego_y - (-CROSSROAD_SIZE/2)) ** 2) - \
+                             sqrt((ref_x - (-CROSSROAD_SIZE/2)) ** 2 + (ref_y - (-CROSSROAD_SIZE/2)) ** 2)
+                return -delta_
+            elif self.task == 'straight':
+                delta_ = ego_x - ref_x
+                return -delta_
+            else:
+                assert self.task == 'right'
+                if ego_x > CROSSROAD_SIZE/2:
+                    delta_ = -(ego_y - ref_y)
+                elif ego_y < -CROSSROAD_SIZE/2:
+                    delta_ = ego_x - ref_x
+                else:
+                    delta_ = -(sqrt((ego_x - CROSSROAD_SIZE/2) ** 2 + (ego_y - (-CROSSROAD_SIZE/2)) ** 2) -
+                               sqrt((ref_x - CROSSROAD_SIZE/2) ** 2 + (ref_y - (-CROSSROAD_SIZE/2)) ** 2))
+                return -delta_
+
+        index, current_point = self.np_find_closest_point(ego_x, ego_y, hint_index=hint_index)
+        final = [two2one(current_point[0], current_point[1]),
+                 np_deal_with_phi_diff(ego_phi - current_point[2]),
+                 ego_v - self.exp_v]
+        for ref_point in self.np_future_n_data(index, n):
+            final.extend([ref_point[0] - ego_x,
+                          ref_point[1] - ego_y,
+                          np_deal_with_phi_diff(ego_phi - ref_point[2])])
+        if return_index:
+            return np.array(final), index
+        return np.array(final)
+
     def plot_path(self, x, y):
         plt.axis('equal')
         plt.plot(self.path_list[0][0], self.path_list[0][1], 'b')
@@ -811,6 +1160,88 @@ def test_tracking_error_vector():
     print(tracking_error_vector)
 
 
+def test_np_backend():
+    # the numpy fast path must agree with the tf model
+    dynamics = VehicleDynamics()
+    states = np.random.uniform([0, -1, -0.5, -30, -60, -180], [10, 1, 0.5, 30, 30, 180], (50, 6)).astype(np.float32)
+    actions = np.random.uniform([-0.4, -3], [0.4, 1.5], (50, 2)).astype(np.float32)
+    next_states, next_params = dynamics.prediction(states, actions, 10)
+    for i in range(len(states)):
+        np_next_state, np_next_params = dynamics.np_prediction(states[i], actions[i], 10)
+        np.testing.assert_allclose(np_next_state, next_states.numpy()[i], rtol=1e-4, atol=1e-3)
+        np.testing.assert_allclose(np_next_params, next_params.numpy()[i], rtol=1e-4, atol=1e-4)
+
+    for task in ['left', 'straight', 'right']:
+        for num_future_data in [0, 3]:
+            model = EnvironmentModel(task, num_future_data)
+            path = model.ref_path
+            for _ in range(50):
+                index = np.random.randint(len(path.path[0]))
+                ego_x, ego_y, ego_phi = [float(p) + np.random.uniform(-2, 2) for p in path.np_indexs2points(index)]
+                ego_v = np.random.uniform(0, 10)
+                tracking = path.tracking_error_vector(np.array([ego_x], np.float32), np.array([ego_y], np.float32),
+                                                      np.array([ego_phi], np.float32), np.array([ego_v], np.float32),
+                                                      num_future_data).numpy()[0]
+                np_tracking = path.np_tracking_error_vector(ego_x, ego_y, ego_phi, ego_v, num_future_data)
+                np.testing.assert_allclose(np_tracking, tracking, rtol=1e-4, atol=1e-3)
+
+                vehs = np.random.uniform([-10, -10, 0, -180], [10, 10, 8, 180], (VEH_NUM[task], 4))
+                vehs[:, :2] += [ego_x, ego_y]
+                obs = np.concatenate([[ego_v, 0, np.random.uniform(-0.3, 0.3), ego_x, ego_y, ego_phi],
+                                      tracking, vehs.reshape(-1)]).astype(np.float32)
+                action = np.random.uniform([-0.4, -3], [0.4, 1.5], (2,)).astype(np.float32)
+                outs = model.compute_rewards(obs[np.newaxis, :], action[np.newaxis, :])
+                np_outs = model.np_compute_rewards(obs, action)
+                for out, np_out in zip(outs[:5], np_outs[:5]):
+                    np.testing.assert_allclose(np_out, out.numpy()[0], rtol=1e-4, atol=1e-3)
+                for key, val in outs[5].items():
+                    np.testing.assert_allclose(np_outs[5][key], val.numpy()[0], rtol=1e-4, atol=1e-3)
+    print('numpy backend matches tf')
+
+
+def test_f_xu_jacobians():
+    # the closed-form jacobians must agree with central differences of the float64 model
+    dynamics = VehicleDynamics()
+    states = np.random.uniform([1, -1, -0.5, -30, -60, -180], [10, 1, 0.5, 30, 30, 180], (50, 6)).astype(np.float32)
+    actions = np.random.uniform([-0.4, -3], [0.4, 1.5], (50, 2)).astype(np.float32)
+    tau, eps = 0.1, 1e-5
+    df_dx, df_du = dynamics.f_xu_jacobians(states, actions, tau)
+    for i in range(len(states)):
+        state, action = states[i].astype(np.float64), actions[i].astype(np.float64)
+        for j in range(6):
+            delta = eps * np.eye(6)[j]
+            fd = (dynamics.np_f_xu(state + delta, action, tau)[0] - dynamics.np_f_xu(state - delta, action, tau)[0]) \
+                 / (2 * eps)
+            np.testing.assert_allclose(df_dx.numpy()[i, :, j], fd, rtol=1e-3, atol=1e-4)
+        for j in range(2):
+            delta = eps * np.eye(2)[j]
+            fd = (dynamics.np_f_xu(state, action + delta, tau)[0] - dynamics.np_f_xu(state, action - delta, tau)[0]) \
+                 / (2 * eps)
+            np.testing.assert_allclose(df_du.numpy()[i, :, j], fd, rtol=1e-3, atol=1e-4)
+    print('f_xu jacobians match finite differences')
+
+
+def test_warm_started_search():
+    # a hinted search never matches worse than the global one, also when the hints are garbage
+    for task in ['left', 'straight', 'right']:
+        path = ReferencePath(task)
+        path_len = len(path.path[0])
+        indexs = np.random.randint(path_len, size=(200,))
+        xs = path.path[0][indexs] + np.random.uniform(-2, 2, (200,)).astype(np.float32)
+        ys = path.path[1][indexs] + np.random.uniform(-2, 2, (200,)).astype(np.float32)
+        for hints in [np.clip(indexs + np.random.randint(-20, 20, (200,)), 0, path_len - 1),
+                      np.random.randint(path_len, size=(200,))]:
+            global_indexs, _ = path.find_closest_point(xs, ys)
+            local_indexs, _ = path.find_closest_point(xs, ys, hint_indexs=hints)
+            np_indexs = [path.np_find_closest_point(x, y, hint_index=hint)[0] for x, y, hint in zip(xs, ys, hints)]
+            np.testing.assert_array_equal(np_indexs, local_indexs.numpy())
+
+            def dists(idx):
+                return np.hypot(xs - path.path[0][idx], ys - path.path[1][idx])
+            assert np.all(dists(local_indexs.numpy()) <= dists(global_indexs.numpy()) + 1e-5)
+    print('warm-started search ok')
+
+
 def test_model():
     from endtoend import CrossroadEnd2end
     env = CrossroadEnd2end('left', 0)
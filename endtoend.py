@@ -9,7 +9,9 @@
 
 import warnings
 from collections import OrderedDict
+from itertools import chain, repeat
 from math import cos, sin, pi
+from operator import itemgetter
 
 import gym
 import matplotlib.pyplot as plt
@@ -19,11 +21,97 @@ from gym.utils import seeding
 # gym.envs.user_defined.toyota_env.
 from dynamics_and_models import VehicleDynamics, ReferencePath, EnvironmentModel
 from endtoend_env_utils import shift_coordination, rotate_coordination, rotate_and_shift_coordination, deal_with_phi, \
-    L, W, CROSSROAD_SIZE, LANE_WIDTH, LANE_NUMBER, judge_feasible, MODE2TASK, VEHICLE_MODE_DICT, VEH_NUM, EXPECTED_V
-from traffic import Traffic
+    L, W, CROSSROAD_SIZE, LANE_WIDTH, LANE_NUMBER, judge_feasible, MODE2TASK, VEHICLE_MODE_DICT, VEH_NUM, EXPECTED_V, \
+    VEHICLE_MODE_LIST, MODE_LIST, MODE2ID, EXIT2ROUTE2MODEID
+from profiler import PROFILER
 
 warnings.filterwarnings("ignore")
 
+# columns of the vehicle table: x, y, v, phi, l, w
+VEH_TABLE_DIM = 6
+_VEH_TABLE_GETTER = itemgetter('x', 'y', 'v', 'phi', 'l', 'w')
+_ROUTE_GETTER = itemgetter('route')
+MODE2FILLVALUE = np.zeros((len(MODE_LIST), VEH_TABLE_DIM), dtype=np.float64)
+for _mode, _fill_value in dict(dl=(LANE_WIDTH/2, -(CROSSROAD_SIZE/2+30), 0, 90, 5, 2.5),
+                               du=(LANE_WIDTH*1.5, -(CROSSROAD_SIZE/2+30), 0, 90, 5, 2.5),
+                               dr=(LANE_WIDTH*(LANE_NUMBER-0.5), -(CROSSROAD_SIZE/2+30), 0, 90, 5, 2.5),
+                               ru=((CROSSROAD_SIZE/2+15), LANE_WIDTH*(LANE_NUMBER-0.5), 0, 180, 5, 2.5),
+                               ur=(-LANE_WIDTH/2, (CROSSROAD_SIZE/2+20), 0, -90, 5, 2.5),
+                               ud=(-LANE_WIDTH*1.5, (CROSSROAD_SIZE/2+20), 0, -90, 5, 2.5),
+                               ul=(-LANE_WIDTH*(LANE_NUMBER-0.5), (CROSSROAD_SIZE/2+20), 0, -90, 5, 2.5),
+                               lr=(-(CROSSROAD_SIZE/2+20), -LANE_WIDTH*1.5, 0, 0, 5, 2.5)).items():
+    MODE2FILLVALUE[MODE2ID[_mode]] = _fill_value
+
+# static vehicles standing at the stop line when the light is red
+RED_LIGHT_VEH_TABLE = np.array([[LANE_WIDTH/2, -CROSSROAD_SIZE/2+2.5, 0., 90, 5, 2.5],
+                                [LANE_WIDTH*1.5, -CROSSROAD_SIZE/2+2.5, 0., 90, 5, 2.5]], dtype=np.float64)
+RED_LIGHT_VEH_MODE_IDS = np.array([MODE2ID['dl'], MODE2ID['du']], dtype=np.int64)
+
+
+def vehicles2table(vehicles, exit_='D'):
+    """list of vehicle dicts -> [V, VEH_TABLE_DIM] table and [V] mode ids (-1 for unknown routes)"""
+    # every route in the sumo files is a (start edge, end edge) pair, so the route itself is the key
+    veh_table = np.fromiter(chain.from_iterable(map(_VEH_TABLE_GETTER, vehicles)), dtype=np.float64,
+                            count=len(vehicles) * VEH_TABLE_DIM).reshape(-1, VEH_TABLE_DIM)
+    mode_ids = np.fromiter(map(EXIT2ROUTE2MODEID[exit_].get, map(_ROUTE_GETTER, vehicles), repeat(-1)),
+                           dtype=np.int64, count=len(vehicles))
+    return veh_table, mode_ids
+
+
+def _region_and_sort_keys(mode, task, xs, ys, ego_x, ego_y):
+    # region mask of a mode and its np.lexsort keys (the last key is the primary one)
+    if mode == 'dl':  # interest of left straight
+        return (xs > -CROSSROAD_SIZE/2-10) & (ys > ego_y-2), (-xs, ys)
+    elif mode == 'du':  # interest of left straight
+        return (ego_y-2 < ys) & (ys < CROSSROAD_SIZE/2+10) & (xs < ego_x+5), (ys,)
+    elif mode == 'dr':  # interest of right
+        return (xs < CROSSROAD_SIZE/2+10) & (ys > ego_y), (xs, ys)
+    elif mode == 'ru':  # interest of straight
+        return (xs < CROSSROAD_SIZE/2+10) & (ys < CROSSROAD_SIZE/2+10), (-ys, xs)
+    elif mode == 'ur' and task == 'straight':
+        return (xs < ego_x + 7) & (ego_y < ys) & (ys < CROSSROAD_SIZE/2+10), (ys,)
+    elif mode == 'ur' and task == 'right':
+        return (xs < CROSSROAD_SIZE/2+10) & (ys < CROSSROAD_SIZE/2), (-xs, ys)
+    elif mode == 'ud':  # interest of left
+        return (max(ego_y-2, -CROSSROAD_SIZE/2) < ys) & (ys < CROSSROAD_SIZE/2) & (ego_x > xs), (ys,)
+    elif mode == 'ul':  # interest of left
+        return (-CROSSROAD_SIZE/2-10 < xs) & (xs < ego_x) & (ys < CROSSROAD_SIZE/2), (xs, ys)
+    elif mode == 'lr':  # interest of right
+        return (-CROSSROAD_SIZE/2-10 < xs) & (xs < CROSSROAD_SIZE/2+10), (-xs,)
+    else:
+        raise NotImplementedError(mode, task)
+
+
+def select_interested_vehicles(veh_table, mode_ids, task, ego_x, ego_y, with_red_light_vehs=False):
+    """pick the interested vehicles of each mode in the order of VEHICLE_MODE_LIST[task],
+    missing ones are filled by MODE2FILLVALUE, returns a [VEH_NUM[task], VEH_TABLE_DIM] table"""
+    if with_red_light_vehs:
+        veh_table = np.concatenate([veh_table, RED_LIGHT_VEH_TABLE], 0)
+        mode_ids = np.concatenate([mode_ids, RED_LIGHT_VEH_MODE_IDS], 0)
+    xs, ys = veh_table[:, 0], veh_table[:, 1]
+    out = np.empty((VEH_NUM[task], VEH_TABLE_DIM), dtype=np.float64)
+    start = 0
+    for mode, num in VEHICLE_MODE_DICT[task].items():
+        candidates = np.flatnonzero(mode_ids == MODE2ID[mode])
+        region, keys = _region_and_sort_keys(mode, task, xs[candidates], ys[candidates], ego_x, ego_y)
+        selected = candidates[region][np.lexsort([key[region] for key in keys])[:num]]
+        out[start:start+len(selected)] = veh_table[selected]
+        out[start+len(selected):start+num] = MODE2FILLVALUE[MODE2ID[mode]]
+        start += num
+    return out
+
+
+def make_traffic(traffic_backend, step_length, mode, init_n_ego_dict, training_task='left', **traffic_kwargs):
+    # imported here so that the surrogate and the replay backends run without SUMO_HOME
+    if traffic_backend == 'surrogate':
+        from surrogate_traffic import SurrogateTraffic
+        return SurrogateTraffic(step_length, mode, init_n_ego_dict, training_task, **traffic_kwargs)
+    if traffic_backend == 'replay':
+        from replay_traffic import ReplayTraffic
+        return ReplayTraffic(step_length, mode, init_n_ego_dict, training_task, **traffic_kwargs)
+    from traffic import Traffic
+    return Traffic(step_length, mode, init_n_ego_dict, training_task, **traffic_kwargs)
+
 
 def convert_observation_to_space(observation):
     if isinstance(observation, dict):
@@ -47,11 +135,20 @@ class CrossroadEnd2end(gym.Env):
                  num_future_data=0,
                  mode='training',
                  multi_display=False,
+                 backend='tf',  # 'tf' or 'numpy', the latter runs the single-sample math without tf ops
+                 traffic_backend='sumo',  # 'sumo', 'surrogate' (numpy traffic model) or 'replay' (recorded sumo traces)
+                 traffic_kwargs=None,  # passed to the traffic backend, e.g. dict(trace_dir=..., seed=0) for 'replay'
                  **kwargs):
+        assert backend in ['tf', 'numpy']
+        assert traffic_backend in ['sumo', 'surrogate', 'replay']
+        self.backend = backend
+        self.traffic_backend = traffic_backend
+        self.traffic_kwargs = traffic_kwargs or {}
         self.dynamics = VehicleDynamics()
         self.interested_vehs = None
         self.training_task = training_task
         self.ref_path = ReferencePath(self.training_task, **kwargs)
+        self.closest_index_hints = {}  # ref_index -> closest path point of the last obs, warm-starts the search
         self.detected_vehicles = None
         self.all_vehicles = None
         self.ego_dynamics = None
@@ -66,6 +163,7 @@ class CrossroadEnd2end(gym.Env):
         self.seed()
         self.v_light = None
         self.step_length = 100  # ms
+        self.ego_id = 'ego'
 
         self.step_time = self.step_length / 1000.0
         self.init_state = self._reset_init_state()
@@ -77,43 +175,59 @@ class CrossroadEnd2end(gym.Env):
 
         self.done_type = 'not_done_yet'
         self.reward_info = None
-        self.ego_info_dim = None
-        self.per_tracking_info_dim = None
-        self.per_veh_info_dim = None
+        self.ego_info_dim = 6
+        self.per_tracking_info_dim = 3
+        self.per_veh_info_dim = 4
         self.mode = mode
-        if not multi_display:
-            self.traffic = Traffic(self.step_length,
-                                   mode=self.mode,
-                                   init_n_ego_dict=self.init_state,
-                                   training_task=self.training_task)
-            self.reset()
-            action = self.action_space.sample()
-            observation, _reward, done, _info = self.step(action)
-            self._set_observation_space(observation)
-            plt.ion()
+        # the obs layout is fixed, so the space is known without running the traffic
+        obs_dim = self.ego_info_dim + self.per_tracking_info_dim * (self.num_future_data + 1) + \
+                  self.per_veh_info_dim * self.veh_num
+        self._set_observation_space(np.zeros((obs_dim,), dtype=np.float32))
+        self.ego_slice = slice(0, self.ego_info_dim)
+        self.tracking_slice = slice(self.ego_info_dim, obs_dim - self.per_veh_info_dim * self.veh_num)
+        self.veh_slice = slice(self.tracking_slice.stop, obs_dim)
+        self.obs_buffer = np.zeros((obs_dim,), dtype=np.float32)  # the obs is assembled here unless out is given
+        # sumo is launched by the first reset, with multi_display the traffic is shared and set from outside
+        self.traffic = None
 
     def seed(self, seed=None):
         self.np_random, seed = seeding.np_random(seed)
         return [seed]
 
-    def reset(self, **kwargs):  # kwargs include three keys
-        self.ref_path = ReferencePath(self.training_task, **kwargs)
-        self.init_state = self._reset_init_state()
+    @PROFILER.timed('env.reset')
+    def reset(self, out=None, **kwargs):  # kwargs include three keys
+        self._reset_ego(**kwargs)
+        if self.traffic is None:
+            self.traffic = make_traffic(self.traffic_backend,
+                                        self.step_length,
+                                        mode=self.mode,
+                                        init_n_ego_dict=self.init_state,
+                                        training_task=self.training_task,
+                                        **self.traffic_kwargs)
         self.traffic.init_traffic(self.init_state)
         self.traffic.sim_step()
-        ego_dynamics = self._get_ego_dynamics([self.init_state['ego']['v_x'],
-                                               self.init_state['ego']['v_y'],
-                                               self.init_state['ego']['r'],
-                                               self.init_state['ego']['x'],
-                                               self.init_state['ego']['y'],
-                                               self.init_state['ego']['phi']],
+        return self._reset_obs(out)
+
+    def _reset_ego(self, **kwargs):
+        self.ref_path = ReferencePath(self.training_task, **kwargs)
+        self.closest_index_hints = {}
+        self.init_state = self._reset_init_state()
+
+    def _reset_obs(self, out=None):  # called after the traffic has been reset
+        init_ego_state = self.init_state[self.ego_id]
+        ego_dynamics = self._get_ego_dynamics([init_ego_state['v_x'],
+                                               init_ego_state['v_y'],
+                                               init_ego_state['r'],
+                                               init_ego_state['x'],
+                                               init_ego_state['y'],
+                                               init_ego_state['phi']],
                                               [0,
                                                0,
                                                self.dynamics.vehicle_params['miu'],
                                                self.dynamics.vehicle_params['miu']]
                                               )
         self._get_all_info(ego_dynamics)
-        self.obs = self._get_obs()
+        self.obs = self._get_obs(out=self.obs_buffer if out is None else out)
         self.action = None
         self.reward_info = None
         self.done_type = 'not_done_yet'
@@ -124,24 +238,33 @@ class CrossroadEnd2end(gym.Env):
                 self.virtual_red_light_vehicle = False
         else:
             self.virtual_red_light_vehicle = False
-        return self.obs
+        return self.obs if out is not None else self.obs.copy()
 
     def close(self):
-        del self.traffic
+        self.traffic = None
+
+    @PROFILER.timed('env.step')
+    def step(self, action, out=None):
+        """if out is given, the obs is written into it and out is returned, otherwise a new array is returned"""
+        reward, ego_dynamics = self._step_ego(action)
+        self.traffic.set_own_car({self.ego_id: ego_dynamics})
+        self.traffic.sim_step()
+        return self._step_obs(reward, ego_dynamics, out)
 
-    def step(self, action):
+    def _step_ego(self, action):  # everything before the traffic is stepped
         self.action = self._action_transformation_for_end2end(action)
         reward, self.reward_info = self.compute_reward(self.obs, self.action)
         next_ego_state, next_ego_params = self._get_next_ego_state(self.action)
         ego_dynamics = self._get_ego_dynamics(next_ego_state, next_ego_params)
-        self.traffic.set_own_car(dict(ego=ego_dynamics))
-        self.traffic.sim_step()
+        return reward, ego_dynamics
+
+    def _step_obs(self, reward, ego_dynamics, out=None):  # everything after the traffic is stepped
         all_info = self._get_all_info(ego_dynamics)
-        self.obs = self._get_obs()
+        self.obs = self._get_obs(out=self.obs_buffer if out is None else out)
         self.done_type, done = self._judge_done()
         self.reward_info.update({'final_rew': reward})
         all_info.update({'reward_info': self.reward_info, 'ref_index': self.ref_path.ref_index})
-        return self.obs, reward, done, all_info
+        return self.obs if out is not None else self.obs.copy(), reward, done, all_info
 
     def _set_observation_space(self, observation):
         self.observation_space = convert_observation_to_space(observation)
@@ -184,7 +307,7 @@ class CrossroadEnd2end(gym.Env):
 
     def _get_all_info(self, ego_dynamics):  # used to update info, must be called every timestep before _get_obs
         # to fetch info
-        self.all_vehicles = self.traffic.n_ego_vehicles['ego']  # coordination 2
+        self.all_vehicles = self.traffic.n_ego_vehicles[self.ego_id]  # coordination 2
         self.ego_dynamics = ego_dynamics  # coordination 2
         self.v_light = self.traffic.v_light
 
@@ -197,6 +320,7 @@ class CrossroadEnd2end(gym.Env):
                         v_light=self.v_light)
         return all_info
 
+    @PROFILER.timed('env.judge_done')
     def _judge_done(self):
         """
         :return:
@@ -205,7 +329,7 @@ class CrossroadEnd2end(gym.Env):
          3: good done: task succeed
          4: not done
         """
-        if self.traffic.collision_flag:
+        if self.traffic.n_ego_collision_flag.get(self.ego_id, False):
             return 'collision', 1
         if self._break_road_constrain():
             return 'break_road_constrain', 1
@@ -255,6 +379,7 @@ class CrossroadEnd2end(gym.Env):
             assert self.training_task == 'straight'
             return True if y > CROSSROAD_SIZE/2 + 10 and 0 < x < LANE_NUMBER*LANE_WIDTH else False
 
+    @PROFILER.timed('env.action_transformation')
     def _action_transformation_for_end2end(self, action):  # [-1, 1]
         action = np.clip(action, -1.05, 1.05)
         steer_norm, a_x_norm = action[0], action[1]
@@ -266,6 +391,7 @@ class CrossroadEnd2end(gym.Env):
         scaled_action = np.array([scaled_steer, scaled_a_x], dtype=np.float32)
         return scaled_action
 
+    @PROFILER.timed('env.dynamics')
     def _get_next_ego_state(self, trans_action):
         current_v_x = self.ego_dynamics['v_x']
         current_v_y = self.ego_dynamics['v_y']
@@ -274,33 +400,51 @@ class CrossroadEnd2end(gym.Env):
         current_y = self.ego_dynamics['y']
         current_phi = self.ego_dynamics['phi']
         steer, a_x = trans_action
-        state = np.array([[current_v_x, current_v_y, current_r, current_x, current_y, current_phi]], dtype=np.float32)
-        action = np.array([[steer, a_x]], dtype=np.float32)
-        next_ego_state, next_ego_params = self.dynamics.prediction(state, action, 10)
-        next_ego_state, next_ego_params = next_ego_state.numpy()[0],  next_ego_params.numpy()[0]
+        if self.backend == 'numpy':
+            next_ego_state, next_ego_params = self.dynamics.np_prediction(
+                [current_v_x, current_v_y, current_r, current_x, current_y, current_phi], [steer, a_x], 10)
+        else:
+            state = np.array([[current_v_x, current_v_y, current_r, current_x, current_y, current_phi]], dtype=np.float32)
+            action = np.array([[steer, a_x]], dtype=np.float32)
+            next_ego_state, next_ego_params = self.dynamics.prediction(state, action, 10)
+            next_ego_state, next_ego_params = next_ego_state.numpy()[0],  next_ego_params.numpy()[0]
         next_ego_state[0] = next_ego_state[0] if next_ego_state[0] >= 0 else 0.
         next_ego_state[-1] = deal_with_phi(next_ego_state[-1])
         return next_ego_state, next_ego_params
 
-    def _get_obs(self, exit_='D'):
+    @PROFILER.timed('env.get_obs')
+    def _get_obs(self, exit_='D', out=None):
+        # ego, tracking and vehicle segments are filled in place
+        if out is None:
+            out = np.empty(self.observation_space.shape, dtype=np.float32)
         ego_x = self.ego_dynamics['x']
         ego_y = self.ego_dynamics['y']
         ego_phi = self.ego_dynamics['phi']
         ego_v_x = self.ego_dynamics['v_x']
 
-        vehs_vector = self._construct_veh_vector_short(exit_)
-        ego_vector = self._construct_ego_vector_short()
-        tracking_error = self.ref_path.tracking_error_vector(np.array([ego_x], dtype=np.float32),
-                                                             np.array([ego_y], dtype=np.float32),
-                                                             np.array([ego_phi], dtype=np.float32),
-                                                             np.array([ego_v_x], dtype=np.float32),
-                                                             self.num_future_data).numpy()[0]
-        self.per_tracking_info_dim = 3
-
-        vector = np.concatenate((ego_vector, tracking_error, vehs_vector), axis=0)
+        self._construct_veh_vector_short(exit_, out[self.veh_slice])
+        self._construct_ego_vector_short(out[self.ego_slice])
+        hint_index = self.closest_index_hints.get(self.ref_path.ref_index)
+        if self.backend == 'numpy':
+            tracking_error, closest_index = self.ref_path.np_tracking_error_vector(ego_x, ego_y, ego_phi, ego_v_x,
+                                                                                   self.num_future_data,
+                                                                                   hint_index=hint_index,
+                                                                                   return_index=True)
+        else:
+            tracking_error, closest_indexs = self.ref_path.tracking_error_vector(
+                np.array([ego_x], dtype=np.float32),
+                np.array([ego_y], dtype=np.float32),
+                np.array([ego_phi], dtype=np.float32),
+                np.array([ego_v_x], dtype=np.float32),
+                self.num_future_data,
+                hint_indexs=None if hint_index is None else np.array([hint_index], dtype=np.int64),
+                return_indexs=True)
+            tracking_error, closest_index = tracking_error.numpy()[0], int(closest_indexs.numpy()[0])
+        self.closest_index_hints[self.ref_path.ref_index] = closest_index
+        out[self.tracking_slice] = tracking_error
         # vector = self.convert_vehs_to_rela(vector)
 
-        return vector
+        return out
 
     # def convert_vehs_to_rela(self, obs_abso):
     #     ego_infos, tracking_infos, veh_infos = obs_abso[:self.ego_info_dim], \
@@ -326,142 +470,29 @@ class CrossroadEnd2end(gym.Env):
     #     out = np.concatenate((ego_infos, tracking_infos, vehs_abso), axis=0)
     #     return out
 
-    def _construct_ego_vector_short(self):
-        ego_v_x = self.ego_dynamics['v_x']
-        ego_v_y = self.ego_dynamics['v_y']
-        ego_r = self.ego_dynamics['r']
-        ego_x = self.ego_dynamics['x']
-        ego_y = self.ego_dynamics['y']
-        ego_phi = self.ego_dynamics['phi']
-        ego_feature = [ego_v_x, ego_v_y, ego_r, ego_x, ego_y, ego_phi]
-        self.ego_info_dim = 6
-        return np.array(ego_feature, dtype=np.float32)
+    def _construct_ego_vector_short(self, out=None):
+        if out is None:
+            out = np.empty((self.ego_info_dim,), dtype=np.float32)
+        out[0] = self.ego_dynamics['v_x']
+        out[1] = self.ego_dynamics['v_y']
+        out[2] = self.ego_dynamics['r']
+        out[3] = self.ego_dynamics['x']
+        out[4] = self.ego_dynamics['y']
+        out[5] = self.ego_dynamics['phi']
+        return out
 
-    def _construct_veh_vector_short(self, exit_='D'):
+    def _construct_veh_vector_short(self, exit_='D', out=None):
         ego_x = self.ego_dynamics['x']
         ego_y = self.ego_dynamics['y']
-        v_light = self.v_light
-        vehs_vector = []
-
-        name_settings = dict(D=dict(do='1o', di='1i', ro='2o', ri='2i', uo='3o', ui='3i', lo='4o', li='4i'),
-                             R=dict(do='2o', di='2i', ro='3o', ri='3i', uo='4o', ui='4i', lo='1o', li='1i'),
-                             U=dict(do='3o', di='3i', ro='4o', ri='4i', uo='1o', ui='1i', lo='2o', li='2i'),
-                             L=dict(do='4o', di='4i', ro='1o', ri='1i', uo='2o', ui='2i', lo='3o', li='3i'))
-
-        name_setting = name_settings[exit_]
-
-        def filter_interested_vehicles(vs, task):
-            dl, du, dr, rd, rl, ru, ur, ud, ul, lu, lr, ld = [], [], [], [], [], [], [], [], [], [], [], []
-            for v in vs:
-                route_list = v['route']
-                start = route_list[0]
-                end = route_list[1]
-                if start == name_setting['do'] and end == name_setting['li']:
-                    dl.append(v)
-                elif start == name_setting['do'] and end == name_setting['ui']:
-                    du.append(v)
-                elif start == name_setting['do'] and end == name_setting['ri']:
-                    dr.append(v)
-
-                elif start == name_setting['ro'] and end == name_setting['di']:
-                    rd.append(v)
-                elif start == name_setting['ro'] and end == name_setting['li']:
-                    rl.append(v)
-                elif start == name_setting['ro'] and end == name_setting['ui']:
-                    ru.append(v)
-
-                elif start == name_setting['uo'] and end == name_setting['ri']:
-                    ur.append(v)
-                elif start == name_setting['uo'] and end == name_setting['di']:
-                    ud.append(v)
-                elif start == name_setting['uo'] and end == name_setting['li']:
-                    ul.append(v)
-
-                elif start == name_setting['lo'] and end == name_setting['ui']:
-                    lu.append(v)
-                elif start == name_setting['lo'] and end == name_setting['ri']:
-                    lr.append(v)
-                elif start == name_setting['lo'] and end == name_setting['di']:
-                    ld.append(v)
-            if self.training_task != 'right':
-                if (v_light != 0 and ego_y < -CROSSROAD_SIZE/2) \
-                        or (self.virtual_red_light_vehicle and ego_y < -CROSSROAD_SIZE/2):
-                    dl.append(dict(x=LANE_WIDTH/2, y=-CROSSROAD_SIZE/2+2.5, v=0., phi=90, l=5, w=2.5, route=None))
-                    du.append(dict(x=LANE_WIDTH*1.5, y=-CROSSROAD_SIZE/2+2.5, v=0., phi=90, l=5, w=2.5, route=None))
-
-            # fetch veh in range
-            dl = list(filter(lambda v: v['x'] > -CROSSROAD_SIZE/2-10 and v['y'] > ego_y-2, dl))  # interest of left straight
-            du = list(filter(lambda v: ego_y-2 < v['y'] < CROSSROAD_SIZE/2+10 and v['x'] < ego_x+5, du))  # interest of left straight
-
-            dr = list(filter(lambda v: v['x'] < CROSSROAD_SIZE/2+10 and v['y'] > ego_y, dr))  # interest of right
-
-            rd = rd  # not interest in case of traffic light
-            rl = rl  # not interest in case of traffic light
-            ru = list(filter(lambda v: v['x'] < CROSSROAD_SIZE/2+10 and v['y'] < CROSSROAD_SIZE/2+10, ru))  # interest of straight
-
-            if task == 'straight':
-                ur = list(filter(lambda v: v['x'] < ego_x + 7 and ego_y < v['y'] < CROSSROAD_SIZE/2+10, ur))  # interest of straight
-            elif task == 'right':
-                ur = list(filter(lambda v: v['x'] < CROSSROAD_SIZE/2+10 and v['y'] < CROSSROAD_SIZE/2, ur))  # interest of right
-            ud = list(filter(lambda v: max(ego_y-2, -CROSSROAD_SIZE/2) < v['y'] < CROSSROAD_SIZE/2 and ego_x > v['x'], ud))  # interest of left
-            ul = list(filter(lambda v: -CROSSROAD_SIZE/2-10 < v['x'] < ego_x and v['y'] < CROSSROAD_SIZE/2, ul))  # interest of left
-
-            lu = lu  # not interest in case of traffic light
-            lr = list(filter(lambda v: -CROSSROAD_SIZE/2-10 < v['x'] < CROSSROAD_SIZE/2+10, lr))  # interest of right
-            ld = ld  # not interest in case of traffic light
-
-            # sort
-            dl = sorted(dl, key=lambda v: (v['y'], -v['x']))
-            du = sorted(du, key=lambda v: v['y'])
-            dr = sorted(dr, key=lambda v: (v['y'], v['x']))
-
-            ru = sorted(ru, key=lambda v: (-v['x'], v['y']), reverse=True)
-
-            if task == 'straight':
-                ur = sorted(ur, key=lambda v: v['y'])
-            elif task == 'right':
-                ur = sorted(ur, key=lambda v: (-v['y'], v['x']), reverse=True)
-
-            ud = sorted(ud, key=lambda v: v['y'])
-            ul = sorted(ul, key=lambda v: (-v['y'], -v['x']), reverse=True)
-
-            lr = sorted(lr, key=lambda v: -v['x'])
-
-            # slice or fill to some number
-            def slice_or_fill(sorted_list, fill_value, num):
-                if len(sorted_list) >= num:
-                    return sorted_list[:num]
-                else:
-                    while len(sorted_list) < num:
-                        sorted_list.append(fill_value)
-                    return sorted_list
-
-            mode2fillvalue = dict(
-                dl=dict(x=LANE_WIDTH/2, y=-(CROSSROAD_SIZE/2+30), v=0, phi=90, w=2.5, l=5, route=('1o', '4i')),
-                du=dict(x=LANE_WIDTH*1.5, y=-(CROSSROAD_SIZE/2+30), v=0, phi=90, w=2.5, l=5, route=('1o', '3i')),
-                dr=dict(x=LANE_WIDTH*(LANE_NUMBER-0.5), y=-(CROSSROAD_SIZE/2+30), v=0, phi=90, w=2.5, l=5, route=('1o', '2i')),
-                ru=dict(x=(CROSSROAD_SIZE/2+15), y=LANE_WIDTH*(LANE_NUMBER-0.5), v=0, phi=180, w=2.5, l=5, route=('2o', '3i')),
-                ur=dict(x=-LANE_WIDTH/2, y=(CROSSROAD_SIZE/2+20), v=0, phi=-90, w=2.5, l=5, route=('3o', '2i')),
-                ud=dict(x=-LANE_WIDTH*1.5, y=(CROSSROAD_SIZE/2+20), v=0, phi=-90, w=2.5, l=5, route=('3o', '1i')),
-                ul=dict(x=-LANE_WIDTH*(LANE_NUMBER-0.5), y=(CROSSROAD_SIZE/2+20), v=0, phi=-90, w=2.5, l=5, route=('3o', '4i')),
-                lr=dict(x=-(CROSSROAD_SIZE/2+20), y=-LANE_WIDTH*1.5, v=0, phi=0, w=2.5, l=5, route=('4o', '2i')))
-
-            tmp = OrderedDict()
-            for mode, num in VEHICLE_MODE_DICT[task].items():
-                tmp[mode] = slice_or_fill(eval(mode), mode2fillvalue[mode], num)
-
-            return tmp
-
-        list_of_interested_veh_dict = []
-        self.interested_vehs = filter_interested_vehicles(self.all_vehicles, self.training_task)
-        for part in list(self.interested_vehs.values()):
-            list_of_interested_veh_dict.extend(part)
-
-        for veh in list_of_interested_veh_dict:
-            veh_x, veh_y, veh_v, veh_phi = veh['x'], veh['y'], veh['v'], veh['phi']
-            vehs_vector.extend([veh_x, veh_y, veh_v, veh_phi])
-        self.per_veh_info_dim = 4
-        return np.array(vehs_vector, dtype=np.float32)
+        with_red_light_vehs = self.training_task != 'right' and ego_y < -CROSSROAD_SIZE/2 and \
+                              (self.v_light != 0 or self.virtual_red_light_vehicle)
+        veh_table, mode_ids = vehicles2table(self.all_vehicles, exit_)
+        self.interested_vehs = select_interested_vehicles(veh_table, mode_ids, self.training_task,
+                                                          ego_x, ego_y, with_red_light_vehs)
+        if out is None:
+            out = np.empty((self.veh_num * self.per_veh_info_dim,), dtype=np.float32)
+        out.reshape(self.veh_num, self.per_veh_info_dim)[:] = self.interested_vehs[:, :self.per_veh_info_dim]
+        return out
 
     def recover_orig_position_fn(self, transformed_x, transformed_y, x, y, d):  # x, y, d are used to transform
         # coordination
@@ -477,7 +508,10 @@ class CrossroadEnd2end(gym.Env):
         else:
             random_index = int(np.random.random()*(420+500)) + 700
 
-        x, y, phi = self.ref_path.indexs2points(random_index)
+        if self.backend == 'numpy':
+            x, y, phi = self.ref_path.np_indexs2points(random_index)
+        else:
+            x, y, phi = [p.numpy() for p in self.ref_path.indexs2points(random_index)]
         # v = 7 + 6 * np.random.random()
         v = EXPECTED_V * np.random.random()
         if self.training_task == 'left':
@@ -487,18 +521,22 @@ class CrossroadEnd2end(gym.Env):
         else:
             assert self.training_task == 'right'
             routeID = 'dr'
-        return dict(ego=dict(v_x=v,
-                             v_y=0,
-                             r=0,
-                             x=x.numpy(),
-                             y=y.numpy(),
-                             phi=phi.numpy(),
-                             l=self.ego_l,
-                             w=self.ego_w,
-                             routeID=routeID,
-                             ))
-
+        return {self.ego_id: dict(v_x=v,
+                                  v_y=0,
+                                  r=0,
+                                  x=x,
+                                  y=y,
+                                  phi=phi,
+                                  l=self.ego_l,
+                                  w=self.ego_w,
+                                  routeID=routeID,
+                                  )}
+
+    @PROFILER.timed('env.compute_reward')
     def compute_reward(self, obs, action):
+        if self.backend == 'numpy':
+            reward, _, _, _, _, reward_dict = self.env_model.np_compute_rewards(obs, action)
+            return reward, reward_dict
         obses, actions = obs[np.newaxis, :], action[np.newaxis, :]
         reward, _, _, _, _, reward_dict = \
             self.env_model.compute_rewards(obses, actions)
@@ -508,6 +546,7 @@ class CrossroadEnd2end(gym.Env):
 
     def render(self, mode='human'):
         if mode == 'human':
+            plt.ion()
             # plot basic map
             square_length = CROSSROAD_SIZE
             extension = 40
@@ -653,21 +692,15 @@ class CrossroadEnd2end(gym.Env):
                     draw_rotate_rec(veh_x, veh_y, veh_phi, veh_l, veh_w, 'black')
 
             # plot_interested vehs
-            for mode, num in self.veh_mode_dict.items():
-                for i in range(num):
-                    veh = self.interested_vehs[mode][i]
-                    veh_x = veh['x']
-                    veh_y = veh['y']
-                    veh_phi = veh['phi']
-                    veh_l = veh['l']
-                    veh_w = veh['w']
-                    task2color = {'left': 'b', 'straight': 'c', 'right': 'm'}
-
-                    if is_in_plot_area(veh_x, veh_y):
-                        plot_phi_line(veh_x, veh_y, veh_phi, 'black')
-                        task = MODE2TASK[mode]
-                        color = task2color[task]
-                        draw_rotate_rec(veh_x, veh_y, veh_phi, veh_l, veh_w, color, linestyle=':')
+            for mode, veh in zip(VEHICLE_MODE_LIST[self.training_task], self.interested_vehs):
+                veh_x, veh_y, _, veh_phi, veh_l, veh_w = veh
+                task2color = {'left': 'b', 'straight': 'c', 'right': 'm'}
+
+                if is_in_plot_area(veh_x, veh_y):
+                    plot_phi_line(veh_x, veh_y, veh_phi, 'black')
+                    task = MODE2TASK[mode]
+                    color = task2color[task]
+                    draw_rotate_rec(veh_x, veh_y, veh_phi, veh_l, veh_w, color, linestyle=':')
 
             # plot own car
             # dict(v_x=ego_dict['v_x'],
@@ -11,6 +11,8 @@ import math
 import os
 from collections import OrderedDict
 
+import numpy as np
+
 L, W = 4.8, 2.0
 LANE_WIDTH = 3.75
 LANE_NUMBER = 3
@@ -18,6 +20,9 @@ CROSSROAD_SIZE = 50
 EXPECTED_V = 8.
 dirname = os.path.dirname(__file__)
 SUMOCFG_DIR = dirname + "/sumo_files/cross.sumocfg"
+PATH_CACHE_DIR = dirname + "/path_cache"
+SNAPSHOT_DIR = dirname + "/snapshot_cache"
+TRACE_DIR = dirname + "/trace_cache"
 VEHICLE_MODE_DICT = dict(left=OrderedDict(dl=2, du=2, ud=2, ul=2),
                          straight=OrderedDict(dl=1, du=2, ud=2, ru=2, ur=2),
                          right=OrderedDict(dr=1, ur=2, lr=2))
@@ -70,6 +75,21 @@ MODE2ROUTE = {'dr': ('1o', '2i'), 'du': ('1o', '3i'), 'dl': ('1o', '4i'),
               'ld': ('4o', '1i'), 'lr': ('4o', '2i'), 'lu': ('4o', '3i')}
 
 
+MODE_LIST = ['dl', 'du', 'dr', 'rd', 'rl', 'ru', 'ur', 'ud', 'ul', 'lu', 'lr', 'ld']
+MODE2ID = {mode: i for i, mode in enumerate(MODE_LIST)}
+
+# sumo edge names seen from the ego's entrance
+NAME_SETTINGS = dict(D=dict(do='1o', di='1i', ro='2o', ri='2i', uo='3o', ui='3i', lo='4o', li='4i'),
+                     R=dict(do='2o', di='2i', ro='3o', ri='3i', uo='4o', ui='4i', lo='1o', li='1i'),
+                     U=dict(do='3o', di='3i', ro='4o', ri='4i', uo='1o', ui='1i', lo='2o', li='2i'),
+                     L=dict(do='4o', di='4i', ro='1o', ri='1i', uo='2o', ui='2i', lo='3o', li='3i'))
+
+# (start edge, end edge) -> mode id, for each entrance
+EXIT2ROUTE2MODEID = {exit_: {(name_setting[mode[0] + 'o'], name_setting[mode[1] + 'i']): MODE2ID[mode]
+                             for mode in MODE_LIST}
+                     for exit_, name_setting in NAME_SETTINGS.items()}
+
+
 def judge_feasible(orig_x, orig_y, task):  # map dependant
     def is_in_straight_before1(orig_x, orig_y):
         return 0 < orig_x < LANE_WIDTH and orig_y <= -CROSSROAD_SIZE / 2
@@ -219,7 +239,7 @@ def _convert_car_coord_to_sumo_coord(x_in_car_coord, y_in_car_coord, a_in_car_co
     x_in_sumo_coord = x_in_car_coord + car_length / 2 * math.cos(math.radians(a_in_car_coord))
     y_in_sumo_coord = y_in_car_coord + car_length / 2 * math.sin(math.radians(a_in_car_coord))
     a_in_sumo_coord = -a_in_car_coord + 90.
-    return x_in_sumo_coord, y_in_sumo_coord, a_in_sumo_coord
+    return float(x_in_sumo_coord), float(y_in_sumo_coord), float(a_in_sumo_coord)  # libsumo only takes doubles
 
 
 def _convert_sumo_coord_to_car_coord(x_in_sumo_coord, y_in_sumo_coord, a_in_sumo_coord, car_length):
@@ -229,6 +249,111 @@ def _convert_sumo_coord_to_car_coord(x_in_sumo_coord, y_in_sumo_coord, a_in_sumo
     return x_in_car_coord, y_in_car_coord, deal_with_phi(a_in_car_coord)
 
 
+def conflict_mask(xs, ys, phis, vs, ls, n_ego_dict):
+    """vehicles in the way of an ego or with an ego in their way, these are removed when an ego is spawned"""
+    is_conflict = np.zeros(len(xs), dtype=bool)
+    for ego_dict in n_ego_dict.values():
+        ego_rad, veh_rads = ego_dict['phi'] * math.pi / 180, phis * math.pi / 180
+        dxs, dys = xs - ego_dict['x'], ys - ego_dict['y']
+        xs_in_ego_coord = dxs * math.cos(ego_rad) + dys * math.sin(ego_rad)
+        ys_in_ego_coord = -dxs * math.sin(ego_rad) + dys * math.cos(ego_rad)
+        ego_xs_in_veh_coord = -dxs * np.cos(veh_rads) - dys * np.sin(veh_rads)
+        ego_ys_in_veh_coord = dxs * np.sin(veh_rads) - dys * np.cos(veh_rads)
+        is_conflict |= ((-5 < xs_in_ego_coord) &
+                        (xs_in_ego_coord < ego_dict['v_x'] + ego_dict['l'] / 2. + ls / 2. + 2) &
+                        (np.abs(ys_in_ego_coord) < 3)) | \
+                       ((-5 < ego_xs_in_veh_coord) &
+                        (ego_xs_in_veh_coord < vs + ego_dict['l'] / 2. + ls / 2. + 2) &
+                        (np.abs(ego_ys_in_veh_coord) < 3))
+    return is_conflict
+
+
+COLLISION_CHECK_RANGE = 10.  # m, only vehicles within this box distance of an ego are checked
+GRID_NEIGHBOURS = np.array([(dx, dy) for dx in (-1, 0, 1) for dy in (-1, 0, 1)])
+
+
+def collision_check_grid(ego_table, veh_table, ego_rows=None, cell_size=COLLISION_CHECK_RANGE):
+    """the two-circle test of Traffic.collision_check for all egos at once. The vehicles are bucketed into a uniform
+    grid of cell_size and every ego is only tested against the vehicles in the 3x3 cells around its own.
+    ego_table [E, 5] and veh_table [N, 5] are x, y, phi, l, w, ego_rows gives the row of each ego in veh_table
+    (-1 if it is not in there) so that an ego is not tested against itself.
+    Returns the [E] collision flags and the ego and vehicle indexes of the colliding pairs"""
+    assert cell_size >= COLLISION_CHECK_RANGE, 'the 3x3 cells must cover the check range'
+    ego_table = np.asarray(ego_table, dtype=np.float64).reshape(-1, 5)
+    veh_table = np.asarray(veh_table, dtype=np.float64).reshape(-1, 5)
+    num_egos = len(ego_table)
+    if num_egos == 0 or len(veh_table) == 0:
+        return np.zeros((num_egos,), dtype=bool), np.zeros((0,), dtype=np.int64), np.zeros((0,), dtype=np.int64)
+
+    # cell -> key in the bounding box of all cells and their neighbours, the vehicles are sorted by key
+    cells = np.floor(veh_table[:, :2] / cell_size).astype(np.int64)
+    ego_cells = np.floor(ego_table[:, :2] / cell_size).astype(np.int64)
+    origin = np.minimum(cells.min(axis=0), ego_cells.min(axis=0)) - 1
+    num_rows = max(cells[:, 1].max(), ego_cells[:, 1].max()) - origin[1] + 2
+    keys = (cells[:, 0] - origin[0]) * num_rows + cells[:, 1] - origin[1]
+    order = np.argsort(keys, kind='stable')
+    sorted_keys = keys[order]
+    neighbour_cells = ego_cells[:, np.newaxis, :] + GRID_NEIGHBOURS  # [E, 9, 2]
+    neighbour_keys = ((neighbour_cells[..., 0] - origin[0]) * num_rows + neighbour_cells[..., 1] - origin[1]).ravel()
+    starts = np.searchsorted(sorted_keys, neighbour_keys, side='left')
+    counts = np.searchsorted(sorted_keys, neighbour_keys, side='right') - starts
+
+    # candidate pairs, one per vehicle in a neighbour cell of an ego
+    ego_index = np.repeat(np.repeat(np.arange(num_egos), len(GRID_NEIGHBOURS)), counts)
+    in_cell_index = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+    veh_index = order[np.repeat(starts, counts) + in_cell_index]
+    if ego_rows is not None:
+        is_other = veh_index != np.asarray(ego_rows)[ego_index]
+        ego_index, veh_index = ego_index[is_other], veh_index[is_other]
+    egos, vehs = ego_table[ego_index], veh_table[veh_index]
+    is_near = (np.abs(vehs[:, 0] - egos[:, 0]) < COLLISION_CHECK_RANGE) & \
+              (np.abs(vehs[:, 1] - egos[:, 1]) < COLLISION_CHECK_RANGE)
+    ego_index, veh_index, egos, vehs = ego_index[is_near], veh_index[is_near], egos[is_near], vehs[is_near]
+
+    def two_circles(table):  # [P, 2] centers of the front and rear circles
+        lws = (table[:, 3] - table[:, 4]) / 2
+        rads = table[:, 2] / 180 * math.pi
+        signs = np.array([1., -1.])
+        return table[:, 0:1] + signs * (np.cos(rads) * lws)[:, np.newaxis], \
+            table[:, 1:2] + signs * (np.sin(rads) * lws)[:, np.newaxis]
+
+    ego_circle_xs, ego_circle_ys = two_circles(egos)
+    veh_circle_xs, veh_circle_ys = two_circles(vehs)
+    square_dists = np.square(ego_circle_xs[:, :, np.newaxis] - veh_circle_xs[:, np.newaxis, :]) + \
+                   np.square(ego_circle_ys[:, :, np.newaxis] - veh_circle_ys[:, np.newaxis, :])
+    collision_check_dis = ((vehs[:, 4] + egos[:, 4]) / 2 + 0.5) ** 2
+    is_collided = np.any(square_dists < collision_check_dis[:, np.newaxis, np.newaxis], axis=(1, 2))
+    ego_index, veh_index = ego_index[is_collided], veh_index[is_collided]
+    return np.bincount(ego_index, minlength=num_egos) > 0, ego_index, veh_index
+
+
+def n_ego_collision_check(others, n_ego_dict, other_ids=None):
+    """checks the egos of n_ego_dict against each other and the vehicles others (xs, ys, phis, ls, ws).
+    Returns egoID -> collision flag and egoID -> ids of the colliding vehicles, i.e. their other_ids (default their
+    index in others) or the egoID of the colliding egos"""
+    ego_ids = list(n_ego_dict.keys())
+    ego_table = np.array([[n_ego_dict[egoID][key] for key in ['x', 'y', 'phi', 'l', 'w']] for egoID in ego_ids],
+                         dtype=np.float64).reshape(-1, 5)
+    veh_table = np.concatenate([np.stack(others, axis=1).reshape(-1, 5), ego_table])
+    num_others = len(veh_table) - len(ego_ids)
+    flags, ego_index, veh_index = collision_check_grid(ego_table, veh_table,
+                                                       ego_rows=num_others + np.arange(len(ego_ids)))
+    ids = (list(other_ids) if other_ids is not None else list(range(num_others))) + ego_ids
+    n_ego_collision_ids = {egoID: [] for egoID in ego_ids}
+    for i, j in zip(ego_index.tolist(), veh_index.tolist()):
+        n_ego_collision_ids[ego_ids[i]].append(ids[j])
+    return dict(zip(ego_ids, flags.tolist())), n_ego_collision_ids
+
+
+def _convert_sumo_coord_to_car_coord_batch(xs_in_sumo_coord, ys_in_sumo_coord, as_in_sumo_coord, car_lengths):
+    """_convert_sumo_coord_to_car_coord on arrays"""
+    as_in_car_coord = -as_in_sumo_coord + 90.
+    xs_in_car_coord = xs_in_sumo_coord - (np.cos(as_in_car_coord / 180. * math.pi) * car_lengths / 2)
+    ys_in_car_coord = ys_in_sumo_coord - (np.sin(as_in_car_coord / 180. * math.pi) * car_lengths / 2)
+    # deal_with_phi, to (-180, 180]
+    return xs_in_car_coord, ys_in_car_coord, as_in_car_coord - 360. * np.ceil((as_in_car_coord - 180.) / 360.)
+
+
 def deal_with_phi(phi):
     while phi > 180:
         phi -= 360
@@ -237,5 +362,33 @@ def deal_with_phi(phi):
     return phi
 
 
+# radii of the turns of the surrounding vehicles inside the intersection, as assumed by their prediction
+LEFT_TURN_RADIUS = CROSSROAD_SIZE/2 + 0.5*LANE_WIDTH
+RIGHT_TURN_RADIUS = CROSSROAD_SIZE/2 - 2.5*LANE_WIDTH  # TODO：ONLY FOR 3LANE
+
+
+def veh_turn_radii(veh_mode_list):
+    """signed turn radius of every vehicle slot, positive for left turns and inf for the straight modes"""
+    return np.array([LEFT_TURN_RADIUS if mode in ['dl', 'rd', 'ur', 'lu'] else
+                     -RIGHT_TURN_RADIUS if mode in ['dr', 'ru', 'ul', 'ld'] else np.inf
+                     for mode in veh_mode_list], dtype=np.float32)
+
+
+def predict_vehs(vehs, turn_radii, frequency, xp=np):
+    """one step of the constant-speed prediction of the surrounding vehicles, which turn with the radius of their
+    slot while inside the intersection. vehs [..., N, 4] of x, y, v, phi (deg), turn_radii [N] of veh_turn_radii,
+    xp is np or tf, the module whose ops are used. shared by the models and the mpc planners"""
+    xs, ys, vs, phis = vehs[..., 0], vehs[..., 1], vehs[..., 2], vehs[..., 3]
+    phis_rad = phis * np.pi / 180.
+    in_crossroad = xp.logical_and(xp.logical_and(xs > -CROSSROAD_SIZE/2, xs < CROSSROAD_SIZE/2),
+                                  xp.logical_and(ys > -CROSSROAD_SIZE/2, ys < CROSSROAD_SIZE/2))
+    next_xs = xs + vs / frequency * xp.cos(phis_rad)
+    next_ys = ys + vs / frequency * xp.sin(phis_rad)
+    next_phis_rad = phis_rad + xp.where(in_crossroad, (vs / turn_radii) / frequency, xp.zeros_like(vs))
+    next_phis_rad = xp.where(next_phis_rad > np.pi, next_phis_rad - 2 * np.pi, next_phis_rad)
+    next_phis_rad = xp.where(next_phis_rad <= -np.pi, next_phis_rad + 2 * np.pi, next_phis_rad)
+    return xp.stack([next_xs, next_ys, vs, next_phis_rad * 180 / np.pi], -1)
+
+
 if __name__ == '__main__':
     pass
@@ -22,6 +22,7 @@ from dynamics_and_models import EnvironmentModel, ReferencePath
 from endtoend import CrossroadEnd2end
 from endtoend_env_utils import rotate_coordination, CROSSROAD_SIZE, LANE_WIDTH, LANE_NUMBER, MODE2TASK
 from hierarchical_decision.multi_path_generator import MultiPathGenerator
+from profiler import PROFILER
 from utils.load_policy import LoadPolicy
 from utils.misc import TimerStat, image2video
 from utils.recorder import Recorder
@@ -83,18 +84,13 @@ class HierarchicalDecision(object):
     # def is_safe(self, obs, path_index):
     #     self.model.ref_path.set_path(path_index)
     #     action = self.policy.run_batch(obs)
-    #     veh2veh4real = self.model.ss(obs, action, lam=0.1)
+    #     veh2veh4real, _ = self.model.ss(obs, action, lam=0.1)
     #     return False if veh2veh4real[0] > 0 else True
 
-    @tf.function
     def is_safe(self, obs, path_index):
         self.model.add_traj(obs, path_index)
-        punish = 0.
-        for step in range(5):
-            action = self.policy.run_batch(obs)
-            obs, _, _, _, veh2veh4real, _ = self.model.rollout_out(action)
-            punish += veh2veh4real[0]
-        return False if punish > 0 else True
+        _, _, _, _, veh2veh4real, _ = self.model.rollout(obs, self.policy.run_batch, 5)
+        return False if tf.reduce_sum(veh2veh4real[:, 0]) > 0 else True
 
     def safe_shield(self, real_obs, path_index):
         action_safe_set = [[[0., -1.]]]
@@ -106,6 +102,7 @@ class HierarchicalDecision(object):
         else:
             return self.policy.run_batch(real_obs).numpy()[0], False
 
+    @PROFILER.timed('hier_decision.step')
     def step(self):
         self.step_counter += 1
         with self.step_timer:
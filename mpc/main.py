@@ -10,6 +10,7 @@ import seaborn as sns
 from numpy import logical_and
 from scipy.optimize import minimize
 
+from endtoend_env_utils import veh_turn_radii, predict_vehs
 from multi_env.multi_ego import LoadPolicy
 
 
@@ -399,35 +400,8 @@ class ModelPredictiveControl:
             assert self.task == 'right'
             veh_mode_list = ['dr'] * 2 + ['ur'] * 3 + ['lr'] * 3
 
-        predictions_to_be_concat = []
-
-        for vehs_index in range(len(veh_mode_list)):
-            predictions_to_be_concat.append(self.predict_for_a_mode(
-                veh_infos[:, vehs_index * self.per_veh_info_dim:(vehs_index + 1) * self.per_veh_info_dim],
-                veh_mode_list[vehs_index]))
-        return np.concatenate(predictions_to_be_concat, 1)
-
-    def predict_for_a_mode(self, vehs, mode):
-        veh_xs, veh_ys, veh_vs, veh_phis = vehs[:, 0], vehs[:, 1], vehs[:, 2], vehs[:, 3]
-        veh_phis_rad = veh_phis * np.pi / 180.
-
-        zeros = np.zeros_like(veh_xs)
-
-        veh_xs_delta = veh_vs / self.fre * np.cos(veh_phis_rad)
-        veh_ys_delta = veh_vs / self.fre * np.sin(veh_phis_rad)
-
-        if mode in ['dl', 'rd', 'ur', 'lu']:
-            veh_phis_rad_delta = np.where(-18 < veh_xs < 18, (veh_vs / 19.875) / self.fre, zeros)
-        elif mode in ['dr', 'ru', 'ul', 'ld']:
-            veh_phis_rad_delta = np.where(-18 < veh_ys < 18, -(veh_vs / 12.375) / self.fre, zeros)
-        else:
-            veh_phis_rad_delta = zeros
-        next_veh_xs, next_veh_ys, next_veh_vs, next_veh_phis_rad = \
-            veh_xs + veh_xs_delta, veh_ys + veh_ys_delta, veh_vs, veh_phis_rad + veh_phis_rad_delta
-        next_veh_phis_rad = np.where(next_veh_phis_rad > np.pi, next_veh_phis_rad - 2 * np.pi, next_veh_phis_rad)
-        next_veh_phis_rad = np.where(next_veh_phis_rad <= -np.pi, next_veh_phis_rad + 2 * np.pi, next_veh_phis_rad)
-        next_veh_phis = next_veh_phis_rad * 180 / np.pi
-        return np.stack([next_veh_xs, next_veh_ys, next_veh_vs, next_veh_phis], 1)
+        vehs = veh_infos.reshape(len(veh_infos), -1, self.per_veh_info_dim)
+        return predict_vehs(vehs, veh_turn_radii(veh_mode_list), self.fre).reshape(len(veh_infos), -1)
 
     def plant_model(self, u, x):
         x_copy = x.copy()
@@ -15,7 +15,8 @@ from casadi import *
 from endtoend import CrossroadEnd2end
 from dynamics_and_models import ReferencePath, EnvironmentModel
 from hierarchical_decision.multi_path_generator import StaticTrajectoryGenerator_origin
-from endtoend_env_utils import CROSSROAD_SIZE, L, W, VEHICLE_MODE_LIST, LANE_WIDTH, LANE_NUMBER, rotate_coordination
+from endtoend_env_utils import CROSSROAD_SIZE, L, W, VEHICLE_MODE_LIST, LANE_WIDTH, LANE_NUMBER, rotate_coordination, \
+    veh_turn_radii, predict_vehs
 from mpc.main import TimerStat
 from utils.load_policy import LoadPolicy
 from utils.recorder import Recorder
@@ -28,11 +29,6 @@ def deal_with_phi_casa(phi):
     return phi
 
 
-def deal_with_phi(phi):
-    phi = if_else(phi > 180, phi - 360, if_else(phi < -180, phi + 360, phi))
-    return phi
-
-
 class VehicleDynamics(object):
     def __init__(self, ):
         self.vehicle_params = dict(C_f=-128915.5,  # front wheel cornering stiffness [N/rad]
@@ -84,6 +80,7 @@ class Dynamics(object):
         self.per_veh_info_dim = per_veh_info_dim
         self.vd = VehicleDynamics()
         self.veh_mode_list = veh_mode_list
+        self.veh_turn_radii = veh_turn_radii(veh_mode_list)
         self.vehs = x_init[6+3*(1+num_future_data):]
         self.x_init = x_init
         path = ReferencePath(task)
@@ -153,34 +150,8 @@ class Dynamics(object):
                     if_else(y < -CROSSROAD_SIZE / 2, out1[2], if_else(x > CROSSROAD_SIZE / 2, out2[2], out3[2]))]
 
     def vehs_pred(self):
-        predictions = []
-        for vehs_index in range(len(self.veh_mode_list)):
-            predictions += \
-                self.predict_for_a_mode(
-                    self.vehs[vehs_index * self.per_veh_info_dim:(vehs_index + 1) * self.per_veh_info_dim],
-                    self.veh_mode_list[vehs_index])
-        self.vehs = predictions
-
-    def predict_for_a_mode(self, vehs, mode):
-        veh_x, veh_y, veh_v, veh_phi = vehs[0], vehs[1], vehs[2], vehs[3]
-        veh_phis_rad = veh_phi * np.pi / 180.
-        veh_x_delta = veh_v * self.tau * math.cos(veh_phis_rad)
-        veh_y_delta = veh_v * self.tau * math.sin(veh_phis_rad)
-
-        if mode in ['dl', 'rd', 'ur', 'lu']:
-            veh_phi_rad_delta = (veh_v / (CROSSROAD_SIZE/2+0.5*LANE_WIDTH)) * self.tau if -CROSSROAD_SIZE/2 < veh_x < CROSSROAD_SIZE/2 \
-                                                             and -CROSSROAD_SIZE/2 < veh_y < CROSSROAD_SIZE/2 else 0
-        elif mode in ['dr', 'ru', 'ul', 'ld']:
-            veh_phi_rad_delta = -(veh_v / (CROSSROAD_SIZE/2-2.5*LANE_WIDTH)) * self.tau if -CROSSROAD_SIZE/2 < veh_x < CROSSROAD_SIZE/2 \
-                                                                and -CROSSROAD_SIZE/2 < veh_y < CROSSROAD_SIZE/2 else 0
-        else:
-            veh_phi_rad_delta = 0
-        next_veh_x, next_veh_y, next_veh_v, next_veh_phi_rad = \
-            veh_x + veh_x_delta, veh_y + veh_y_delta, veh_v, veh_phis_rad + veh_phi_rad_delta
-        next_veh_phi = next_veh_phi_rad * 180 / np.pi
-        next_veh_phi = deal_with_phi(next_veh_phi)
-
-        return [next_veh_x, next_veh_y, next_veh_v, next_veh_phi]
+        vehs = np.array(self.vehs, dtype=np.float64).reshape(-1, self.per_veh_info_dim)
+        self.vehs = predict_vehs(vehs, self.veh_turn_radii, 1. / self.tau).ravel().tolist()
 
     def f_xu(self, x, u):
         next_ego = self.vd.f_xu(x, u, self.tau)           # Unit of heading angle is degree
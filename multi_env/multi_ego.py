@@ -22,6 +22,7 @@ from endtoend import CrossroadEnd2end
 from endtoend_env_utils import rotate_coordination, cal_ego_info_in_transform_coordination, \
     cal_info_in_transform_coordination, CROSSROAD_SIZE, LANE_WIDTH, LANE_NUMBER
 from hierarchical_decision.multi_path_generator import MultiPathGenerator
+from profiler import PROFILER
 from traffic import Traffic
 from utils.load_policy import LoadPolicy
 from hierarchical_decision.hier_decision import select_and_rename_snapshots_of_an_episode
@@ -81,6 +82,7 @@ class MultiEgo(object):
                                                                                        self.n_ego_instance[egoID].dynamics.vehicle_params['miu'],
                                                                                        self.n_ego_instance[egoID].dynamics.vehicle_params['miu']])
 
+    @PROFILER.timed('multi_ego.get_next_n_ego_dynamics')
     def get_next_n_ego_dynamics(self, n_ego_vehicles, v_light):
         for egoID, ego_dynamics in self.n_ego_dynamics.items():
             rotate_angle = ROTATE_ANGLE[egoID[0]]
@@ -181,20 +183,15 @@ class MultiEgo(object):
     #     policy = self.TASK2MODEL[task]
     #     model.ref_path.set_path(path_index)
     #     action = policy.run_batch(obs)
-    #     veh2veh4real = model.ss(obs, action)
+    #     veh2veh4real, _ = model.ss(obs, action)
     #     return False if veh2veh4real[0] > 0 else True
 
-    @tf.function
     def is_safe(self, obs, path_index, task):
         model = self.virtual_model[task]
         policy = self.TASK2MODEL[task]
         model.add_traj(obs, path_index)
-        punish = 0.
-        for step in range(20):
-            action = policy.run_batch(obs)
-            obs, _, _, real_punish_term, _, _ = model.rollout_out(action)
-            punish += real_punish_term[0]
-        return False if punish > 0 else True
+        _, _, _, real_punish_term, _, _ = model.rollout(obs, policy.run_batch, 20)
+        return False if tf.reduce_sum(real_punish_term[:, 0]) > 0 else True
 
     def safe_shield(self, real_obs, path_index, egoID, task=None):
         action_safe_set = ([[0., -1.]],)
@@ -254,7 +251,7 @@ class Simulation(object):
         n_ego_done = self.multiego.judge_n_ego_done(current_n_ego_collision_flag)
         for egoID, flag_list in n_ego_done.items():
             if flag_list[0]:
-                print('Ego {} collision!'.format(egoID))
+                print('Ego {} collision with {}!'.format(egoID, self.traffic.n_ego_collision_ids.get(egoID)))
                 return 1
             elif flag_list[1]:
                 print('Ego {} achieve goal!'.format(egoID))
@@ -0,0 +1,145 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# =====================================
+# @Time    : 2021/04/12
+# @Author  : Yang Guan (Tsinghua Univ.)
+# @FileName: profiler.py
+# =====================================
+
+import functools
+import json
+import os
+import threading
+import time
+from collections import OrderedDict, deque
+
+import numpy as np
+
+
+class PhaseStat(object):
+    def __init__(self, window_size):
+        self.durations = deque(maxlen=window_size)  # s, rolling window used for the percentiles
+        self.self_durations = deque(maxlen=window_size)  # s, without the time spent in nested phases
+        self.count = 0
+        self.total_time = 0.
+
+    def push(self, duration, self_duration):
+        self.durations.append(duration)
+        self.self_durations.append(self_duration)
+        self.count += 1
+        self.total_time += duration
+
+
+class Profiler(object):
+    """opt-in timer of the phases of a step, disabled it costs one attribute check per timed call.
+    Phases are timed by decorating methods with PROFILER.timed(name), nested phases show up both in the
+    self time of the summary and as nested slices in the chrome trace (chrome://tracing or ui.perfetto.dev)"""
+    def __init__(self, window_size=1000, max_events=200000):
+        self.enabled = False
+        self.window_size = window_size
+        self.max_events = max_events
+        self.reset()
+
+    def reset(self):
+        self.stats = OrderedDict()
+        self.events = deque(maxlen=self.max_events)  # (name, start, duration), dropped from the left when full
+        self._child_times = []  # time spent in the nested phases, one entry per open phase
+        self._t0 = time.perf_counter()
+
+    def enable(self, reset=True):
+        if reset:
+            self.reset()
+        self.enabled = True
+
+    def disable(self):
+        self.enabled = False
+
+    def timed(self, name):
+        def decorator(fn):
+            @functools.wraps(fn)
+            def wrapper(*args, **kwargs):
+                if not self.enabled:
+                    return fn(*args, **kwargs)
+                self._child_times.append(0.)
+                start = time.perf_counter()
+                try:
+                    return fn(*args, **kwargs)
+                finally:
+                    duration = time.perf_counter() - start
+                    self._record(name, start, duration, duration - self._child_times.pop())
+            return wrapper
+        return decorator
+
+    def _record(self, name, start, duration, self_duration):
+        if self._child_times:
+            self._child_times[-1] += duration
+        if name not in self.stats:
+            self.stats[name] = PhaseStat(self.window_size)
+        self.stats[name].push(duration, self_duration)
+        self.events.append((name, start, duration))
+
+    def summary(self, percentiles=(50, 90, 99)):
+        """name -> count, mean/self mean and rolling percentiles of the duration, all in ms"""
+        out = OrderedDict()
+        for name, stat in self.stats.items():
+            durations = np.array(stat.durations) * 1000.
+            info = OrderedDict(count=stat.count,
+                               mean=stat.total_time / stat.count * 1000.,
+                               self_mean=float(np.mean(stat.self_durations)) * 1000.)
+            for q, value in zip(percentiles, np.percentile(durations, percentiles)):
+                info['p{}'.format(q)] = float(value)
+            out[name] = info
+        return out
+
+    def print_summary(self, percentiles=(50, 90, 99)):
+        summary = self.summary(percentiles)
+        columns = ['count', 'mean', 'self_mean'] + ['p{}'.format(q) for q in percentiles]
+        width = max([len(name) for name in summary] + [5])
+        print('{:<{w}}'.format('phase', w=width) + ''.join('{:>11}'.format(c) for c in columns) + '   (ms)')
+        for name, info in summary.items():
+            print('{:<{w}}'.format(name, w=width) + '{:>11d}'.format(info['count']) +
+                  ''.join('{:>11.3f}'.format(info[c]) for c in columns[1:]))
+
+    def export_chrome_trace(self, path):
+        """write the recorded events as complete ('X') trace events, times are in us"""
+        pid, tid = os.getpid(), threading.get_ident()
+        trace_events = [dict(name=name, cat=name.split('.')[0], ph='X', pid=pid, tid=tid,
+                             ts=(start - self._t0) * 1e6, dur=duration * 1e6)
+                        for name, start, duration in self.events]
+        with open(path, 'w') as f:
+            json.dump(dict(traceEvents=trace_events, displayTimeUnit='ms'), f)
+        return path
+
+
+PROFILER = Profiler()
+
+
+def test_profiler():
+    @PROFILER.timed('test.inner')
+    def inner():
+        time.sleep(0.001)
+
+    @PROFILER.timed('test.outer')
+    def outer():
+        inner()
+        time.sleep(0.002)
+
+    outer()
+    assert not PROFILER.stats
+    PROFILER.enable()
+    for _ in range(20):
+        outer()
+    PROFILER.disable()
+    PROFILER.print_summary()
+    print(PROFILER.export_chrome_trace('/tmp/profile_trace.json'))
+
+    disabled = PROFILER.timed('test.noop')(lambda: None)
+    start = time.perf_counter()
+    for _ in range(100000):
+        disabled()
+    print('disabled overhead per call: {:.3f}us'.format((time.perf_counter() - start) * 10))
+
+
+if __name__ == '__main__':
+    test_profiler()
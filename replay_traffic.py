@@ -0,0 +1,248 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# =====================================
+# @Time    : 2021/04/12
+# @Author  : Yang Guan (Tsinghua Univ.)
+# @FileName: replay_traffic.py
+# =====================================
+
+import json
+import os
+from collections import defaultdict, OrderedDict
+from math import sqrt
+
+import numpy as np
+
+from endtoend_env_utils import TRACE_DIR, ROUTE2MODE, MODE2ROUTE, MODE_LIST, MODE2ID, conflict_mask, \
+    n_ego_collision_check
+from profiler import PROFILER
+
+SIM_PERIOD = 1.0 / 10
+TRACE_COLUMNS = ['x', 'y', 'v', 'phi', 'l', 'w']
+# file name -> dtype of the flat arrays of a trace directory
+TRACE_FILES = OrderedDict([('vehicles', np.float32),  # [num_rows, len(TRACE_COLUMNS)]
+                           ('modes', np.int8),  # [num_rows], MODE2ID of the route, -1 if not in ROUTE2MODE
+                           ('ids', np.int32),  # [num_rows], the same sumo vehicle keeps its id along the trace
+                           ('counts', np.int16),  # [num_steps], number of rows of each step
+                           ('v_light', np.int8),  # [num_steps]
+                           ('episodes', np.int64)])  # first step of each recorded episode
+
+
+def _default_trace_dir(training_task):
+    return os.path.join(TRACE_DIR, training_task)
+
+
+class TraceWriter(object):
+    """appends the surrounding vehicles and the light of every step to the flat binary files of a trace directory,
+    the meta.json written by close() is what makes the trace loadable"""
+    def __init__(self, trace_dir, step_length):
+        self.trace_dir = trace_dir
+        self.step_length = step_length
+        os.makedirs(trace_dir, exist_ok=True)
+        meta_path = os.path.join(trace_dir, 'meta.json')
+        if os.path.exists(meta_path):
+            os.remove(meta_path)
+        self.files = {name: open(os.path.join(trace_dir, name + '.bin'), 'wb') for name in TRACE_FILES}
+        self.veh_ids = {}  # sumo id -> trace id
+        self.num_steps = 0
+        self.num_rows = 0
+
+    def add_episode_start(self):
+        self._write('episodes', [self.num_steps])
+
+    def add_step(self, vehicles, v_light):
+        """vehicles: sumo id -> dict(x, y, v, phi, l, w, route) as in Traffic._get_vehicles"""
+        rows = [[veh[key] for key in TRACE_COLUMNS] for veh in vehicles.values()]
+        self._write('vehicles', np.array(rows, dtype=np.float32).reshape(-1, len(TRACE_COLUMNS)))
+        self._write('modes', [MODE2ID[ROUTE2MODE[veh['route']]] if veh['route'] in ROUTE2MODE else -1
+                              for veh in vehicles.values()])
+        self._write('ids', [self.veh_ids.setdefault(veh_id, len(self.veh_ids)) for veh_id in vehicles])
+        self._write('counts', [len(rows)])
+        self._write('v_light', [v_light])
+        self.num_steps += 1
+        self.num_rows += len(rows)
+
+    def _write(self, name, values):
+        self.files[name].write(np.asarray(values, dtype=TRACE_FILES[name]).tobytes())
+
+    def close(self):
+        if self.files is None:
+            return
+        for f in self.files.values():
+            f.close()
+        self.files = None
+        with open(os.path.join(self.trace_dir, 'meta.json'), 'w') as f:
+            json.dump(dict(step_length=self.step_length, num_steps=self.num_steps, num_rows=self.num_rows,
+                           num_vehicles=len(self.veh_ids), columns=TRACE_COLUMNS), f)
+
+
+class Trace(object):
+    """read-only memory-mapped view of a trace directory"""
+    def __init__(self, trace_dir):
+        with open(os.path.join(trace_dir, 'meta.json')) as f:
+            self.meta = json.load(f)
+        assert self.meta['columns'] == TRACE_COLUMNS
+        self.step_length = self.meta['step_length']
+        self.num_steps = self.meta['num_steps']
+        arrays = {}
+        for name, dtype in TRACE_FILES.items():
+            path = os.path.join(trace_dir, name + '.bin')
+            # np.memmap can not map empty files
+            arrays[name] = np.memmap(path, dtype=dtype, mode='r') if os.path.getsize(path) \
+                else np.zeros((0,), dtype=dtype)
+        self.vehicles = arrays['vehicles'].reshape(-1, len(TRACE_COLUMNS))
+        self.modes, self.ids, self.v_light, self.episodes = \
+            arrays['modes'], arrays['ids'], arrays['v_light'], arrays['episodes']
+        self.offsets = np.zeros((self.num_steps + 1,), dtype=np.int64)
+        np.cumsum(arrays['counts'], out=self.offsets[1:])
+        assert self.offsets[-1] == len(self.vehicles) == self.meta['num_rows']
+
+    def rows(self, step):
+        return slice(self.offsets[step], self.offsets[step + 1])
+
+
+def record_trace(num_steps, trace_dir=None, step_length=100, mode='training', training_task='left',
+                 episode_steps=None):
+    """runs sumo without egos and writes its traffic to trace_dir (default trace_cache/<training_task>),
+    e.g. python -c "from replay_traffic import record_trace; record_trace(36000)" """
+    from traffic import Traffic
+    trace_dir = trace_dir or _default_trace_dir(training_task)
+    traffic = Traffic(step_length, mode, {}, training_task)
+    traffic.init_traffic({})
+    traffic.trace_writer = TraceWriter(trace_dir, step_length)
+    try:
+        for i in range(num_steps):
+            if episode_steps and i % episode_steps == 0:
+                traffic.trace_writer.add_episode_start()
+            traffic.sim_step()
+    finally:
+        traffic.trace_writer.close()
+        traffic.trace_writer = None
+    return trace_dir
+
+
+class ReplayTraffic(object):
+    """open-loop stand-in for traffic.Traffic serving a trace recorded from sumo, see record_trace and
+    Traffic.trace_writer. The recorded vehicles do not react to the egos, the ones in conflict with an ego at reset
+    are hidden for the episode as Traffic removes them. Episodes start at random steps drawn from seed, or at the
+    recorded episode starts in turn with replay_episodes, and wrap around at the end of the trace"""
+
+    def __init__(self, step_length, mode, init_n_ego_dict, training_task='left', trace_dir=None, seed=None,
+                 replay_episodes=False):
+        self.trace = Trace(trace_dir or _default_trace_dir(training_task))
+        assert self.trace.step_length == step_length, 'the trace is recorded with another step length'
+        assert self.trace.num_steps > 0
+        assert not replay_episodes or len(self.trace.episodes), 'the trace has no recorded episodes'
+        self.np_random = np.random.RandomState(seed)
+        self.replay_episodes = replay_episodes
+        self.num_episodes = 0
+        self.sim_time = 0
+        self.n_ego_vehicles = defaultdict(list)
+        self.step_length = step_length
+        self.collision_flag = False
+        self.n_ego_collision_flag = {}
+        self.n_ego_collision_ids = {}
+        self.collision_ego_id = None
+        self.v_light = None
+        self.n_ego_dict = init_n_ego_dict
+        self.mode = mode
+        self.training_task = training_task
+        self.trace_step = -1  # the trace step served by the last sim_step
+        self.hidden_ids = np.zeros((0,), dtype=np.int32)
+        self._others = None  # xs, ys, phis, ls, ws of the vehicles, for collision check
+        self._other_ids = None  # their trace ids
+
+    @PROFILER.timed('traffic.init_traffic')
+    def init_traffic(self, init_n_ego_dict):
+        self.sim_time = 0
+        self.n_ego_vehicles = defaultdict(list)
+        self.collision_flag = False
+        self.n_ego_collision_flag = {}
+        self.n_ego_collision_ids = {}
+        self.collision_ego_id = None
+        self.v_light = None
+        self.n_ego_dict = init_n_ego_dict
+        if self.replay_episodes:
+            start = int(self.trace.episodes[self.num_episodes % len(self.trace.episodes)])
+        else:
+            start = self.np_random.randint(self.trace.num_steps)
+        self.num_episodes += 1
+        # the next sim_step serves the start step
+        self.trace_step = start - 1
+        self.hidden_ids = np.zeros((0,), dtype=np.int32)
+        self._remove_conflict_vehicles(self.n_ego_dict, start % self.trace.num_steps)
+
+    def reset_ego(self, egoID, ego_dict):
+        """re-spawn a single ego in the running replay, other egos are left untouched"""
+        self.n_ego_dict[egoID] = ego_dict
+        self._remove_conflict_vehicles({egoID: ego_dict}, (self.trace_step + 1) % self.trace.num_steps)
+        self.n_ego_collision_flag[egoID] = False
+
+    def _remove_conflict_vehicles(self, n_ego_dict, step):
+        rows = self.trace.rows(step)
+        xs, ys, vs, phis, ls, ws = self.trace.vehicles[rows].astype(np.float64).T
+        is_conflict = conflict_mask(xs, ys, phis, vs, ls, n_ego_dict)
+        self.hidden_ids = np.union1d(self.hidden_ids, self.trace.ids[rows][is_conflict])
+
+    @PROFILER.timed('traffic.sim_step')
+    def sim_step(self):
+        self.sim_time += SIM_PERIOD
+        self.trace_step = (self.trace_step + 1) % self.trace.num_steps
+        self._get_vehicles()
+        self.v_light = int(self.trace.v_light[self.trace_step])
+        self.collision_check()
+        for egoID, collision_flag in self.n_ego_collision_flag.items():
+            if collision_flag:
+                self.collision_flag = True
+                self.collision_ego_id = egoID
+
+    @PROFILER.timed('traffic.set_own_car')
+    def set_own_car(self, n_ego_dict_):
+        assert len(self.n_ego_dict) == len(n_ego_dict_)
+        for egoID in self.n_ego_dict.keys():
+            for key in ['v_x', 'v_y', 'r', 'x', 'y', 'phi']:
+                self.n_ego_dict[egoID][key] = n_ego_dict_[egoID][key]
+
+    @PROFILER.timed('traffic.get_vehicles')
+    def _get_vehicles(self):
+        self.n_ego_vehicles = defaultdict(list)
+        rows = self.trace.rows(self.trace_step)
+        table = self.trace.vehicles[rows].astype(np.float64)
+        mode_ids, ids = self.trace.modes[rows], self.trace.ids[rows]
+        if len(self.hidden_ids):
+            visible = ~np.isin(ids, self.hidden_ids)
+            table, mode_ids, ids = table[visible], mode_ids[visible], ids[visible]
+        xs, ys, vs, phis, ls, ws = table.T
+        self._others = xs, ys, phis, ls, ws
+        self._other_ids = ids.tolist()
+        # the dicts are shared by the egos and must not be modified
+        vehicles = [dict(x=x, y=y, v=v, phi=phi, l=l, w=w, route=MODE2ROUTE[MODE_LIST[mode_id]] if mode_id >= 0 else ())
+                    for (x, y, v, phi, l, w), mode_id in zip(table.tolist(), mode_ids.tolist())]
+        for egoID in self.n_ego_dict.keys():
+            self.n_ego_vehicles[egoID] = vehicles + \
+                [dict(x=ego_dict['x'], y=ego_dict['y'], v=sqrt(ego_dict['v_x'] ** 2 + ego_dict['v_y'] ** 2),
+                      phi=ego_dict['phi'], l=ego_dict['l'], w=ego_dict['w'], route=MODE2ROUTE[ego_dict['routeID']])
+                 for other_egoID, ego_dict in self.n_ego_dict.items() if other_egoID != egoID]
+
+    @PROFILER.timed('traffic.collision_check')
+    def collision_check(self):  # True: collision
+        self.n_ego_collision_flag, self.n_ego_collision_ids = \
+            n_ego_collision_check(self._others, self.n_ego_dict, self._other_ids)
+
+
+def test_replay_traffic():
+    import time
+    trace_dir = record_trace(600, trace_dir='/tmp/replay_test_trace', episode_steps=200)
+    init_state = dict(ego=dict(v_x=8., v_y=0, r=0, x=1.875, y=-30, phi=90, l=4.8, w=2.2, routeID='dl'))
+    traffic = ReplayTraffic(100., mode='training', init_n_ego_dict=init_state, trace_dir=trace_dir, seed=0)
+    traffic.init_traffic(init_state)
+    start = time.time()
+    for i in range(1000):
+        traffic.sim_step()
+    print('{} vehicles, time per step: {:.6f}s'.format(len(traffic.n_ego_vehicles['ego']),
+                                                       (time.time() - start) / 1000))
+
+
+if __name__ == "__main__":
+    test_replay_traffic()
@@ -0,0 +1,329 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# =====================================
+# @Time    : 2020/11/08
+# @Author  : Yang Guan (Tsinghua Univ.)
+# @FileName: surrogate_traffic.py
+# =====================================
+
+import os
+import random
+import xml.etree.ElementTree as ET
+from collections import defaultdict
+from math import sqrt, pi
+
+import numpy as np
+
+from endtoend_env_utils import SUMOCFG_DIR, TASK2ROUTEID, ROUTE2MODE, MODE2ROUTE, MODE_LIST, MODE2ID, \
+    conflict_mask, n_ego_collision_check
+from profiler import PROFILER
+
+SIM_PERIOD = 1.0 / 10
+ROUTE_SAMPLE_DS = 0.5  # m, resolution of the resampled route shapes
+EGO_ON_ROUTE_DIST = 2.  # an ego closer than this to a route blocks the vehicles behind it on that route
+LIGHT_GO, LIGHT_YELLOW, LIGHT_RED = 0, 1, 2
+
+
+def _parse_shape(shape):
+    return np.array([[float(v) for v in point.split(',')] for point in shape.split()])
+
+
+def _load_scenario(sumocfg_dir=SUMOCFG_DIR):
+    """routes (indexed as MODE_LIST), signal plan, and flows of the sumo scenario"""
+    sumo_dir = os.path.dirname(sumocfg_dir)
+    cfg = ET.parse(sumocfg_dir).getroot()
+    net = ET.parse(os.path.join(sumo_dir, cfg.find('input/net-file').get('value'))).getroot()
+    rou = ET.parse(os.path.join(sumo_dir, cfg.find('input/route-files').get('value'))).getroot()
+
+    # every route has its own incoming lane, junction lane and outgoing lane
+    lane_shapes = {lane.get('id'): _parse_shape(lane.get('shape')) for lane in net.iter('lane')}
+    route_shapes, link_indexes, stop_line_s = [None] * len(MODE_LIST), [None] * len(MODE_LIST), [None] * len(MODE_LIST)
+    for conn in net.iter('connection'):
+        route = conn.get('from'), conn.get('to')
+        if route not in ROUTE2MODE:
+            continue
+        route_id = MODE2ID[ROUTE2MODE[route]]
+        in_shape = lane_shapes['{}_{}'.format(route[0], conn.get('fromLane'))]
+        out_shape = lane_shapes['{}_{}'.format(route[1], conn.get('toLane'))]
+        route_shapes[route_id] = np.concatenate([in_shape, lane_shapes[conn.get('via')][1:], out_shape[1:]])
+        link_indexes[route_id] = int(conn.get('linkIndex'))
+        stop_line_s[route_id] = np.sum(np.hypot(*np.diff(in_shape, axis=0).T))
+
+    light2code = dict(G=LIGHT_GO, g=LIGHT_GO, Y=LIGHT_YELLOW, y=LIGHT_YELLOW, r=LIGHT_RED)
+    phases = [phase for phase in net.find('tlLogic').iter('phase')]
+    phase_durations = np.array([float(phase.get('duration')) for phase in phases])
+    phase_route_lights = np.array([[light2code[phase.get('state')[link_index]] for link_index in link_indexes]
+                                   for phase in phases])
+
+    vtypes = {vtype.get('id'): vtype for vtype in rou.iter('vType')}
+    flows = []
+    for flow in rou.iter('flow'):
+        vtype = vtypes[flow.get('type')]
+        flows.append([MODE2ID[ROUTE2MODE[(flow.get('from'), flow.get('to'))]],
+                      float(flow.get('vehsPerHour')) / 3600.,
+                      float(vtype.get('length')), float(vtype.get('width')), float(vtype.get('maxSpeed')),
+                      float(vtype.get('accel')), float(vtype.get('decel')), float(vtype.get('emergencyDecel')),
+                      float(vtype.get('tau')), float(vtype.get('minGap'))])
+    return route_shapes, np.array(stop_line_s), phase_durations, phase_route_lights, np.array(flows)
+
+
+def _resample_routes(route_shapes, ds):
+    # [route_num, sample_num, 2] points every ds meters along the routes and their headings in deg,
+    # routes shorter than the longest one repeat their end
+    route_lens = np.array([np.sum(np.hypot(*np.diff(shape, axis=0).T)) for shape in route_shapes])
+    sample_num = int(np.ceil(route_lens.max() / ds)) + 2
+    route_xy = np.zeros((len(route_shapes), sample_num, 2))
+    route_phi = np.zeros((len(route_shapes), sample_num))
+    for route_id, shape in enumerate(route_shapes):
+        shape_s = np.concatenate([[0.], np.cumsum(np.hypot(*np.diff(shape, axis=0).T))])
+        sample_s = np.minimum(np.arange(sample_num) * ds, route_lens[route_id])
+        route_xy[route_id, :, 0] = np.interp(sample_s, shape_s, shape[:, 0])
+        route_xy[route_id, :, 1] = np.interp(sample_s, shape_s, shape[:, 1])
+        last = int(route_lens[route_id] / ds)
+        deltas = np.diff(route_xy[route_id, :last + 1], axis=0)
+        route_phi[route_id, :last] = np.arctan2(deltas[:, 1], deltas[:, 0]) * 180 / pi
+        route_phi[route_id, last:] = route_phi[route_id, last - 1]
+    return route_xy, route_phi, route_lens
+
+
+ROUTE_SHAPES, STOP_LINE_S, PHASE_DURATIONS, PHASE_ROUTE_LIGHTS, FLOWS = _load_scenario()
+ROUTE_XY, ROUTE_PHI, ROUTE_LENS = _resample_routes(ROUTE_SHAPES, ROUTE_SAMPLE_DS)
+ROUTE_XS, ROUTE_YS = np.ascontiguousarray(ROUTE_XY[:, :, 0]), np.ascontiguousarray(ROUTE_XY[:, :, 1])
+ROUTES = [MODE2ROUTE[mode] for mode in MODE_LIST]
+# columns of FLOWS
+FLOW_ROUTE_IDS = FLOWS[:, 0].astype(int)
+FLOW_RATES, FLOW_L, FLOW_W, FLOW_V0, FLOW_A, FLOW_B, FLOW_EMERGENCY_B, FLOW_T, FLOW_S0 = FLOWS[:, 1:].T
+
+
+class SurrogateTraffic(object):
+    """SUMO-free stand-in for traffic.Traffic. The flows of cross.rou.xml arrive as poisson processes at a random
+    position of their incoming lane, follow their route with IDM and stop for the signal plan of a.net.xml.
+    Vehicles do not change lanes or yield to each other in the junction, egos block the routes they are on."""
+
+    def __init__(self, step_length, mode, init_n_ego_dict, training_task='left'):  # mode 'display' or 'training'
+        self.random_traffic = None
+        self.sim_time = 0
+        self.n_ego_vehicles = defaultdict(list)
+        self.step_length = step_length
+        self.step_time = float(step_length) / 1000
+        self.collision_flag = False
+        self.n_ego_collision_flag = {}
+        self.n_ego_collision_ids = {}
+        self.collision_ego_id = None
+        self.v_light = None
+        self.n_ego_dict = init_n_ego_dict
+
+        self.mode = mode
+        self.training_light_phase = 0
+        self.training_task = training_task
+        self.ego_route = TASK2ROUTEID[self.training_task]
+        if training_task == 'right':
+            if random.random() > 0.5:
+                self.training_light_phase = 2
+
+        # vehicle states, the static params are looked up by flow id
+        self.flow_ids = np.zeros((0,), dtype=int)
+        self.s = np.zeros((0,))
+        self.v = np.zeros((0,))
+        self.pending = np.zeros((len(FLOWS),), dtype=int)  # arrivals waiting for a free insertion place
+        self.light_phase = 0
+        self.light_time = 0.
+        self._others = None  # xs, ys, phis, ls, ws of the vehicles, for collision check
+
+        for i in range(int(round(100 / self.step_time))):  # warm up as Traffic does
+            self._set_light_phase(2 if i * self.step_time < 80 else 0)
+            self._step_vehicles({})
+
+    @PROFILER.timed('traffic.init_traffic')
+    def init_traffic(self, init_n_ego_dict):
+        self.sim_time = 0
+        self.n_ego_vehicles = defaultdict(list)
+        self.collision_flag = False
+        self.n_ego_collision_flag = {}
+        self.n_ego_collision_ids = {}
+        self.collision_ego_id = None
+        self.v_light = None
+        self.training_light_phase = 0
+        if self.training_task == 'right':
+            if random.random() > 0.5:
+                self.training_light_phase = 2
+        self.n_ego_dict = init_n_ego_dict
+        self._set_light_phase(self.training_light_phase)
+        self._step_vehicles(self.n_ego_dict)
+        self._remove_conflict_vehicles(self.n_ego_dict)
+
+    def reset_ego(self, egoID, ego_dict):
+        """re-spawn a single ego in the running simulation, without stepping it, other egos are left untouched"""
+        self.n_ego_dict[egoID] = ego_dict
+        self._remove_conflict_vehicles({egoID: ego_dict})
+        self.n_ego_collision_flag[egoID] = False
+
+    @PROFILER.timed('traffic.sim_step')
+    def sim_step(self):
+        self.sim_time += SIM_PERIOD
+        if self.mode == 'training':
+            self._set_light_phase(self.training_light_phase)
+        else:
+            self._step_light()
+        self._step_vehicles(self.n_ego_dict)
+        self._get_vehicles()
+        self._get_traffic_light()
+        self.collision_check()
+        for egoID, collision_flag in self.n_ego_collision_flag.items():
+            if collision_flag:
+                self.collision_flag = True
+                self.collision_ego_id = egoID
+
+    @PROFILER.timed('traffic.set_own_car')
+    def set_own_car(self, n_ego_dict_):
+        assert len(self.n_ego_dict) == len(n_ego_dict_)
+        for egoID in self.n_ego_dict.keys():
+            for key in ['v_x', 'v_y', 'r', 'x', 'y', 'phi']:
+                self.n_ego_dict[egoID][key] = n_ego_dict_[egoID][key]
+
+    def _set_light_phase(self, phase):
+        self.light_phase = phase
+        self.light_time = 0.
+
+    def _step_light(self):
+        self.light_time += self.step_time
+        if self.light_time >= PHASE_DURATIONS[self.light_phase]:
+            self._set_light_phase((self.light_phase + 1) % len(PHASE_DURATIONS))
+
+    def _get_traffic_light(self):
+        self.v_light = self.light_phase
+
+    def _positions(self):
+        route_ids = FLOW_ROUTE_IDS[self.flow_ids]
+        sample_indexs = self.s / ROUTE_SAMPLE_DS
+        lower = np.minimum(sample_indexs.astype(int), ROUTE_XY.shape[1] - 2)
+        ratios = (sample_indexs - lower)[:, np.newaxis]
+        xys = ROUTE_XY[route_ids, lower] * (1. - ratios) + ROUTE_XY[route_ids, lower + 1] * ratios
+        return xys[:, 0], xys[:, 1], ROUTE_PHI[route_ids, lower]
+
+    def _keep(self, mask):
+        self.flow_ids, self.s, self.v = self.flow_ids[mask], self.s[mask], self.v[mask]
+
+    def _ego_blockers(self, n_ego_dict):
+        # route ids, positions, speeds and lengths of the egos projected onto every route they are close to
+        route_ids, ss, vs, ls = [], [], [], []
+        for ego_dict in n_ego_dict.values():
+            dists = np.square(ROUTE_XS - ego_dict['x']) + np.square(ROUTE_YS - ego_dict['y'])
+            sample_indexs = np.argmin(dists, axis=1)
+            on_routes = np.flatnonzero(dists[np.arange(len(ROUTE_XS)), sample_indexs] < EGO_ON_ROUTE_DIST ** 2)
+            route_ids.append(on_routes)
+            ss.append(np.minimum(sample_indexs[on_routes] * ROUTE_SAMPLE_DS, ROUTE_LENS[on_routes]))
+            vs.append(np.full(len(on_routes), sqrt(ego_dict['v_x'] ** 2 + ego_dict['v_y'] ** 2)))
+            ls.append(np.full(len(on_routes), ego_dict['l']))
+        if not route_ids:
+            return np.zeros((0,), dtype=int), np.zeros((0,)), np.zeros((0,)), np.zeros((0,))
+        return np.concatenate(route_ids), np.concatenate(ss), np.concatenate(vs), np.concatenate(ls)
+
+    def _step_vehicles(self, n_ego_dict):
+        blocker_route_ids, blocker_ss, blocker_vs, blocker_ls = self._ego_blockers(n_ego_dict)
+        veh_num = len(self.s)
+        route_ids = FLOW_ROUTE_IDS[self.flow_ids]
+        ls, v0s, a_maxs, bs, Ts, s0s = FLOW_L[self.flow_ids], FLOW_V0[self.flow_ids], FLOW_A[self.flow_ids], \
+                                       FLOW_B[self.flow_ids], FLOW_T[self.flow_ids], FLOW_S0[self.flow_ids]
+
+        # leader: the next vehicle or ego on the same route
+        all_route_ids = np.concatenate([route_ids, blocker_route_ids])
+        all_ss, all_vs, all_ls = np.concatenate([self.s, blocker_ss]), np.concatenate([self.v, blocker_vs]), \
+                                 np.concatenate([ls, blocker_ls])
+        order = np.lexsort((all_ss, all_route_ids))
+        same_route = all_route_ids[order[1:]] == all_route_ids[order[:-1]]
+        followers, leaders = order[:-1][same_route], order[1:][same_route]
+        gaps, leader_vs = np.full(len(all_ss), np.inf), np.zeros(len(all_ss))
+        gaps[followers] = all_ss[leaders] - all_ss[followers] - (all_ls[leaders] + all_ls[followers]) / 2.
+        leader_vs[followers] = all_vs[leaders]
+        gaps, leader_vs = gaps[:veh_num], leader_vs[:veh_num]
+
+        # the stop line acts as a standing leader on red, and on yellow if it is still possible to stop
+        lights = PHASE_ROUTE_LIGHTS[self.light_phase, route_ids]
+        stop_gaps = STOP_LINE_S[route_ids] - (self.s + ls / 2.)
+        is_stopping = (stop_gaps >= 0.) & (stop_gaps < gaps) & \
+                      ((lights == LIGHT_RED) | ((lights == LIGHT_YELLOW) & (stop_gaps > self.v ** 2 / (2. * bs))))
+        gaps = np.where(is_stopping, stop_gaps, gaps)
+        leader_vs = np.where(is_stopping, 0., leader_vs)
+
+        # IDM
+        desired_gaps = s0s + np.maximum(0., self.v * Ts + self.v * (self.v - leader_vs) / (2. * np.sqrt(a_maxs * bs)))
+        accs = a_maxs * (1. - (self.v / v0s) ** 4 - (desired_gaps / np.maximum(gaps, 1e-3)) ** 2)
+        accs = np.clip(accs, -FLOW_EMERGENCY_B[self.flow_ids], a_maxs)
+        self.v = np.minimum(np.maximum(self.v + accs * self.step_time, 0.),
+                            np.maximum(gaps, 0.) / self.step_time)  # never run into the leader within one step
+        self.s = self.s + self.v * self.step_time
+        self._keep(self.s < ROUTE_LENS[route_ids])
+
+        self._insert_arrivals(blocker_route_ids, blocker_ss, blocker_ls)
+
+    def _insert_arrivals(self, blocker_route_ids, blocker_ss, blocker_ls):
+        self.pending += np.random.poisson(FLOW_RATES * self.step_time)
+        flow_ids = np.flatnonzero(self.pending)
+        if len(flow_ids) == 0:
+            return
+        # at most one insertion trial per route and step
+        route_ids, firsts = np.unique(FLOW_ROUTE_IDS[flow_ids], return_index=True)
+        flow_ids = flow_ids[firsts]
+        ls = FLOW_L[flow_ids]
+        ss = np.random.uniform(ls / 2., STOP_LINE_S[route_ids] - ls / 2.)
+        all_route_ids = np.concatenate([FLOW_ROUTE_IDS[self.flow_ids], blocker_route_ids])
+        all_ss, all_ls = np.concatenate([self.s, blocker_ss]), np.concatenate([FLOW_L[self.flow_ids], blocker_ls])
+        is_same_route = route_ids[:, np.newaxis] == all_route_ids
+        gaps = np.where(is_same_route, np.abs(all_ss - ss[:, np.newaxis]) - (all_ls + ls[:, np.newaxis]) / 2., np.inf)
+        is_free = np.all(gaps >= FLOW_S0[flow_ids, np.newaxis], axis=1)
+        if not np.any(is_free):
+            return
+        flow_ids, route_ids, ls, ss = flow_ids[is_free], route_ids[is_free], ls[is_free], ss[is_free]
+        # random speed, but able to stop behind the leader or at the stop line
+        leader_gaps = np.min(np.where(all_ss > ss[:, np.newaxis], gaps[is_free], np.inf), axis=1, initial=np.inf)
+        leader_gaps = np.where(PHASE_ROUTE_LIGHTS[self.light_phase, route_ids] != LIGHT_GO,
+                               np.minimum(leader_gaps, STOP_LINE_S[route_ids] - ss - ls / 2.), leader_gaps)
+        vs = np.minimum(np.random.uniform(0., FLOW_V0[flow_ids]),
+                        np.sqrt(2. * FLOW_B[flow_ids] * np.maximum(leader_gaps - FLOW_S0[flow_ids], 0.)))
+        self.flow_ids = np.concatenate([self.flow_ids, flow_ids])
+        self.s = np.concatenate([self.s, ss])
+        self.v = np.concatenate([self.v, vs])
+        self.pending[flow_ids] -= 1
+
+    def _remove_conflict_vehicles(self, n_ego_dict):
+        xs, ys, phis = self._positions()
+        self._keep(~conflict_mask(xs, ys, phis, self.v, FLOW_L[self.flow_ids], n_ego_dict))
+
+    @PROFILER.timed('traffic.get_vehicles')
+    def _get_vehicles(self):
+        self.n_ego_vehicles = defaultdict(list)
+        xs, ys, phis = self._positions()
+        ls, ws = FLOW_L[self.flow_ids], FLOW_W[self.flow_ids]
+        self._others = xs, ys, phis, ls, ws
+        # the dicts are shared by the egos and must not be modified
+        vehicles = [dict(x=x, y=y, v=v, phi=phi, l=l, w=w, route=ROUTES[route_id])
+                    for x, y, v, phi, l, w, route_id in zip(xs.tolist(), ys.tolist(), self.v.tolist(), phis.tolist(),
+                                                           ls.tolist(), ws.tolist(),
+                                                           FLOW_ROUTE_IDS[self.flow_ids].tolist())]
+        for egoID in self.n_ego_dict.keys():
+            self.n_ego_vehicles[egoID] = vehicles + \
+                [dict(x=ego_dict['x'], y=ego_dict['y'], v=sqrt(ego_dict['v_x'] ** 2 + ego_dict['v_y'] ** 2),
+                      phi=ego_dict['phi'], l=ego_dict['l'], w=ego_dict['w'], route=MODE2ROUTE[ego_dict['routeID']])
+                 for other_egoID, ego_dict in self.n_ego_dict.items() if other_egoID != egoID]
+
+    @PROFILER.timed('traffic.collision_check')
+    def collision_check(self):  # True: collision
+        self.n_ego_collision_flag, self.n_ego_collision_ids = n_ego_collision_check(self._others, self.n_ego_dict)
+
+
+def test_surrogate_traffic():
+    import time
+    init_state = dict(ego=dict(v_x=8., v_y=0, r=0, x=-30, y=1.5, phi=180, l=4.8, w=2.2, routeID='dl'))
+    traffic = SurrogateTraffic(100., mode='display', init_n_ego_dict=init_state, training_task='left')
+    traffic.init_traffic(init_state)
+    start = time.time()
+    for i in range(1000):
+        traffic.sim_step()
+    print('{} vehicles, time per step: {:.6f}s'.format(len(traffic.n_ego_vehicles['ego']),
+                                                       (time.time() - start) / 1000))
+
+
+if __name__ == "__main__":
+    test_surrogate_traffic()
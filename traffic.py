@@ -7,13 +7,12 @@
 # @FileName: traffic.py
 # =====================================
 
-import copy
+import glob
 import math
 import os
 import random
 import sys
 from collections import defaultdict
-from math import fabs, cos, sin, pi
 
 if 'SUMO_HOME' in os.environ:
     tools = os.path.join(os.environ['SUMO_HOME'], 'tools')
@@ -21,20 +20,138 @@ if 'SUMO_HOME' in os.environ:
 else:
     sys.exit("please declare environment variable 'SUMO_HOME'")
 
+import numpy as np
 import sumolib
 from sumolib import checkBinary
 import traci
-from traci.exceptions import FatalTraCIError
-from endtoend_env_utils import shift_and_rotate_coordination, _convert_car_coord_to_sumo_coord, \
-    _convert_sumo_coord_to_car_coord, xy2_edgeID_lane, SUMOCFG_DIR, TASK2ROUTEID
+from traci.exceptions import FatalTraCIError, TraCIException  # before libsumo, which patches traci.exceptions
+try:
+    import libsumo  # in-process sumo with the traci api, no socket
+except ImportError:
+    libsumo = None
+from endtoend_env_utils import _convert_car_coord_to_sumo_coord, _convert_sumo_coord_to_car_coord_batch, \
+    xy2_edgeID_lane, collision_check_grid, conflict_mask, SUMOCFG_DIR, SNAPSHOT_DIR, TASK2ROUTEID, ROUTE2MODE, MODE2ID
+from profiler import PROFILER
 
 SUMO_BINARY = checkBinary('sumo')
+SUMO_ERRORS = (TraCIException,) + ((libsumo.TraCIException,) if libsumo is not None else ())
 SIM_PERIOD = 1.0 / 10
+WARM_UP_TIME = 100
+# the per-step variables of the surrounding vehicles, the static ones are fetched once per vehicle, see _static_info
+DYNAMIC_VARS = [traci.constants.VAR_POSITION, traci.constants.VAR_ANGLE, traci.constants.VAR_SPEED]
+CONFLICT_RANGE = 30.  # m, beyond the ego speed, the conflict vehicles of a spawned ego are searched within this
+
+
+def _start_sumo(step_time_str, seed=None, label='default', sumo=traci):
+    sumo_cmd = [SUMO_BINARY, "-c", SUMOCFG_DIR,
+                "--step-length", step_time_str,
+                "--lateral-resolution", "3.5",
+                # "--start",
+                # "--quit-on-end",
+                "--no-warnings",
+                "--no-step-log"]
+    sumo_cmd += ["--random"] if seed is None else ["--seed", str(int(seed))]
+    if sumo is libsumo:
+        libsumo.start(sumo_cmd)
+        return
+    try:
+        traci.start(sumo_cmd, numRetries=5, label=label)
+    except FatalTraCIError:
+        print('Retry by other port')
+        port = sumolib.miscutils.getFreeSocketPort()
+        traci.start(sumo_cmd, port=port, numRetries=5, label=label)
+
+
+def _warm_up(connection, end_time, light_phase=0):
+    # the other phase until 20s before the end, so that both directions have queued a bit
+    while connection.simulation.getTime() < end_time:
+        if connection.simulation.getTime() < WARM_UP_TIME - 20:
+            connection.trafficlight.setPhase('0', 2 - light_phase)
+        else:
+            connection.trafficlight.setPhase('0', light_phase)
+        connection.simulationStep()
+
+
+def _snapshot_dir(step_time_str):
+    return os.path.join(SNAPSHOT_DIR, step_time_str)
+
+
+def build_snapshot_pool(step_length=100, seeds=range(10), light_phases=(0, 2), save_times=(100, 115, 130)):
+    """run sumo to steady state for every seed and light phase, and save the states for Traffic to start from,
+    e.g. python -c "from traffic import build_snapshot_pool; build_snapshot_pool()" """
+    step_time_str = str(float(step_length) / 1000)
+    pool_dir = _snapshot_dir(step_time_str)
+    os.makedirs(pool_dir, exist_ok=True)
+    label = 'snapshot_builder'
+    for seed in seeds:
+        for light_phase in light_phases:
+            _start_sumo(step_time_str, seed=seed, label=label)
+            connection = traci.getConnection(label)
+            for save_time in sorted(save_times):
+                _warm_up(connection, save_time, light_phase)
+                file_name = os.path.join(pool_dir, 'phase{}_seed{}_t{}.xml.gz'.format(light_phase, seed, save_time))
+                tmp_file_name = file_name[:-len('.xml.gz')] + '.{}.tmp.xml.gz'.format(os.getpid())
+                connection.simulation.saveState(tmp_file_name)
+                os.replace(tmp_file_name, file_name)
+            connection.close()
+
+
+def load_snapshot_pool(step_time_str):
+    """light phase -> saved states, empty if build_snapshot_pool has not been run"""
+    snapshots = {}
+    for file_name in sorted(glob.glob(os.path.join(_snapshot_dir(step_time_str), 'phase*_seed*_t*.xml.gz'))):
+        if '.tmp.' in file_name:
+            continue
+        light_phase = int(os.path.basename(file_name).split('_')[0][len('phase'):])
+        snapshots.setdefault(light_phase, []).append(file_name)
+    return snapshots
+
+
+def _static_info(sumo, veh):
+    """length, width, route and its MODE2ID (-1 if not in ROUTE2MODE) of a vehicle, None for the vehicles parked on
+    4i by _remove_conflict_vehicles"""
+    route = sumo.vehicle.getRoute(veh)
+    if route[0] == '4i':
+        return None
+    return sumo.vehicle.getLength(veh), sumo.vehicle.getWidth(veh), route, \
+        MODE2ID[ROUTE2MODE[route]] if route in ROUTE2MODE else -1
+
+
+class VehicleTable(object):
+    """the vehicles of a step decoded once as a struct of arrays, the columns of table are x, y, v, phi, l, w in car
+    coord, mode_ids are the MODE2ID of the routes"""
+    def __init__(self, ids, table, routes, mode_ids):
+        self.ids = ids
+        self.rows = {veh: i for i, veh in enumerate(ids)}
+        self.table = table
+        self.routes = routes
+        self.mode_ids = mode_ids
+        # the dicts of the n_ego_vehicles interface, they are shared by the egos and must not be modified
+        self.vehicles = [dict(x=x, y=y, v=v, phi=phi, l=l, w=w, route=route)
+                         for (x, y, v, phi, l, w), route in zip(table.tolist(), routes)]
+
+    def __len__(self):
+        return len(self.ids)
+
+    def others(self, vehID):
+        """mask of the rows of all vehicles but vehID"""
+        mask = np.ones((len(self.ids),), dtype=bool)
+        if vehID in self.rows:
+            mask[self.rows[vehID]] = False
+        return mask
+
+    def vehicles_but(self, vehID):
+        i = self.rows.get(vehID)
+        return list(self.vehicles) if i is None else self.vehicles[:i] + self.vehicles[i + 1:]
 
 
 class Traffic(object):
 
-    def __init__(self, step_length, mode, init_n_ego_dict, training_task='left'):  # mode 'display' or 'training'
+    def __init__(self, step_length, mode, init_n_ego_dict, training_task='left',
+                 snapshot_reset=False,
+                 sumo_backend=None,  # mode 'display' or 'training', sumo_backend 'traci' or 'libsumo'
+                 roi_radius=None,  # m, only the vehicles this close to an ego are seen, None for the whole network
+                 roi_filters=None):  # e.g. [('addSubscriptionFilterVClass', (['passenger'],))], see _subscribe_roi
         self.random_traffic = None
         self.sim_time = 0
         self.n_ego_vehicles = defaultdict(list)
@@ -42,9 +159,15 @@ class Traffic(object):
         self.step_time_str = str(float(step_length) / 1000)
         self.collision_flag = False
         self.n_ego_collision_flag = {}
+        self.n_ego_collision_ids = {}  # egoID -> ids of the vehicles it collides with
         self.collision_ego_id = None
         self.v_light = None
         self.n_ego_dict = init_n_ego_dict
+        self.trace_writer = None  # a replay_traffic.TraceWriter records the traffic of every sim_step
+        self.veh_table = None  # VehicleTable of the last sim_step
+        self._veh_static = {}  # vehicle id -> _static_info, until the vehicle arrives
+        self.roi_radius = roi_radius
+        self.roi_filters = roi_filters or []
         # dict(DL1=dict(x=1.875, y=-30, v=3, a=90, l=4.8, w=2.2),
         #      UR1=dict(x=-1.875, y=30, v=3, a=-90, l=4.8, w=2.2),
         #      DR1=dict(x=5.625, y=-30, v=3, a=90, l=4.8, w=2.2),
@@ -58,61 +181,68 @@ class Traffic(object):
             if random.random() > 0.5:
                 self.training_light_phase = 2
 
-        try:
-            traci.start(
-                [SUMO_BINARY, "-c", SUMOCFG_DIR,
-                 "--step-length", self.step_time_str,
-                 "--lateral-resolution", "3.5",
-                 "--random",
-                 # "--start",
-                 # "--quit-on-end",
-                 "--no-warnings",
-                 "--no-step-log",
-                 # '--seed', str(int(seed))
-                 ], numRetries=5)  # '--seed', str(int(seed))
-        except FatalTraCIError:
-            print('Retry by other port')
-            port = sumolib.miscutils.getFreeSocketPort()
-            traci.start(
-                [SUMO_BINARY, "-c", SUMOCFG_DIR,
-                 "--step-length", self.step_time_str,
-                 "--lateral-resolution", "3.5",
-                 "--random",
-                 # "--start",
-                 # "--quit-on-end",
-                 "--no-warnings",
-                 "--no-step-log",
-                 # '--seed', str(int(seed))
-                 ], port=port, numRetries=5)  # '--seed', str(int(seed))
-
-        traci.vehicle.subscribeContext('collector',
-                                       traci.constants.CMD_GET_VEHICLE_VARIABLE,
-                                       999999, [traci.constants.VAR_POSITION,
-                                                traci.constants.VAR_LENGTH,
-                                                traci.constants.VAR_WIDTH,
-                                                traci.constants.VAR_ANGLE,
-                                                traci.constants.VAR_SIGNALS,
-                                                traci.constants.VAR_SPEED,
-                                                # traci.constants.VAR_TYPE,
-                                                # traci.constants.VAR_EMERGENCY_DECEL,
-                                                # traci.constants.VAR_LANE_INDEX,
-                                                # traci.constants.VAR_LANEPOSITION,
-                                                traci.constants.VAR_EDGES,
-                                                # traci.constants.VAR_ROUTE_INDEX
-                                                ],
-                                       0, 2147483647)
-        while traci.simulation.getTime() < 100:
-            if traci.simulation.getTime() < 80:
-                traci.trafficlight.setPhase('0', 2)
-            else:
-                traci.trafficlight.setPhase('0', 0)
+        # libsumo runs sumo in this process, by default it is used for training if installed
+        if sumo_backend is None:
+            sumo_backend = 'libsumo' if mode == 'training' and libsumo is not None else 'traci'
+        assert sumo_backend in ['traci', 'libsumo']
+        assert sumo_backend == 'traci' or libsumo is not None, 'libsumo is not installed'
+        self.sumo = libsumo if sumo_backend == 'libsumo' else traci
+        _start_sumo(self.step_time_str, sumo=self.sumo)
+        self._subscribe()
+        # start from a saved steady state if there is one, otherwise warm up for 100s
+        self.snapshot_reset = snapshot_reset
+        self.snapshots = load_snapshot_pool(self.step_time_str)
+        if self.snapshots:
+            self._load_snapshot(self.training_light_phase)
+        else:
+            _warm_up(self.sumo, WARM_UP_TIME)
 
             # if self.mode == "training":
             #     traci.trafficlight.setPhase('0', self.training_light_phase)
-            traci.simulationStep()
+
+    def _subscribe(self):  # subscriptions are dropped by loadState
+        if self.roi_radius is None:
+            self.sumo.vehicle.subscribeContext('collector', traci.constants.CMD_GET_VEHICLE_VARIABLE, 999999,
+                                               DYNAMIC_VARS, 0, 2147483647)
+        # the egos are subscribed by _recycle_egos, once they are in the simulation
+        self.sumo.simulation.subscribe([traci.constants.VAR_ARRIVED_VEHICLES_IDS])  # to clean up _veh_static
+
+    def _subscribe_roi(self, n_ego_dict):
+        """context subscriptions centred on the egos, each followed by the filters of roi_filters, given as
+        (name of a sumo.vehicle.addSubscriptionFilter* function, args), they apply to the last subscription"""
+        for egoID in n_ego_dict:
+            self.sumo.vehicle.subscribeContext(egoID, traci.constants.CMD_GET_VEHICLE_VARIABLE, self.roi_radius,
+                                               DYNAMIC_VARS)
+            for filter_name, filter_args in self.roi_filters:
+                getattr(self.sumo.vehicle, filter_name)(*filter_args)
+
+    def _context_results(self):
+        if self.roi_radius is None:
+            return self.sumo.vehicle.getContextSubscriptionResults('collector')
+        veh_infos = {}
+        for egoID in self.n_ego_dict:
+            veh_infos.update(self.sumo.vehicle.getContextSubscriptionResults(egoID))
+        return veh_infos
+
+    def _spawn_area_results(self, n_ego_dict):
+        """vehicles around the given egos right now. The ego subscriptions can not be used, as the egos are moved at
+        the next step, so this is a one-off context subscription on the junction, whose results come at once"""
+        radius = max(math.hypot(ego_dict['x'], ego_dict['y']) + ego_dict['v_x'] + CONFLICT_RANGE
+                     for ego_dict in n_ego_dict.values())
+        self.sumo.junction.subscribeContext('0', traci.constants.CMD_GET_VEHICLE_VARIABLE, radius, DYNAMIC_VARS)
+        veh_infos = self.sumo.junction.getContextSubscriptionResults('0')
+        self.sumo.junction.unsubscribeContext('0', traci.constants.CMD_GET_VEHICLE_VARIABLE, radius)
+        return veh_infos
+
+    def _load_snapshot(self, light_phase):
+        snapshots = self.snapshots.get(light_phase) or [f for fs in self.snapshots.values() for f in fs]
+        self.sumo.simulation.loadState(random.choice(snapshots))
+        self._veh_static = {}
+        self._subscribe()
+        self.sumo.simulationStep()  # fill the subscription results
 
     def __del__(self):
-        traci.close()
+        self.sumo.close()
 
     def add_self_car(self, n_ego_dict, with_delete=True):
         for egoID, ego_dict in n_ego_dict.items():
@@ -126,101 +256,132 @@ class Traffic(object):
             edgeID, lane = xy2_edgeID_lane(ego_x, ego_y)
             if with_delete:
                 try:
-                    traci.vehicle.remove(egoID)
-                except traci.exceptions.TraCIException:
+                    self.sumo.vehicle.remove(egoID)
+                except SUMO_ERRORS:
                     print('Don\'t worry, it\'s been handled well')
-                traci.simulationStep()
-                traci.vehicle.addLegacy(vehID=egoID, routeID=ego_dict['routeID'],
-                                        # depart=0, pos=20, lane=lane, speed=ego_dict['v_x'],
-                                        typeID='self_car')
-            traci.vehicle.moveToXY(egoID, edgeID, lane, ego_x_in_sumo, ego_y_in_sumo, ego_a_in_sumo, keepRoute=1)
-            traci.vehicle.setLength(egoID, ego_dict['l'])
-            traci.vehicle.setWidth(egoID, ego_dict['w'])
-            traci.vehicle.setSpeed(egoID, math.sqrt(ego_v_x ** 2 + ego_v_y ** 2))
-
-    def generate_random_traffic(self):
-        random_traffic = traci.vehicle.getContextSubscriptionResults('collector')
-        random_traffic = copy.deepcopy(random_traffic)
-
-        for ego_id in self.n_ego_dict.keys():
-            if ego_id in random_traffic:
-                del random_traffic[ego_id]
-
-        return random_traffic
+                self.sumo.simulationStep()
+                self.sumo.vehicle.addLegacy(vehID=egoID, routeID=ego_dict['routeID'],
+                                            # depart=0, pos=20, lane=lane, speed=ego_dict['v_x'],
+                                            typeID='self_car')
+            self.sumo.vehicle.moveToXY(egoID, edgeID, lane, ego_x_in_sumo, ego_y_in_sumo, ego_a_in_sumo, keepRoute=1)
+            self.sumo.vehicle.setLength(egoID, ego_dict['l'])
+            self.sumo.vehicle.setWidth(egoID, ego_dict['w'])
+            self.sumo.vehicle.setSpeed(egoID, math.sqrt(ego_v_x ** 2 + ego_v_y ** 2))
+
+    def _recycle_egos(self, n_ego_dict):
+        """keep the egos of the last episode alive and only add the missing ones (e.g. after a snapshot load),
+        a simulation step is only needed when an ego can not be put on its new route in place"""
+        veh_ids = set(self.sumo.vehicle.getIDList())
+        to_remove = [egoID for egoID in self.n_ego_dict if egoID not in n_ego_dict and egoID in veh_ids]
+        for egoID, ego_dict in n_ego_dict.items():
+            if egoID in veh_ids and self.sumo.vehicle.getRouteID(egoID) != ego_dict['routeID']:
+                # the route can only be replaced when the current edge is on it, all ego routes start from 1o
+                if self.sumo.vehicle.getRoadID(egoID) == '1o':
+                    self.sumo.vehicle.setRouteID(egoID, ego_dict['routeID'])
+                else:
+                    to_remove.append(egoID)
+        for egoID in to_remove:
+            self.sumo.vehicle.remove(egoID)
+            veh_ids.discard(egoID)
+        for egoID in n_ego_dict:  # the routes of the egos may have changed
+            self._veh_static.pop(egoID, None)
+        if any(egoID in n_ego_dict for egoID in to_remove):
+            self.sumo.simulationStep()
+        for egoID, ego_dict in n_ego_dict.items():
+            if egoID not in veh_ids:
+                self.sumo.vehicle.addLegacy(vehID=egoID, routeID=ego_dict['routeID'], typeID='self_car')
+        if self.roi_radius is not None:
+            self._subscribe_roi(n_ego_dict)
 
+    @PROFILER.timed('traffic.init_traffic')
     def init_traffic(self, init_n_ego_dict):
         self.sim_time = 0
         self.n_ego_vehicles = defaultdict(list)
         self.collision_flag = False
         self.n_ego_collision_flag = {}
+        self.n_ego_collision_ids = {}
         self.collision_ego_id = None
         self.v_light = None
         self.training_light_phase = 0
         if self.training_task == 'right':
             if random.random() > 0.5:
                 self.training_light_phase = 2
+        if self.snapshot_reset and self.snapshots:
+            # loading takes ~0.15s, so by default the traffic just goes on from the last episode
+            self._load_snapshot(self.training_light_phase)
+        self.sumo.trafficlight.setPhase('0', self.training_light_phase)
+        self._recycle_egos(init_n_ego_dict)
         self.n_ego_dict = init_n_ego_dict
-        traci.trafficlight.setPhase('0', self.training_light_phase)
-        self.add_self_car(init_n_ego_dict)
-        traci.simulationStep()
-        random_traffic = self.generate_random_traffic()
         self.add_self_car(init_n_ego_dict, with_delete=False)
 
         # move ego to the given position and remove conflict cars
-        for egoID, ego_dict in self.n_ego_dict.items():
-            ego_x, ego_y, ego_v_x, ego_v_y, ego_phi, ego_l, ego_w = ego_dict['x'], ego_dict['y'], ego_dict['v_x'],\
-                                                                    ego_dict['v_y'], ego_dict['phi'], ego_dict['l'], \
-                                                                    ego_dict['w']
-            for veh in random_traffic:
-                x_in_sumo, y_in_sumo = random_traffic[veh][traci.constants.VAR_POSITION]
-                a_in_sumo = random_traffic[veh][traci.constants.VAR_ANGLE]
-                veh_l = random_traffic[veh][traci.constants.VAR_LENGTH]
-                veh_v = random_traffic[veh][traci.constants.VAR_SPEED]
-                # veh_sig = random_traffic[veh][traci.constants.VAR_SIGNALS]
-                # 10: left and brake 9: right and brake 1: right 8: brake 0: no signal 2: left
-
-                x, y, a = _convert_sumo_coord_to_car_coord(x_in_sumo, y_in_sumo, a_in_sumo, veh_l)
-                x_in_ego_coord, y_in_ego_coord, a_in_ego_coord = shift_and_rotate_coordination(x, y, a, ego_x,
-                                                                                               ego_y, ego_phi)
-                ego_x_in_veh_coord, ego_y_in_veh_coord, ego_a_in_veh_coord = shift_and_rotate_coordination(0, 0, 0,
-                                                                                                           x_in_ego_coord,
-                                                                                                           y_in_ego_coord,
-                                                                                                           a_in_ego_coord)
-                if (-5 < x_in_ego_coord < 1 * (ego_v_x) + ego_l/2. + veh_l/2. + 2 and abs(y_in_ego_coord) < 3) or \
-                        (-5 < ego_x_in_veh_coord < 1 * (veh_v) + ego_l/2. + veh_l/2. + 2 and abs(ego_y_in_veh_coord) <3):
-                    traci.vehicle.moveToXY(veh, '4i', 1, -80, 1.85, 180, 2)
-                    # traci.vehicle.remove(vehID=veh)
-                # if 0<x_in_sumo<3.5 and -22<y_in_sumo<-15:# and veh_sig!=1 and veh_sig!=9:
-                #     traci.vehicle.moveToXY(veh, '4o', 1, -80, 1.85, 180,2)
-                #     traci.vehicle.remove(vehID=veh)
-
+        self._remove_conflict_vehicles(self.n_ego_dict)
+        if self.trace_writer is not None:
+            self.trace_writer.add_episode_start()
+
+    def reset_ego(self, egoID, ego_dict):
+        """re-spawn a single ego in the running simulation, without stepping it, other egos are left untouched"""
+        self._recycle_egos(dict(self.n_ego_dict, **{egoID: ego_dict}))
+        self.n_ego_dict[egoID] = ego_dict
+        self.add_self_car({egoID: ego_dict}, with_delete=False)
+        self._remove_conflict_vehicles({egoID: ego_dict})
+        self.n_ego_collision_flag[egoID] = False
+
+    def _remove_conflict_vehicles(self, n_ego_dict):
+        veh_table = self._decode_vehicles(None if self.roi_radius is None else self._spawn_area_results(n_ego_dict))
+        xs, ys, vs, phis, ls, _ = veh_table.table.T
+        is_conflict = conflict_mask(xs, ys, phis, vs, ls, n_ego_dict)
+        for veh in self.n_ego_dict:
+            if veh in veh_table.rows:
+                is_conflict[veh_table.rows[veh]] = False
+        for i in np.flatnonzero(is_conflict):
+            veh = veh_table.ids[i]
+            self.sumo.vehicle.moveToXY(veh, '4i', 1, -80, 1.85, 180, 2)
+            self._veh_static.pop(veh, None)  # its route changes
+            # traci.vehicle.remove(vehID=veh)
+
+    def _decode_vehicles(self, veh_infos=None):
+        """subscription results (default of the last step) -> VehicleTable, the vehicles parked on 4i are left out"""
+        if veh_infos is None:
+            veh_infos = self._context_results()
+        ids, dynamics, statics = [], [], []
+        for veh, veh_info in veh_infos.items():
+            if veh not in self._veh_static:
+                self._veh_static[veh] = _static_info(self.sumo, veh)
+            static = self._veh_static[veh]
+            if static is None:
+                continue
+            ids.append(veh)
+            statics.append(static)
+            dynamics.append(veh_info[traci.constants.VAR_POSITION] + (veh_info[traci.constants.VAR_ANGLE],
+                                                                       veh_info[traci.constants.VAR_SPEED]))
+        dynamics = np.array(dynamics, dtype=np.float64).reshape(-1, 4)
+        ls = np.array([static[0] for static in statics], dtype=np.float64)
+        ws = np.array([static[1] for static in statics], dtype=np.float64)
+        xs, ys, phis = _convert_sumo_coord_to_car_coord_batch(dynamics[:, 0], dynamics[:, 1], dynamics[:, 2], ls)
+        return VehicleTable(ids, np.stack([xs, ys, dynamics[:, 3], phis, ls, ws], axis=1),
+                            [static[2] for static in statics],
+                            np.array([static[3] for static in statics], dtype=np.int64))
+
+    @PROFILER.timed('traffic.get_vehicles')
     def _get_vehicles(self):
+        self.veh_table = self._decode_vehicles()
         self.n_ego_vehicles = defaultdict(list)
-        veh_infos = traci.vehicle.getContextSubscriptionResults('collector')
         for egoID in self.n_ego_dict.keys():
-            veh_info_dict = copy.deepcopy(veh_infos)
-            for i, veh in enumerate(veh_info_dict):
-                if veh != egoID:
-                    length = veh_info_dict[veh][traci.constants.VAR_LENGTH]
-                    width = veh_info_dict[veh][traci.constants.VAR_WIDTH]
-                    route = veh_info_dict[veh][traci.constants.VAR_EDGES]
-                    if route[0] == '4i':
-                        continue
-                    x_in_sumo, y_in_sumo = veh_info_dict[veh][traci.constants.VAR_POSITION]
-                    a_in_sumo = veh_info_dict[veh][traci.constants.VAR_ANGLE]
-                    # transfer x,y,a in car coord
-                    x, y, a = _convert_sumo_coord_to_car_coord(x_in_sumo, y_in_sumo, a_in_sumo, length)
-                    v = veh_info_dict[veh][traci.constants.VAR_SPEED]
-                    self.n_ego_vehicles[egoID].append(dict(x=x, y=y, v=v, phi=a, l=length,
-                                                           w=width, route=route))
+            self.n_ego_vehicles[egoID] = self.veh_table.vehicles_but(egoID)
+
+    def _record_trace(self):  # the surrounding vehicles of all egos, see replay_traffic.TraceWriter
+        self.trace_writer.add_step({veh: veh_dict for veh, veh_dict in zip(self.veh_table.ids, self.veh_table.vehicles)
+                                    if veh not in self.n_ego_dict}, self.v_light)
 
     def _get_traffic_light(self):
-        self.v_light = traci.trafficlight.getPhase('0')
+        self.v_light = self.sumo.trafficlight.getPhase('0')
 
+    @PROFILER.timed('traffic.sim_step')
     def sim_step(self):
         self.sim_time += SIM_PERIOD
         if self.mode == 'training':
-            traci.trafficlight.setPhase('0', self.training_light_phase)
+            self.sumo.trafficlight.setPhase('0', self.training_light_phase)
         # else:
         #     if self.sim_time < 5.:
         #         traci.trafficlight.setPhase('0', 2)
@@ -228,15 +389,20 @@ class Traffic(object):
         #         traci.trafficlight.setPhase('0', 1)
         #     else:
         #         traci.trafficlight.setPhase('0', 0)
-        traci.simulationStep()
+        self.sumo.simulationStep()
+        for veh in self.sumo.simulation.getSubscriptionResults()[traci.constants.VAR_ARRIVED_VEHICLES_IDS]:
+            self._veh_static.pop(veh, None)
         self._get_vehicles()
         self._get_traffic_light()
+        if self.trace_writer is not None:
+            self._record_trace()
         self.collision_check()
         for egoID, collision_flag in self.n_ego_collision_flag.items():
             if collision_flag:
                 self.collision_flag = True
                 self.collision_ego_id = egoID
 
+    @PROFILER.timed('traffic.set_own_car')
     def set_own_car(self, n_ego_dict_):
         assert len(self.n_ego_dict) == len(n_ego_dict_)
         for egoID in self.n_ego_dict.keys():
@@ -254,49 +420,30 @@ class Traffic(object):
             # if self.training_task == 'left':  # TODO
             #     keeproute = 2 if ego_x > 0 and ego_y > -7 else 1
             try:
-                traci.vehicle.moveToXY(egoID, egdeID, lane, ego_x_in_sumo, ego_y_in_sumo, ego_a_in_sumo, keeproute)
-            except traci.exceptions.TraCIException:
+                self.sumo.vehicle.moveToXY(egoID, egdeID, lane, ego_x_in_sumo, ego_y_in_sumo, ego_a_in_sumo, keeproute)
+            except SUMO_ERRORS:
                 print(egoID, egdeID, lane, ego_x_in_sumo, ego_y_in_sumo, ego_a_in_sumo, keeproute)
-                traci.vehicle.moveToXY(egoID, egdeID, lane, ego_x_in_sumo, ego_y_in_sumo, ego_a_in_sumo, keeproute)
-            traci.vehicle.setSpeed(egoID, math.sqrt(ego_v_x**2+ego_v_y**2))
+                self.sumo.vehicle.moveToXY(egoID, egdeID, lane, ego_x_in_sumo, ego_y_in_sumo, ego_a_in_sumo, keeproute)
+            self.sumo.vehicle.setSpeed(egoID, math.sqrt(ego_v_x**2+ego_v_y**2))
 
+    @PROFILER.timed('traffic.collision_check')
     def collision_check(self):  # True: collision
-        flag_dict = dict()
-        for egoID, list_of_veh_dict in self.n_ego_vehicles.items():
-            ego_x = self.n_ego_dict[egoID]['x']
-            ego_y = self.n_ego_dict[egoID]['y']
-            ego_phi = self.n_ego_dict[egoID]['phi']
-            ego_l = self.n_ego_dict[egoID]['l']
-            ego_w = self.n_ego_dict[egoID]['w']
-            ego_lw = (ego_l - ego_w) / 2
-            ego_x0 = (ego_x + cos(ego_phi / 180 * pi) * ego_lw)
-            ego_y0 = (ego_y + sin(ego_phi / 180 * pi) * ego_lw)
-            ego_x1 = (ego_x - cos(ego_phi / 180 * pi) * ego_lw)
-            ego_y1 = (ego_y - sin(ego_phi / 180 * pi) * ego_lw)
-            flag_dict[egoID] = False
-
-            for veh in list_of_veh_dict:
-                if fabs(veh['x'] - ego_x) < 10 and fabs(veh['y'] - ego_y) < 10:
-                    surrounding_lw = (veh['l'] - veh['w']) / 2
-                    surrounding_x0 = (veh['x'] + cos(veh['phi'] / 180 * pi) * surrounding_lw)
-                    surrounding_y0 = (veh['y'] + sin(veh['phi'] / 180 * pi) * surrounding_lw)
-                    surrounding_x1 = (veh['x'] - cos(veh['phi'] / 180 * pi) * surrounding_lw)
-                    surrounding_y1 = (veh['y'] - sin(veh['phi'] / 180 * pi) * surrounding_lw)
-                    collision_check_dis = ((veh['w'] + ego_w) / 2 + 0.5) ** 2
-                    if (ego_x0 - surrounding_x0) ** 2 + (ego_y0 - surrounding_y0) ** 2 < collision_check_dis:
-                        flag_dict[egoID] = True
-                    elif (ego_x0 - surrounding_x1) ** 2 + (ego_y0 - surrounding_y1) ** 2 < collision_check_dis:
-                        flag_dict[egoID] = True
-                    elif (ego_x1 - surrounding_x1) ** 2 + (ego_y1 - surrounding_y1) ** 2 < collision_check_dis:
-                        flag_dict[egoID] = True
-                    elif (ego_x1 - surrounding_x0) ** 2 + (ego_y1 - surrounding_y0) ** 2 < collision_check_dis:
-                        flag_dict[egoID] = True
-
-        self.n_ego_collision_flag = flag_dict
+        # every ego is checked against the vehicles of n_ego_vehicles, i.e. all but itself, the other egos as sumo
+        # sees them, see collision_check_grid
+        veh_table = self.veh_table
+        ego_ids = list(self.n_ego_dict.keys())
+        ego_table = np.array([[self.n_ego_dict[egoID][key] for key in ['x', 'y', 'phi', 'l', 'w']]
+                              for egoID in ego_ids], dtype=np.float64).reshape(-1, 5)
+        flags, ego_index, veh_index = collision_check_grid(ego_table, veh_table.table[:, [0, 1, 3, 4, 5]],
+                                                           ego_rows=[veh_table.rows.get(egoID, -1)
+                                                                     for egoID in ego_ids])
+        self.n_ego_collision_flag = dict(zip(ego_ids, flags.tolist()))
+        self.n_ego_collision_ids = {egoID: [] for egoID in ego_ids}
+        for i, j in zip(ego_index.tolist(), veh_index.tolist()):
+            self.n_ego_collision_ids[ego_ids[i]].append(veh_table.ids[j])
 
 
 def test_traffic():
-    import numpy as np
     from dynamics_and_models import ReferencePath
 
     def _reset_init_state():
@@ -33,7 +33,7 @@ class LoadPolicy(object):
                                          self.args.obs_scale, self.args.reward_scale, self.args.reward_shift,
                                          gamma=self.args.gamma)
         # self.preprocessor.load_params(load_dir)
-        init_obs = env.reset()
+        init_obs = np.zeros(env.observation_space.shape, dtype=np.float32)  # only to build the graphs, no sumo needed
         self.run_batch(init_obs[np.newaxis, :])
         self.obj_value_batch(init_obs[np.newaxis, :])
 
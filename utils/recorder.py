@@ -6,6 +6,10 @@
 # @Author  : Yang Guan (Tsinghua Univ.)
 # @FileName: recorder.py
 # =====================================
+import json
+import os
+from collections import OrderedDict
+
 import numpy as np
 import seaborn as sns
 import matplotlib.pyplot as plt
@@ -18,6 +22,68 @@ sns.set(style="darkgrid")
 WINDOWSIZE = 15
 
 
+class EpisodeLog(object):
+    """append-only columnar log of episodes. <path>.f32 holds one chunk per episode, in which every column is a
+    contiguous [T, width] float32 block, <path>.index holds the columns as a json line followed by one
+    'offset length' line per episode (offset in float32s), so a single episode is read by memory mapping its chunk"""
+    def __init__(self, path, mode='a'):  # 'w' starts a new log, 'a' appends to an existing one, 'r' reads
+        assert mode in ['w', 'a', 'r']
+        self.path = path
+        self.mode = mode
+        self.columns = None  # [(name, width)], set by the first episode
+        self.offsets, self.lengths = [], []
+        if mode == 'w':
+            for suffix in ['.f32', '.index']:
+                if os.path.exists(path + suffix):
+                    os.remove(path + suffix)
+        elif os.path.exists(path + '.index'):
+            with open(path + '.index') as f:
+                self.columns = [tuple(column) for column in json.loads(f.readline())]
+                for line in f:
+                    offset, length = line.split()
+                    self.offsets.append(int(offset))
+                    self.lengths.append(int(length))
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def append(self, episode):  # name -> [T] or [T, width]
+        assert self.mode != 'r'
+        blocks = [np.asarray(value, dtype=np.float32).reshape(len(value), -1) for value in episode.values()]
+        columns = [(name, block.shape[1]) for name, block in zip(episode, blocks)]
+        if self.columns is None:
+            self.columns = columns
+            with open(self.path + '.index', 'w') as f:
+                f.write(json.dumps(self.columns) + '\n')
+        assert columns == self.columns, (columns, self.columns)
+        with open(self.path + '.f32', 'ab') as f:
+            offset = f.tell() // 4
+            for block in blocks:
+                f.write(block.tobytes())
+        # the index line goes last, a chunk that was not written completely is never referenced
+        with open(self.path + '.index', 'a') as f:
+            f.write('{} {}\n'.format(offset, len(blocks[0])))
+        self.offsets.append(offset)
+        self.lengths.append(len(blocks[0]))
+
+    def episode(self, i):
+        """name -> [T] or [T, width] read-only views into the memory mapped chunk of the ith episode"""
+        length = self.lengths[i]
+        chunk = np.memmap(self.path + '.f32', dtype=np.float32, mode='r', offset=self.offsets[i] * 4,
+                          shape=(length * sum(width for _, width in self.columns),))
+        out, start = OrderedDict(), 0
+        for name, width in self.columns:
+            block = chunk[start:start + length * width].reshape(length, width)
+            out[name] = block[:, 0] if width == 1 else block
+            start += length * width
+        return out
+
+
+def _rows2columns(rows, names):
+    return OrderedDict((name, np.array([row[index] for row in rows], dtype=np.float32))
+                       for index, name in enumerate(names))
+
+
 class Recorder(object):
     def __init__(self):
         self.val2record = ['v_x', 'v_y', 'r', 'x', 'y', 'phi',
@@ -42,16 +108,20 @@ class Recorder(object):
         self.ego_info_dim = 6
         self.per_tracking_info_dim = 3
         self.num_future_data = 0
+        # finished episodes as columns, only those that are not in the logs yet are kept in memory
         self.data_across_all_episodes = []
         self.val_list_for_an_episode = []
         self.comp_list_for_an_episode = []
         self.comp_data_for_all_episodes = []
+        self.logdir = None  # the logs are appended to by save
+        self.val_log = None
+        self.comp_log = None
 
     def reset(self,):
         if self.val_list_for_an_episode:
-            self.data_across_all_episodes.append(self.val_list_for_an_episode)
+            self.data_across_all_episodes.append(_rows2columns(self.val_list_for_an_episode, self.val2record))
         if self.comp_list_for_an_episode:
-            self.comp_data_for_all_episodes.append(self.comp_list_for_an_episode)
+            self.comp_data_for_all_episodes.append(_rows2columns(self.comp_list_for_an_episode, self.comp2record))
         self.val_list_for_an_episode = []
         self.comp_list_for_an_episode = []
 
@@ -68,8 +138,8 @@ class Recorder(object):
         # transformation
         beta = 0 if v_x == 0 else np.arctan(v_y/v_x) * 180 / math.pi
         steer = steer * 180 / math.pi
-        self.val_list_for_an_episode.append(np.array([v_x, v_y, r, x, y, phi, steer, a_x, delta_y,
-                                        delta_phi, delta_v, cal_time, ref_index, beta, path_values, ss_time, is_ss]))
+        self.val_list_for_an_episode.append((v_x, v_y, r, x, y, phi, steer, a_x, delta_y,
+                                             delta_phi, delta_v, cal_time, ref_index, beta, path_values, ss_time, is_ss))
 
     # For comparison of MPC and ADP
     def record_compare(self, obs, adp_act, mpc_act, adp_time, mpc_time, adp_ref, mpc_ref, mode='ADP'):
@@ -87,23 +157,45 @@ class Recorder(object):
         beta = 0 if v_x == 0 else np.arctan(v_y/v_x) * 180 / math.pi
         adp_steer = adp_steer * 180 / math.pi
         mpc_steer = mpc_steer * 180 / math.pi
-        self.comp_list_for_an_episode.append(np.array([v_x, v_y, r, x, y, phi, adp_steer, adp_a_x, mpc_steer, mpc_a_x,
-                                            delta_y, delta_phi, delta_v, adp_time, mpc_time, adp_ref, mpc_ref, beta]))
+        self.comp_list_for_an_episode.append((v_x, v_y, r, x, y, phi, adp_steer, adp_a_x, mpc_steer, mpc_a_x,
+                                              delta_y, delta_phi, delta_v, adp_time, mpc_time, adp_ref, mpc_ref, beta))
 
     def save(self, logdir):
-        np.save(logdir + '/data_across_all_episodes.npy', np.array(self.data_across_all_episodes))
-        np.save(logdir + '/comp_data_for_all_episodes.npy', np.array(self.comp_data_for_all_episodes))
+        # the first save of a recorder starts new logs in logdir, later ones only append the episodes finished since
+        if self.logdir != logdir:
+            self.logdir = logdir
+            self.val_log = EpisodeLog(logdir + '/data_across_all_episodes', mode='w')
+            self.comp_log = EpisodeLog(logdir + '/comp_data_for_all_episodes', mode='w')
+        for episode in self.data_across_all_episodes:
+            self.val_log.append(episode)
+        for episode in self.comp_data_for_all_episodes:
+            self.comp_log.append(episode)
+        self.data_across_all_episodes = []
+        self.comp_data_for_all_episodes = []
 
     def load(self, logdir):
-        self.data_across_all_episodes = np.load(logdir + '/data_across_all_episodes.npy', allow_pickle=True)
-        self.comp_data_for_all_episodes = np.load(logdir + '/comp_data_for_all_episodes.npy', allow_pickle=True)
+        self.logdir = None
+        self.val_log = EpisodeLog(logdir + '/data_across_all_episodes', mode='r')
+        self.comp_log = EpisodeLog(logdir + '/comp_data_for_all_episodes', mode='r')
+        self.data_across_all_episodes, self.comp_data_for_all_episodes = [], []
+        # logs of older versions, pickled arrays of per step rows
+        if not self.val_log and os.path.exists(logdir + '/data_across_all_episodes.npy'):
+            self.data_across_all_episodes = [_rows2columns(episode, self.val2record) for episode in
+                                             np.load(logdir + '/data_across_all_episodes.npy', allow_pickle=True)]
+        if not self.comp_log and os.path.exists(logdir + '/comp_data_for_all_episodes.npy'):
+            self.comp_data_for_all_episodes = [_rows2columns(episode, self.comp2record) for episode in
+                                               np.load(logdir + '/comp_data_for_all_episodes.npy', allow_pickle=True)]
+
+    @staticmethod
+    def _get_episode(i, log, episodes_in_memory):  # the logged episodes come first
+        num_logged = len(log) if log is not None else 0
+        if i < 0:
+            i += num_logged + len(episodes_in_memory)
+        return log.episode(i) if i < num_logged else episodes_in_memory[i - num_logged]
 
     def plot_and_save_ith_episode_curves(self, i, save_dir, isshow=True):
-        episode2plot = self.data_across_all_episodes[i]
-        real_time = np.array([0.1*i for i in range(len(episode2plot))])
-        all_data = [np.array([vals_in_a_timestep[index] for vals_in_a_timestep in episode2plot])
-                    for index in range(len(self.val2record))]
-        data_dict = dict(zip(self.val2record, all_data))
+        data_dict = self._get_episode(i, self.val_log, self.data_across_all_episodes)
+        real_time = 0.1 * np.arange(len(data_dict['v_x']))
         color = ['cyan', 'indigo', 'magenta', 'coral', 'b', 'brown', 'c']
         i = 0
         for key in data_dict.keys():
@@ -202,11 +294,9 @@ class Recorder(object):
             plt.show()
 
     def plot_mpc_rl(self, i):
-        episode2plot = self.comp_data_for_all_episodes[i] if i is not None else self.comp_list_for_an_episode
-        real_time = np.array([0.1 * i for i in range(len(episode2plot))])
-        all_data = [np.array([vals_in_a_timestep[index] for vals_in_a_timestep in episode2plot])
-                    for index in range(len(self.comp2record))]
-        data_dict = dict(zip(self.comp2record, all_data))
+        data_dict = self._get_episode(i, self.comp_log, self.comp_data_for_all_episodes) if i is not None else \
+            _rows2columns(self.comp_list_for_an_episode, self.comp2record)
+        real_time = 0.1 * np.arange(len(data_dict['v_x']))
 
         df_mpc = pd.DataFrame({'algorithms': 'MPC',
                                'iteration': real_time,
@@ -0,0 +1,308 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# =====================================
+# @Time    : 2020/11/08
+# @Author  : Yang Guan (Tsinghua Univ.)
+# @FileName: vec_endtoend.py
+# =====================================
+
+import multiprocessing as mp
+import random
+from collections import OrderedDict
+from multiprocessing import shared_memory
+
+import gym
+import numpy as np
+
+from endtoend import CrossroadEnd2end, make_traffic
+
+
+class CrossroadEnd2endMultiEgo(object):
+    """N independent training egos driven in one SUMO instance, observations are stacked to (N, obs_dim),
+    obs of tasks with less surrounding vehicles are zero padded at the tail, see self.obs_dims"""
+    def __init__(self,
+                 training_tasks,  # e.g. ['left', 'left', 'straight', 'right']
+                 num_future_data=0,
+                 mode='training',
+                 **kwargs):
+        self.training_tasks = list(training_tasks)
+        self.num_envs = len(self.training_tasks)
+        self.ego_ids = ['ego{}'.format(i) for i in range(self.num_envs)]
+        self.num_future_data = num_future_data
+        self.mode = mode
+        self.spawn_dist = 10.  # min distance between a re-spawned ego and the others
+        self.spawn_trials = 10
+        self.envs = []
+        for ego_id, task in zip(self.ego_ids, self.training_tasks):
+            env = CrossroadEnd2end(task, num_future_data, mode, multi_display=True, **kwargs)
+            env.ego_id = ego_id
+            self.envs.append(env)
+        self.step_length = self.envs[0].step_length
+        self.action_space = self.envs[0].action_space
+        self.ego_xys = np.full((self.num_envs, 2), np.inf)
+        self.obs_dims = [env.observation_space.shape[0] for env in self.envs]
+        self.obs = np.zeros((self.num_envs, max(self.obs_dims)), dtype=np.float32)
+        self.observation_space = gym.spaces.Box(-np.inf, np.inf, shape=(max(self.obs_dims),), dtype=np.float32)
+
+        light_task = 'right' if all(task == 'right' for task in self.training_tasks) else 'left'
+        self.traffic = make_traffic(kwargs.get('traffic_backend', 'sumo'),
+                                    self.step_length,
+                                    mode=self.mode,
+                                    init_n_ego_dict={},
+                                    training_task=light_task,
+                                    **(kwargs.get('traffic_kwargs') or {}))
+        for env in self.envs:
+            env.traffic = self.traffic
+        self._reset_all()
+
+    def seed(self, seed=None):
+        return [env.seed(None if seed is None else seed + i)[0] for i, env in enumerate(self.envs)]
+
+    def reset(self):
+        self._reset_all()
+        return self.obs.copy()
+
+    def close(self):
+        for env in self.envs:
+            env.traffic = None
+        del self.traffic
+
+    def step(self, actions):
+        rewards = np.zeros((self.num_envs,), dtype=np.float32)
+        dones = np.zeros((self.num_envs,), dtype=np.bool_)
+        n_ego_dynamics = {}
+        for i, (env, action) in enumerate(zip(self.envs, actions)):
+            rewards[i], n_ego_dynamics[env.ego_id] = env._step_ego(action)
+        self.traffic.set_own_car(n_ego_dynamics)
+        self.traffic.sim_step()
+
+        infos = []
+        for i, env in enumerate(self.envs):
+            ego_dynamics = n_ego_dynamics[env.ego_id]
+            obs, _, done, info = env._step_obs(rewards[i], ego_dynamics, out=self._obs_row(i))
+            self.ego_xys[i] = ego_dynamics['x'], ego_dynamics['y']
+            if done:
+                info.update({'terminal_observation': obs.copy(), 'done_type': env.done_type})
+                self._reset_single(i)
+            dones[i] = done
+            infos.append(info)
+        return self.obs.copy(), rewards, dones, infos
+
+    def render(self, mode='human', index=0):
+        self.envs[index].render(mode)
+
+    def _obs_row(self, i):  # the envs write their obs straight into self.obs, the zero padding stays untouched
+        return self.obs[i, :self.obs_dims[i]]
+
+    def _spawn_ego(self, i):
+        # resample the init state until it is far enough from the other egos
+        env = self.envs[i]
+        others = np.delete(self.ego_xys, i, axis=0)
+        for _ in range(self.spawn_trials):
+            env._reset_ego()
+            init_ego_state = env.init_state[env.ego_id]
+            dists = np.hypot(others[:, 0] - init_ego_state['x'], others[:, 1] - init_ego_state['y'])
+            if not np.any(dists < self.spawn_dist):
+                break
+        self.ego_xys[i] = init_ego_state['x'], init_ego_state['y']
+        return init_ego_state
+
+    def _reset_all(self):
+        self.ego_xys[:] = np.inf
+        n_ego_dict = {}
+        for i, env in enumerate(self.envs):
+            n_ego_dict[env.ego_id] = self._spawn_ego(i)
+        self.traffic.init_traffic(n_ego_dict)
+        self.traffic.sim_step()
+        for i, env in enumerate(self.envs):
+            env._reset_obs(out=self._obs_row(i))
+
+    def _reset_single(self, i):
+        # the traffic is not stepped here, so the first obs still sees the vehicles
+        # that are cleared away from the new spawn point
+        env = self.envs[i]
+        init_ego_state = self._spawn_ego(i)
+        self.traffic.reset_ego(env.ego_id, init_ego_state)
+        env._reset_obs(out=self._obs_row(i))
+
+
+def _shm_buffers(shm, num_envs, obs_dim):
+    # one float32 block: obs | terminal obs | rewards | dones | actions
+    sizes = OrderedDict([('obs', (num_envs, obs_dim)),
+                         ('terminal_obs', (num_envs, obs_dim)),
+                         ('rewards', (num_envs,)),
+                         ('dones', (num_envs,)),
+                         ('actions', (num_envs, 2))])
+    buffers, offset = {}, 0
+    for key, shape in sizes.items():
+        buffers[key] = np.ndarray(shape, dtype=np.float32, buffer=shm.buf, offset=offset)
+        offset += int(np.prod(shape)) * 4
+    return buffers
+
+
+def _shm_nbytes(num_envs, obs_dim):
+    return (2 * num_envs * obs_dim + 4 * num_envs) * 4
+
+
+def _subproc_worker(remote, parent_remote, index, training_task, num_future_data, mode, seed, env_kwargs):
+    parent_remote.close()
+    random.seed(seed)
+    np.random.seed(seed)
+    env = CrossroadEnd2end(training_task, num_future_data, mode, **env_kwargs)
+    env.seed(seed)
+    obs_dim = env.observation_space.shape[0]
+    remote.send(obs_dim)
+    shm_name, num_envs, max_obs_dim = remote.recv()
+    shm = shared_memory.SharedMemory(name=shm_name)
+    buffers = _shm_buffers(shm, num_envs, max_obs_dim)
+    obs_buf, terminal_obs_buf = buffers['obs'][index], buffers['terminal_obs'][index]
+    try:
+        while True:
+            cmd = remote.recv()
+            if cmd == 'step':
+                obs, reward, done, info = env.step(buffers['actions'][index].copy(), out=obs_buf[:obs_dim])
+                done_info = None
+                if done:
+                    done_info = (env.done_type, info['ref_index'])
+                    terminal_obs_buf[:obs_dim] = obs
+                    env.reset(out=obs_buf[:obs_dim])
+                buffers['rewards'][index] = reward
+                buffers['dones'][index] = done
+                remote.send(done_info)
+            elif cmd == 'reset':
+                env.reset(out=obs_buf[:obs_dim])
+                remote.send(None)
+            elif cmd == 'close':
+                break
+            else:
+                raise NotImplementedError(cmd)
+    finally:
+        env.obs = None  # a view into the shared block as well
+        del obs_buf, terminal_obs_buf, buffers
+        shm.close()
+        env.close()
+        remote.close()
+
+
+class SubprocVecCrossroadEnd2end(object):
+    """one CrossroadEnd2end per subprocess, obs/reward/done are written by the workers into a shared float32 block,
+    the arrays returned by reset/step_wait are views into it and get overwritten by the next call"""
+    def __init__(self,
+                 training_tasks,  # one task per worker
+                 num_future_data=0,
+                 mode='training',
+                 seed=None,
+                 start_method='spawn',
+                 **kwargs):
+        self.training_tasks = list(training_tasks)
+        self.num_envs = len(self.training_tasks)
+        if seed is None:
+            seed = np.random.randint(2 ** 31 - self.num_envs)
+        self.seeds = [seed + i for i in range(self.num_envs)]
+        self.waiting = False
+        self.closed = False
+
+        ctx = mp.get_context(start_method)
+        self.remotes, work_remotes = zip(*[ctx.Pipe() for _ in range(self.num_envs)])
+        self.processes = []
+        for i, (work_remote, remote) in enumerate(zip(work_remotes, self.remotes)):
+            process = ctx.Process(target=_subproc_worker,
+                                  args=(work_remote, remote, i, self.training_tasks[i], num_future_data, mode,
+                                        self.seeds[i], kwargs),
+                                  daemon=True)
+            process.start()
+            self.processes.append(process)
+            work_remote.close()
+
+        self.obs_dims = [remote.recv() for remote in self.remotes]
+        obs_dim = max(self.obs_dims)
+        self.shm = shared_memory.SharedMemory(create=True, size=_shm_nbytes(self.num_envs, obs_dim))
+        self.buffers = _shm_buffers(self.shm, self.num_envs, obs_dim)
+        for key in self.buffers:
+            self.buffers[key][:] = 0.
+        for remote in self.remotes:
+            remote.send((self.shm.name, self.num_envs, obs_dim))
+        self.action_space = gym.spaces.Box(low=-1, high=1, shape=(2,), dtype=np.float32)
+        self.observation_space = gym.spaces.Box(-np.inf, np.inf, shape=(obs_dim,), dtype=np.float32)
+
+    def reset(self):
+        for remote in self.remotes:
+            remote.send('reset')
+        for remote in self.remotes:
+            remote.recv()
+        return self.buffers['obs']
+
+    def step_async(self, actions):
+        self.buffers['actions'][:] = actions
+        for remote in self.remotes:
+            remote.send('step')
+        self.waiting = True
+
+    def step_wait(self):
+        infos = []
+        for i, remote in enumerate(self.remotes):
+            result = remote.recv()
+            if result is None:
+                infos.append({})
+            else:
+                done_type, ref_index = result
+                infos.append({'done_type': done_type, 'ref_index': ref_index,
+                              'terminal_observation': self.buffers['terminal_obs'][i, :self.obs_dims[i]]})
+        self.waiting = False
+        return self.buffers['obs'], self.buffers['rewards'], self.buffers['dones'].astype(np.bool_), infos
+
+    def step(self, actions):
+        self.step_async(actions)
+        return self.step_wait()
+
+    def close(self):
+        if self.closed:
+            return
+        if self.waiting:
+            for remote in self.remotes:
+                remote.recv()
+        for remote in self.remotes:
+            remote.send('close')
+        for process in self.processes:
+            process.join()
+        self.buffers = None
+        self.shm.close()
+        self.shm.unlink()
+        self.closed = True
+
+
+def test_multi_ego():
+    import time
+    env = CrossroadEnd2endMultiEgo(['left', 'left', 'straight', 'straight', 'right', 'right'])
+    obs = env.reset()
+    print(obs.shape, env.obs_dims)
+    start = time.time()
+    for i in range(200):
+        actions = np.array([env.action_space.sample() for _ in range(env.num_envs)])
+        obs, rewards, dones, infos = env.step(actions)
+        for info, done in zip(infos, dones):
+            if done:
+                print(i, info['done_type'])
+    print('time per step: {:.4f}s'.format((time.time() - start) / 200))
+
+
+def test_subproc_vec():
+    import time
+    env = SubprocVecCrossroadEnd2end(['left', 'straight', 'right', 'left'], seed=0)
+    obs = env.reset()
+    print(obs.shape, env.obs_dims)
+    start = time.time()
+    for i in range(200):
+        actions = np.array([env.action_space.sample() for _ in range(env.num_envs)])
+        env.step_async(actions)
+        obs, rewards, dones, infos = env.step_wait()
+        for info, done in zip(infos, dones):
+            if done:
+                print(i, info['done_type'])
+    print('time per step: {:.4f}s'.format((time.time() - start) / 200))
+    env.close()
+
+
+if __name__ == '__main__':
+    test_subproc_vec()